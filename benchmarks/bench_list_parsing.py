@@ -0,0 +1,91 @@
+"""
+Stripeの一覧APIレスポンスを records にするまでのCPU時間とメモリ割り当てを比較するベンチマーク。
+
+- sdk: SDK と同じく JSON をパースして StripeObject を組み立て、to_dict() → rename_id_field → flatten_json
+- raw: レスポンス本文を parse_json（orjson）でパースし、flatten_record で1回の走査でフラット化
+
+実行方法（リポジトリのルートで）:
+    python benchmarks/bench_list_parsing.py --pages 100
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stripe  # noqa: E402
+
+import main  # noqa: E402
+from bench_serialization import make_invoice  # noqa: E402
+
+
+def make_list_bodies(pages: int, per_page: int = 100) -> list:
+    bodies = []
+    for p in range(pages):
+        data = [make_invoice(p * per_page + i) for i in range(per_page)]
+        bodies.append(json.dumps({"object": "list", "data": data, "has_more": p < pages - 1, "url": "/v1/invoices"}))
+    return bodies
+
+
+def sdk_path(bodies: list) -> list:
+    records = []
+    for body in bodies:
+        page = stripe.ListObject.construct_from(json.loads(body, object_pairs_hook=OrderedDict), "sk_test_bench")
+        for inv in page.data:
+            records.append(main.flatten_json(main.rename_id_field(inv.to_dict(), "invoice")))
+    return records
+
+
+def raw_path(bodies: list) -> list:
+    records = []
+    for body in bodies:
+        for inv in main.parse_json(body)["data"]:
+            records.append(main.flatten_record(inv, "invoice"))
+    return records
+
+
+def measure(fn, bodies: list, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        main.format_jst.cache_clear()
+        start = time.process_time()
+        fn(bodies)
+        timings.append(time.process_time() - start)
+
+    # 1ページ分を処理する間の一時的な割り当て（結果は破棄）のピーク
+    main.format_jst.cache_clear()
+    tracemalloc.start()
+    page_peak = 0
+    for body in bodies:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        fn([body])
+        _, peak = tracemalloc.get_traced_memory()
+        page_peak = max(page_peak, peak - base)
+    tracemalloc.stop()
+    return min(timings), page_peak
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=100, help="number of 100-record list pages")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    bodies = make_list_bodies(args.pages)
+    assert sdk_path(bodies[:2]) == raw_path(bodies[:2]), "raw path output differs from the SDK path"
+
+    print(f"pages={args.pages} records={args.pages * 100} orjson={'yes' if main.orjson else 'no'}")
+    print(f"{'':<6}{'cpu(ms)':>10}{'peak/page(KB)':>15}")
+    for name, fn in (("sdk", sdk_path), ("raw", raw_path)):
+        cpu, page_peak = measure(fn, bodies, args.repeat)
+        print(f"{name:<6}{cpu * 1000:>10.1f}{page_peak / 1024:>15.0f}")
+
+
+if __name__ == "__main__":
+    main_cli()
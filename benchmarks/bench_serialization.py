@@ -0,0 +1,116 @@
+"""
+レスポンスJSONのシリアライズ時間とメモリ使用量を比較するベンチマーク。
+
+- before: dict を返して FastAPI に任せた場合（jsonable_encoder + JSONResponse.render）
+- after : serialize_payload（orjson）で直接バイト列にする場合
+
+両者の出力は同じ内容のJSONで、このベンチマークのデータ（小数を含まない）ではバイト列も一致する。
+一致しているかどうかも合わせて表示する。
+
+実行方法（リポジトリのルートで）:
+    python benchmarks/bench_serialization.py --records 10000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+import main  # noqa: E402
+
+
+def make_invoice(i: int) -> dict:
+    """
+    Stripeのインボイスに近い形（ネストした明細・支払情報を含む）のダミーデータ。
+    """
+    created = 1_700_000_000 + i * 60
+    return {
+        "id": f"in_{i:08d}",
+        "object": "invoice",
+        "customer": f"cus_{i % 500:06d}",
+        "subscription": f"sub_{i % 800:06d}",
+        "status": "paid",
+        "amount_due": 2980,
+        "amount_paid": 2980,
+        "currency": "jpy",
+        "created": created,
+        "customer_email": f"user{i % 500}@example.com",
+        "customer_name": "山田 太郎",
+        "lines": {
+            "object": "list",
+            "data": [
+                {
+                    "id": f"il_{i:08d}_{n}",
+                    "amount": 2980,
+                    "description": "スタンダードプラン × 1",
+                    "period": {"start": created - 86400 * 30, "end": created},
+                    "price": {"id": "price_standard", "unit_amount": 2980, "recurring": {"interval": "month"}},
+                }
+                for n in range(2)
+            ],
+            "has_more": False,
+        },
+        "payment_method_details": {
+            "card": {
+                "brand": "visa",
+                "last4": "4242",
+                "checks": {"address_line1_check": None, "address_postal_code_check": "pass", "cvc_check": "pass"},
+            }
+        },
+        "metadata": {"order_id": str(i)},
+    }
+
+
+def build_payload(count: int) -> dict:
+    return {
+        "records": [main.flatten_json(main.rename_id_field(make_invoice(i), "invoice")) for i in range(count)]
+    }
+
+
+def serialize_before(payload: dict) -> bytes:
+    return JSONResponse(content=jsonable_encoder(payload)).body
+
+
+def serialize_after(payload: dict) -> bytes:
+    return main.serialize_payload(payload)
+
+
+def measure(fn, payload: dict, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn(payload)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), sum(timings) / len(timings), peak, len(body)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    payload = build_payload(args.records)
+    print(f"records={args.records} keys/record={len(payload['records'][0])} orjson={'yes' if main.orjson else 'no'}")
+    print(f"{'':<8}{'best(ms)':>10}{'mean(ms)':>10}{'peak(MB)':>10}{'bytes':>12}")
+    for name, fn in (("before", serialize_before), ("after", serialize_after)):
+        best, mean, peak, size = measure(fn, payload, args.repeat)
+        print(f"{name:<8}{best * 1000:>10.1f}{mean * 1000:>10.1f}{peak / 1024 / 1024:>10.1f}{size:>12}")
+
+    before, after = serialize_before(payload), serialize_after(payload)
+    print(f"same JSON: {json.loads(before) == json.loads(after)}, same bytes: {before == after}")
+
+
+if __name__ == "__main__":
+    main_cli()
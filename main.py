@@ -1,48 +1,212 @@
-from fastapi import FastAPI, HTTPException, Query
-from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from typing import Callable, Dict, List, Literal, Optional
+from collections import OrderedDict
+from functools import lru_cache
 import stripe
 import logging
+import os
+import json
+import hashlib
+import math
+import threading
+import time
+import re
+import zlib
+import gzip
+import base64
+import sqlite3
+import socket
+import fcntl
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from urllib.parse import urlencode
 from pydantic import BaseModel, EmailStr, ValidationError
 from mangum import Mangum  # Mangumのインポート
-from datetime import datetime, timezone, timedelta  # タイムゾーン変換用
+from datetime import timezone, timedelta  # タイムゾーン変換用
+
+try:
+    import orjson  # レスポンスJSONの高速シリアライズ（未インストール時は標準の json を使う）
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow as pa  # format=arrow / parquet でのみ使用する（未インストール時は501を返す）
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+try:
+    import brotli  # Accept-Encoding: br に対応する場合のみインストールする
+except ImportError:
+    brotli = None
 
 # ロギング設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# stripe-mock などローカルのStripe互換サーバーで動作確認する場合は STRIPE_API_BASE を指定する
+if os.environ.get("STRIPE_API_BASE"):
+    stripe.api_base = os.environ["STRIPE_API_BASE"]
+
 app = FastAPI()
 
 # JSTのタイムゾーン設定
 JST = timezone(timedelta(hours=9))
+JST_OFFSET_SECONDS = int(JST.utcoffset(None).total_seconds())
+
+# タイムスタンプの出力形式（jst: "YYYY/MM/DD HH:MM:SS", iso: ISO 8601（+09:00）, epoch: UNIX秒のまま）
+TimeFormat = Literal["jst", "iso", "epoch"]
+
+# レスポンスキャッシュ設定（秒・エントリ数）。TTLを0にするとキャッシュ無効
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "60"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+# 保持するレスポンス本文の合計バイト数の上限。これより大きい本文はキャッシュしない（0で上限なし）
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# 有効期限切れのキャッシュを返せる範囲（秒）。レスポンスキャッシュと次回インボイスのプレビューキャッシュに共通
+# stale-while-revalidate: 期限切れからこの秒数以内なら古い値を返し、裏で取り直す
+#   Lambda では応答後に実行環境が凍結され、裏での取り直しが次の呼び出しまで止まるため、既定では使わない（同期で取り直す）
+# stale-if-error: 期限切れからこの秒数以内なら、Stripe が 429 / 5xx / 接続エラーのときに古い値を返す
+CACHE_STALE_WHILE_REVALIDATE = int(
+    os.environ.get("CACHE_STALE_WHILE_REVALIDATE") or ("0" if os.environ.get("AWS_LAMBDA_FUNCTION_NAME") else "30")
+)
+CACHE_STALE_IF_ERROR = int(os.environ.get("CACHE_STALE_IF_ERROR", "600"))
+CACHE_REFRESH_WORKERS = int(os.environ.get("CACHE_REFRESH_WORKERS", "4"))
+
+# 不変なStripeオブジェクト（支払済みインボイス等）のディスクキャッシュ設定
+# Lambda上では /tmp を使い、uvicorn で動かす場合は OBJECT_STORE_DIR を指定したときだけ有効になる
+OBJECT_STORE_DIR = os.environ.get("OBJECT_STORE_DIR") or (
+    "/tmp/stripe-object-store" if os.environ.get("AWS_LAMBDA_FUNCTION_NAME") else ""
+)
+OBJECT_STORE_MAX_BYTES = int(os.environ.get("OBJECT_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+# 成功した請求は返金や不審請求の申請で変わりうるため、全額返金済みか、作成からこの日数を過ぎたものだけを確定済みとして保存する
+CHARGE_DISPUTE_WINDOW_DAYS = int(os.environ.get("CHARGE_DISPUTE_WINDOW_DAYS", "180"))
+
+# 顧客ミラー（SQLite）の設定。パス未指定なら無効
+CUSTOMER_MIRROR_PATH = os.environ.get("CUSTOMER_MIRROR_PATH", "")
+# Events API で差分を取り込む最短間隔（秒）
+CUSTOMER_MIRROR_REFRESH_INTERVAL = int(os.environ.get("CUSTOMER_MIRROR_REFRESH_INTERVAL", "30"))
+
+# 一括エクスポートジョブの保存先と、ジョブがStripeを呼び出す最大レート（呼び出し/秒）
+JOBS_DIR = os.environ.get("JOBS_DIR", "/tmp/stripe-export-jobs")
+JOB_MAX_REQUESTS_PER_SECOND = float(os.environ.get("JOB_MAX_REQUESTS_PER_SECOND", "20"))
+# 実行中のジョブが保持するリース（秒）。実行中はこの1/3ごとに延長し、切れたジョブだけを別のプロセスが再開する
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "60"))
+
+# Stripe一覧APIの1ページの件数（Stripeの上限は100）と、次ページを先読みするスレッド数
+LIST_PAGE_SIZE = 100
+LIST_PREFETCH_WORKERS = int(os.environ.get("LIST_PREFETCH_WORKERS", "8"))
+# 次回インボイスのプレビューのキャッシュ設定（秒・エントリ数）。TTLを0にするとキャッシュ無効
+UPCOMING_CACHE_TTL = int(os.environ.get("UPCOMING_CACHE_TTL", "300"))
+UPCOMING_CACHE_MAX_ENTRIES = int(os.environ.get("UPCOMING_CACHE_MAX_ENTRIES", "4096"))
+UPCOMING_CACHE_MAX_BYTES = int(os.environ.get("UPCOMING_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# 存在しないID（resource_missing）を覚えておく秒数と件数。件数を超えた分はブルームフィルタで保持する
+NEGATIVE_CACHE_TTL = int(os.environ.get("NEGATIVE_CACHE_TTL", "60"))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.environ.get("NEGATIVE_CACHE_MAX_ENTRIES", "10000"))
+NEGATIVE_CACHE_BLOOM_CAPACITY = int(os.environ.get("NEGATIVE_CACHE_BLOOM_CAPACITY", "100000"))
+NEGATIVE_CACHE_BLOOM_ERROR_RATE = 0.001
+
+# Invoice Search API の1クエリに含められる条件数（Stripeの上限）
+INVOICE_SEARCH_MAX_CLAUSES = 10
+# Search API の索引が作成・更新に追いつくまでの目安（秒）。これより新しいインボイスは検索結果に含まれないことがある
+INVOICE_SEARCH_LAG_SECONDS = 60
+# shards 指定時に created の区間ごとの一覧取得を並行して行うスレッド数（プロセス全体で共有）
+LIST_SHARD_WORKERS = int(os.environ.get("LIST_SHARD_WORKERS", "16"))
+# プランナーが使うアカウント統計の有効期間（秒）と、保持するサブスクリプション数の上限
+ACCOUNT_STATS_TTL = int(os.environ.get("ACCOUNT_STATS_TTL", "3600"))
+ACCOUNT_STATS_MAX_SUBSCRIPTIONS = int(os.environ.get("ACCOUNT_STATS_MAX_SUBSCRIPTIONS", "100000"))
+
+# レスポンス圧縮の設定。この値（バイト）未満の本文は圧縮しない。レベルは gzip / brotli 共通（1〜9）
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = min(max(int(os.environ.get("COMPRESSION_LEVEL", "6")), 1), 9)
+# Lambdaの同期呼び出しのレスポンス上限（base64化した本文とヘッダーを含む）
+LAMBDA_RESPONSE_MAX_BYTES = int(os.environ.get("LAMBDA_RESPONSE_MAX_BYTES", str(6 * 1024 * 1024)))
 
 # Pydanticで入力バリデーションのクラスを作成
 class SearchRequest(BaseModel):
     api_key: str
     email_addresses: List[EmailStr]  # EmailStrでメールアドレスの形式を検証
+    consistency: Literal["eventual", "strong"] = "eventual"  # strong の場合は顧客ミラーを使わずStripeから取得
+    time_format: TimeFormat = "jst"
 
 class SubscriptionSearchRequest(BaseModel):
     api_key: str
     cus_ids: List[str]  # 複数の顧客IDを受け取る
+    shape: Literal["rows", "normalized"] = "rows"  # normalized: エンティティごとのテーブルに分けて返す
+    format: Literal["json", "columnar", "arrow", "parquet"] = "json"
+    time_format: TimeFormat = "jst"
+    include: List[Literal["items", "upcoming", "invoices"]] = ["items", "upcoming", "invoices"]  # フルデータ検索で取得するセクション
 
 class SubscriptionItemSearchRequest(BaseModel):
     api_key: str
     subscription_ids: List[str]  # 複数のサブスクリプションIDを受け取る
+    shape: Literal["rows", "normalized"] = "rows"
+    time_format: TimeFormat = "jst"
 
 class SubscriptionDirectSearchRequest(BaseModel):
     api_key: str
     subscription_ids: List[str]  # 複数のサブスクリプションIDを受け取る
+    format: Literal["json", "columnar", "arrow", "parquet"] = "json"
+    time_format: TimeFormat = "jst"
 
 class ChargeSearchRequest(BaseModel):
     api_key: str
     subscription_ids: List[str]  # 複数のサブスクリプションIDを受け取る
+    limit: Optional[int] = None  # 指定するとページングする（1ページの最大件数）
+    starting_after: Optional[str] = None  # 前ページの next_starting_after
+    shards: int = 1  # 2以上で、長い履歴を created の区間に分けて並行取得する（limit 指定時は使わない）
+    format: Literal["json", "columnar", "arrow", "parquet"] = "json"  # columnar: {columns, rows}, arrow / parquet: バイナリ
+    time_format: TimeFormat = "jst"
 
 class InvoiceSearchRequest(BaseModel):
     api_key: str
     subscription_ids: List[str]  # 複数のサブスクリプションIDを受け取る
+    limit: Optional[int] = None
+    starting_after: Optional[str] = None
+    shards: int = 1
+    consistency: Literal["eventual", "strong"] = "eventual"  # strong の場合は検索APIとキャッシュを使わない
+    format: Literal["json", "columnar", "arrow", "parquet"] = "json"
+    time_format: TimeFormat = "jst"
 
 class ChargeInvoiceSearchRequest(BaseModel):
     api_key: str
     charge_ids: List[str]  # 複数の請求IDを受け取る
+    format: Literal["json", "columnar", "arrow", "parquet"] = "json"
+    time_format: TimeFormat = "jst"
+
+class ExportJobRequest(BaseModel):
+    api_key: str
+    kind: Literal["fulldata", "invoices"]  # fulldata: 顧客ID単位, invoices: サブスクリプションID単位
+    ids: Optional[List[str]] = None  # 省略時はアカウント全体が対象
+
+class CustomerGraphRequest(BaseModel):
+    api_key: str
+    email_addresses: List[EmailStr] = []  # メールアドレスから顧客を特定する場合
+    cus_ids: List[str] = []  # 顧客IDを直接指定する場合
+    depth: int = 5  # 1:顧客 2:サブスクリプション 3:アイテム/価格/商品 4:インボイス 5:請求
+
+class ChangeFeedRequest(BaseModel):
+    api_key: str
+    cursor: Optional[str] = None  # 前回レスポンスの cursor（イベントID）
+    limit: int = 100
+
+
+# object_type ごとの "id" のリネーム先
+ID_FIELD_NAMES = {
+    "customer": "cus_id",
+    "subscription": "sub_id",
+    "subscription_item": "si_id",
+    "invoice": "inv_id",
+    "charge": "ch_id",
+    "product": "prod_id",
+    "price": "price_id",
+    "plan": "plan_id",
+}
 
 
 def rename_id_field(obj_dict: dict, object_type: str) -> dict:
@@ -51,275 +215,3118 @@ def rename_id_field(obj_dict: dict, object_type: str) -> dict:
     object_type が 'customer' → 'cus_id', 'subscription' → 'sub_id' などのように変換。
     """
     if "id" in obj_dict:
-        new_key = ""
-        if object_type == "customer":
-            new_key = "cus_id"
-        elif object_type == "subscription":
-            new_key = "sub_id"
-        elif object_type == "subscription_item":
-            new_key = "si_id"
-        elif object_type == "invoice":
-            new_key = "inv_id"
-        elif object_type == "charge":
-            new_key = "ch_id"
-        elif object_type == "product":
-            new_key = "prod_id"
-        elif object_type == "price":
-            new_key = "price_id"
-        elif object_type == "plan":
-            new_key = "plan_id"
-        else:
-            # 該当しない場合は "_id" としておく
-            new_key = f"{object_type}_id"
+        # 該当しない場合は "_id" としておく
+        new_key = ID_FIELD_NAMES.get(object_type, f"{object_type}_id")
 
         # pop して rename
         obj_dict[new_key] = obj_dict.pop("id")
     return obj_dict
 
-def flatten_json(nested_json, parent_key='', sep='_'):
+# フラット化の際にUNIXタイムスタンプとして扱うキー
+TIMESTAMP_FIELDS = frozenset([
+    'billing_cycle_anchor', 'created', 'current_period_end',
+    'current_period_start', 'start_date', 'trial_end', 'trial_start',
+    'period_start', 'period_end'
+])
+
+
+@lru_cache(maxsize=4096)
+def is_timestamp_key(key: str) -> bool:
+    """
+    フラット化後のキーがタイムスタンプの項目かどうか。
+    ネストした位置（lines_data_0_period_start, product_created など）でも末尾の項目名で判定する。
+    """
+    return any(key == field or key.endswith("_" + field) for field in TIMESTAMP_FIELDS)
+
+
+@lru_cache(maxsize=65536)
+def format_jst(timestamp: int) -> str:
+    # JSTは夏時間のない固定オフセットなので、datetime を作らずに gmtime + オフセットで求める
+    return "%04d/%02d/%02d %02d:%02d:%02d" % time.gmtime(timestamp + JST_OFFSET_SECONDS)[:6]
+
+
+@lru_cache(maxsize=65536)
+def format_iso(timestamp: int) -> str:
+    return "%04d-%02d-%02dT%02d:%02d:%02d+09:00" % time.gmtime(timestamp + JST_OFFSET_SECONDS)[:6]
+
+
+def format_timestamp(value, time_format: str = "jst"):
+    """
+    UNIXタイムスタンプを time_format の形式にする。整数以外（None など）はそのまま返す。
+    同じ時刻（請求期間の開始・終了など）は多くのレコードで繰り返されるため、変換結果はキャッシュする。
+    """
+    if type(value) is not int or time_format == "epoch":
+        return value
+    if time_format == "iso":
+        return format_iso(value)
+    return format_jst(value)
+
+
+def flatten_json(nested_json, parent_key='', sep='_', time_format='jst'):
     """
     ネストされたJSONをフラット化する再帰的な関数
+    タイムスタンプの項目は time_format（jst / iso / epoch）に変換する。epoch は Arrow / Parquet の型付き列用
     """
-    items = []
+    flat = {}
+    _flatten_into(flat, nested_json, parent_key, sep, time_format)
+    return flat
+
+
+def _flatten_into(flat: dict, nested_json, parent_key: str, sep: str, time_format: str) -> None:
+    # 階層ごとに dict を作って結合せず、1つの dict に直接書き込む
     for k, v in nested_json.items():
         new_key = f"{parent_key}{sep}{k}" if parent_key else k
         if isinstance(v, dict):
-            items.extend(flatten_json(v, new_key, sep=sep).items())
+            _flatten_into(flat, v, new_key, sep, time_format)
         elif isinstance(v, list):
             for i, item in enumerate(v):
                 if isinstance(item, dict):
-                    items.extend(flatten_json(item, f"{new_key}_{i}", sep=sep).items())
+                    _flatten_into(flat, item, f"{new_key}_{i}", sep, time_format)
                 else:
-                    items.append((f"{new_key}_{i}", item))
+                    flat[f"{new_key}_{i}"] = item
+        else:
+            # UNIXタイムスタンプの項目をチェックして変換
+            if time_format != 'epoch' and is_timestamp_key(new_key):
+                v = format_timestamp(v, time_format)
+            flat[new_key] = v
+
+
+def flatten_record(obj: dict, object_type: str, time_format: str = "jst") -> dict:
+    """
+    flatten_json(rename_id_field(obj, object_type)) と同じ結果を、元の dict を書き換えずに1回の走査で作る。
+    （rename_id_field はリネームした ID を末尾に移すため、フラット化後に同じ位置へ移す）
+    """
+    flat = {}
+    _flatten_into(flat, obj, '', '_', time_format)
+    if "id" in flat:
+        flat[ID_FIELD_NAMES.get(object_type, f"{object_type}_id")] = flat.pop("id")
+    return flat
+
+
+def to_columnar(payload: dict) -> dict:
+    """
+    {"records": [...]} を {"columns": [...], "rows": [[...]]} に変換する（records 以外のキーはそのまま残す）。
+    フラット化したレコードは長いキー名が全件で繰り返されるため、キー名を columns に1回だけ持たせる。
+    列はレコードに初めて現れた順に並べ、そのレコードに無い列は null で埋める。
+    """
+    index = {}
+    columns = []
+    rows = []
+    for record in payload.get("records", []):
+        row = [None] * len(columns)
+        for key, value in record.items():
+            i = index.get(key)
+            if i is None:
+                index[key] = len(columns)
+                columns.append(key)
+                row.append(value)
+            else:
+                row[i] = value
+        rows.append(row)
+
+    width = len(columns)
+    for row in rows:
+        if len(row) < width:
+            row.extend([None] * (width - len(row)))
+
+    result = {"columns": columns, "rows": rows}
+    result.update((k, v) for k, v in payload.items() if k != "records")
+    return result
+
+
+def format_records(payload: dict, response_format: str) -> dict:
+    """
+    format パラメータに応じてレスポンスの形を変える（json はそのまま返す）。
+    """
+    if response_format == "columnar":
+        return to_columnar(payload)
+    return payload
+
+
+ARROW_MEDIA_TYPES = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+# 値が null だけの呼び出しでも Arrow の列型が変わらないよう、型を固定する項目（フラット化後のキーの末尾で判定する）
+ARROW_INT64_FIELDS = frozenset([
+    'amount', 'amount_captured', 'amount_due', 'amount_paid', 'amount_refunded', 'amount_remaining',
+    'application_fee_amount', 'attempt_count', 'balance', 'cancel_at', 'canceled_at', 'due_date',
+    'ended_at', 'ending_balance', 'quantity', 'starting_balance', 'subtotal', 'tax', 'total', 'unit_amount',
+])
+ARROW_BOOL_FIELDS = frozenset([
+    'active', 'attempted', 'cancel_at_period_end', 'captured', 'deleted', 'disputed', 'livemode', 'paid', 'refunded',
+])
+
+
+@lru_cache(maxsize=4096)
+def field_name_matches(key: str, fields: frozenset) -> bool:
+    return any(key == field or key.endswith("_" + field) for field in fields)
+
+
+def infer_arrow_type(column: str, values: list):
+    """
+    列の Arrow の型を決める。呼び出しごとに型が揺れないよう、判定は項目名と値の Python 型だけで行う。
+    - タイムスタンプの項目（is_timestamp_key）で値が整数の列は timestamp（JST）
+    - ARROW_INT64_FIELDS / ARROW_BOOL_FIELDS の項目は、null だけの列でも int64 / bool
+    - それ以外の bool / int / float（int と混在する場合も）/ str はそれぞれの型
+    - すべて null の列は null 型（pa.unify_schemas や concat_tables で他の呼び出しの型に昇格できる）
+    - 型が混在する列は string
+    """
+    kinds = {type(v) for v in values if v is not None}
+    if is_timestamp_key(column) and kinds <= {int}:
+        return pa.timestamp("s", tz="+09:00")
+    if field_name_matches(column, ARROW_INT64_FIELDS) and kinds <= {int}:
+        return pa.int64()
+    if field_name_matches(column, ARROW_BOOL_FIELDS) and kinds <= {bool}:
+        return pa.bool_()
+    if not kinds:
+        return pa.null()
+    if kinds == {bool}:
+        return pa.bool_()
+    if kinds == {int}:
+        return pa.int64()
+    if kinds <= {int, float}:
+        return pa.float64()
+    return pa.string()
+
+
+def records_to_arrow_table(payload: dict):
+    """
+    フラット化したレコード（タイムスタンプはUNIX秒のまま）から Arrow のテーブルを作る。
+    列は名前順に並べ、records 以外の項目（watermark など）はスキーマのメタデータに入れる。
+    """
+    records = payload.get("records", [])
+    columns = sorted({key for record in records for key in record})
+    fields = []
+    arrays = []
+    for column in columns:
+        values = [record.get(column) for record in records]
+        arrow_type = infer_arrow_type(column, values)
+        if pa.types.is_string(arrow_type):
+            values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+        fields.append(pa.field(column, arrow_type))
+        arrays.append(pa.array(values, type=arrow_type))
+
+    metadata = {k: json.dumps(v) for k, v in payload.items() if k != "records"}
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields, metadata=metadata or None))
+
+
+def serialize_arrow(payload: dict, response_format: str) -> bytes:
+    """
+    Arrow IPC（ストリーム形式）または Parquet のバイト列にする。
+    """
+    table = records_to_arrow_table(payload)
+    sink = pa.BufferOutputStream()
+    if response_format == "parquet":
+        pq.write_table(table, sink, compression="snappy")
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+# ============ レスポンスキャッシュ ============
+
+def account_key(api_key: str) -> str:
+    """
+    APIキーそのものをキャッシュキーに残さないよう、SHA-256の先頭16桁をアカウント識別子として使う。
+    """
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def normalize_ids(ids: List[str]) -> List[str]:
+    """
+    前後の空白と空要素を取り除く。順序と重複は、レスポンスの並び（重複したIDの結果は重複して返る）に影響するため維持する。
+    """
+    return [id_ for id_ in (id_.strip() for id_ in ids) if id_]
+
+
+def serialize_payload(payload) -> bytes:
+    """
+    レスポンス本文をJSONバイト列に変換する（ETag計算とキャッシュ保存に同じバイト列を使う）。
+    フラット化済みのレコードはそのままJSONにできるため、jsonable_encoder を通さず orjson で直接バイト列にする。
+    orjson が扱えない値（64bitを超える整数など）を含む場合は標準の json にフォールバックする。
+    出力は標準の json と同じ内容のJSONで、文字列・整数・真偽値・null・日時（default=str）はバイト列も同じになる。
+    指数表記の小数（json の 1e+16 が 1e16）と NaN / Infinity（json では NaN、orjson では null）だけが異なる。
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                payload, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+            )
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """
+    serialize_payload でシリアライズするJSONレスポンス。
+    FastAPI は dict を返すと jsonable_encoder で全キーを走査し直すため、エンドポイントからはこのクラスで包んで返す。
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return serialize_payload(content)
+
+
+def compute_etag(body: bytes) -> str:
+    """
+    フラット化済みペイロードのバイト列から強いETagを生成する。
+    """
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+ETAG_ENCODING_SUFFIX = re.compile(r'-(?:gzip|br)"$')
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-Match ヘッダー（カンマ区切り・W/付き・* を含む）と ETag を比較する。
+    圧縮時に付けた "-gzip" / "-br" の接尾辞は取り除いて比較する。
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        candidate = ETAG_ENCODING_SUFFIX.sub('"', candidate)
+        if candidate == etag:
+            return True
+    return False
+
+
+def is_transient_stripe_error(error: BaseException) -> bool:
+    """
+    Stripe のレート制限（429）・障害（5xx）・接続エラーかを判定する。
+    検索関数は StripeError を HTTPException に包み直すため、例外の連鎖（__cause__ / __context__）もたどる。
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, (stripe.error.RateLimitError, stripe.error.APIConnectionError)):
+            return True
+        if isinstance(error, stripe.error.StripeError):
+            status = error.http_status
+            return status is not None and (status == 429 or status >= 500)
+        error = error.__cause__ or error.__context__
+    return False
+
+
+# 期限切れキャッシュの裏での取り直し用スレッドプール（同じキーの取り直しは同時に1つだけ）
+cache_refresh_executor = ThreadPoolExecutor(max_workers=CACHE_REFRESH_WORKERS, thread_name_prefix="cache-refresh")
+cache_refresh_keys = set()
+cache_refresh_lock = threading.Lock()
+
+
+def refresh_in_background(key, refresh: Callable[[], None]) -> None:
+    """
+    stale-while-revalidate 用に refresh を別スレッドで実行する。同じキーを取り直し中なら何もしない。
+    取り直しはリクエストとは別の統計で動くため、X-Stripe-* ヘッダーの件数には含まれない
+    （取り直しの中で期限切れの部分結果を使ったかどうかは、その統計で判断する）。
+    """
+    with cache_refresh_lock:
+        if key in cache_refresh_keys:
+            return
+        cache_refresh_keys.add(key)
+
+    def run():
+        list_stats.set({"pages": 0, "objects": 0, "skipped": {}, "stale_since": None, "stale_error": False})
+        try:
+            refresh()
+        except Exception as e:
+            logger.warning(f"Background cache refresh failed for {key}: {str(e)}")
+        finally:
+            with cache_refresh_lock:
+                cache_refresh_keys.discard(key)
+
+    cache_refresh_executor.submit(run)
+
+
+class BoundedLRUCache:
+    """
+    有効期限（ttl）付きのエントリを、件数（max_entries）と合計バイト数（max_bytes、0なら上限なし）の範囲で保持するLRUキャッシュ。
+    有効期限を過ぎたエントリも stale_ttl 秒までは残し、stale-while-revalidate / stale-if-error に使う。
+    エントリの新しさは呼び出し側が expires_at / stored_at で判断する。
+    """
+
+    def __init__(self, ttl: int, max_entries: int, stale_ttl: int = 0, max_bytes: int = 0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry["size"]
+
+    def get_entry(self, key, valid: Optional[Callable[[dict], bool]] = None) -> Optional[dict]:
+        """
+        エントリを返す。stale_ttl も過ぎたもの、valid が偽を返すものは破棄して None を返す。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires_at"] + self.stale_ttl <= time.time() or (valid is not None and not valid(entry)):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry: dict, size: int) -> None:
+        """
+        entry に stored_at / expires_at / size を付けて保存し、上限を超えた分を古いものから破棄する。
+        size が max_bytes を超える場合は保存せず、同じキーの古いエントリも破棄する。
+        """
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._remove(key)
+            if self.max_bytes > 0 and size > self.max_bytes:
+                return
+            self._entries[key] = dict(entry, stored_at=now, expires_at=now + self.ttl, size=size)
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes > 0 and self.total_bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def remove_where(self, predicate: Callable[[object, dict], bool]) -> int:
+        """
+        predicate(key, entry) が真のエントリを破棄し、破棄した件数を返す。
+        """
+        with self._lock:
+            targets = [key for key, entry in self._entries.items() if predicate(key, entry)]
+            for key in targets:
+                self._remove(key)
+        return len(targets)
+
+
+class ResponseCache(BoundedLRUCache):
+    """
+    ルート + 正規化したID + APIキーのハッシュをキーに、シリアライズ済みレスポンスを短時間保持するLRUキャッシュ。
+    本文の合計バイト数を max_bytes までに抑える。
+    """
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.get_entry(key)
+
+    def set(self, key: str, body: bytes, etag: str, account: str, ids: List[str]) -> None:
+        self.put(key, {"body": body, "etag": etag, "account": account, "ids": set(ids)}, len(body))
+
+    def invalidate(self, account: str, ids: Optional[List[str]] = None) -> int:
+        """
+        指定アカウントのエントリを破棄する。ids を渡した場合はそのIDを含むエントリだけを破棄する。
+        """
+        return self.remove_where(
+            lambda key, entry: entry["account"] == account and (ids is None or bool(entry["ids"].intersection(ids)))
+        )
+
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    max(CACHE_STALE_WHILE_REVALIDATE, CACHE_STALE_IF_ERROR, 0),
+    RESPONSE_CACHE_MAX_BYTES,
+)
+
+
+def make_cache_key(route: str, api_key: str, ids: List[str], params: Optional[dict] = None) -> str:
+    parts = [route, account_key(api_key), ",".join(ids)]
+    for name in sorted(params or {}):
+        parts.append(f"{name}={params[name]}")
+    return "|".join(parts)
+
+
+def cached_json_response(
+    request: Request,
+    route: str,
+    api_key: str,
+    ids: List[str],
+    producer: Callable[[], dict],
+    params: Optional[dict] = None,
+    bypass: bool = False,
+    media_type: str = "application/json",
+    serializer: Callable[[dict], bytes] = serialize_payload,
+) -> Response:
+    """
+    レスポンスキャッシュを通してエンドポイントの結果を返す。
+    - キャッシュ有効期間内なら Stripe を呼ばずに保存済みの本文を返す（X-Cache: HIT）
+    - 期限切れから CACHE_STALE_WHILE_REVALIDATE 秒以内なら古い本文を返し、裏で取り直す（X-Cache: STALE）
+    - それより古い場合は取り直し、Stripe が 429 / 5xx / 接続エラーなら CACHE_STALE_IF_ERROR 秒以内の古い本文を返す（X-Cache: STALE-ERROR）
+    - キャッシュから返す場合は、保存からの経過秒数を Age ヘッダーで返す
+    - 取り直した結果に期限切れの部分結果（次回インボイスのプレビューなど）が含まれる場合は、
+      そのうち最も古いものの経過秒数を Age で返し（X-Cache: STALE）、レスポンスキャッシュには保存しない
+    - If-None-Match が ETag と一致すれば 304 を返す
+    - リクエストの Cache-Control: no-cache / no-store（または bypass=True）はキャッシュを読まずに再取得する
+    """
+    request_cache_control = request.headers.get("cache-control", "").lower()
+    bypass = bypass or "no-cache" in request_cache_control or "no-store" in request_cache_control
+    key = make_cache_key(route, api_key, ids, params)
+    account = account_key(api_key)
+
+    def produce():
+        body = serializer(producer())
+        etag = compute_etag(body)
+        # 期限切れの部分結果を含む本文は、新しい結果としてキャッシュしない
+        if "no-store" not in request_cache_control and stale_data_since() is None:
+            response_cache.set(key, body, etag, account, ids)
+        return body, etag
+
+    now = time.time()
+    entry = None if bypass else response_cache.get(key)
+    stale_entry = None
+    cache_status = "HIT"
+    stale_since = None
+    if entry is not None and entry["expires_at"] <= now:
+        if now - entry["expires_at"] < CACHE_STALE_WHILE_REVALIDATE:
+            cache_status = "STALE"
+            refresh_in_background(key, produce)
+        else:
+            stale_entry, entry = entry, None
+    if entry is None:
+        cache_status = "MISS"
+        try:
+            body, etag = produce()
+            stale_since = stale_data_since()
+            if stale_since is not None:
+                cache_status = "STALE-ERROR" if stale_data_after_error() else "STALE"
+        except Exception as e:
+            stale_for = now - stale_entry["expires_at"] if stale_entry is not None else None
+            if stale_for is None or stale_for >= CACHE_STALE_IF_ERROR or not is_transient_stripe_error(e):
+                raise
+            logger.warning(f"Serving stale response for {route} ({int(stale_for)}s past expiry): {str(e)}")
+            entry = stale_entry
+            cache_status = "STALE-ERROR"
+    if entry is not None:
+        body = entry["body"]
+        etag = entry["etag"]
+
+    cache_control = f"private, max-age={max(RESPONSE_CACHE_TTL, 0)}"
+    if RESPONSE_CACHE_TTL > 0:
+        cache_control += (
+            f", stale-while-revalidate={max(CACHE_STALE_WHILE_REVALIDATE, 0)}"
+            f", stale-if-error={max(CACHE_STALE_IF_ERROR, 0)}"
+        )
+    headers = {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "X-Cache": cache_status,
+    }
+    if entry is not None:
+        stale_since = entry["stored_at"]
+    if stale_since is not None:
+        headers["Age"] = str(max(int(now - stale_since), 0))
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def records_response(
+    request: Request,
+    route: str,
+    api_key: str,
+    ids: List[str],
+    producer: Callable[[str], dict],
+    response_format: str,
+    params: Optional[dict] = None,
+    time_format: str = "jst",
+    bypass: bool = False,
+) -> Response:
+    """
+    format パラメータに応じて records 形式の結果を返す。producer はタイムスタンプの形式を受け取る。
+    - json / columnar: JSON（タイムスタンプは time_format の形式）
+    - arrow / parquet: バイナリ（タイムスタンプは型付きの列。pyarrow が必要）
+    """
+    if response_format in ARROW_MEDIA_TYPES:
+        # タイムスタンプは型付きの列になり time_format に依らないため、キャッシュキーに含めない
+        params = dict(params or {}, format=response_format)
+        if pa is None:
+            raise HTTPException(
+                status_code=501,
+                detail=f"format={response_format} is not available on this server (pyarrow is not installed)",
+            )
+        return cached_json_response(
+            request, route, api_key, ids,
+            lambda: producer("epoch"),
+            params=params,
+            bypass=bypass,
+            media_type=ARROW_MEDIA_TYPES[response_format],
+            serializer=lambda payload: serialize_arrow(payload, response_format),
+        )
+    return cached_json_response(
+        request, route, api_key, ids,
+        lambda: format_records(producer(time_format), response_format),
+        params=dict(params or {}, format=response_format, time_format=time_format),
+        bypass=bypass,
+    )
+
+
+# ============ 存在しないIDのネガティブキャッシュ ============
+
+class BloomFilter:
+    """
+    想定件数（capacity）に対して偽陽性率が error_rate 程度になるようにビット数・ハッシュ数を決めるブルームフィルタ。
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def is_full(self) -> bool:
+        # capacity を超えて入れると偽陽性率が error_rate から急に悪化する
+        return self.count >= self.capacity
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class NegativeCache:
+    """
+    Stripe が resource_missing を返した (アカウント, オブジェクト種別, ID) を ttl 秒のあいだ覚えておき、
+    同じIDへの問い合わせを Stripe に送らずに同じエラーで返す。
+    max_entries を超えた分は ttl ごと（または bloom_capacity 件ごと）に作り直すブルームフィルタに移し、
+    件数が多くてもメモリを一定に保つ（ブルームフィルタに移ったIDは偽陽性率 NEGATIVE_CACHE_BLOOM_ERROR_RATE で誤判定されうる）。
+    フィルタは最大 MAX_BLOOMS 個までで、それを超えると古いフィルタのIDは ttl より早く忘れる。
+    """
+
+    MAX_BLOOMS = 3
+
+    def __init__(self, ttl: int, max_entries: int, bloom_capacity: int, bloom_error_rate: float):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self._entries = OrderedDict()
+        # (作成時刻, BloomFilter) を古い順に保持する。各フィルタは作成から 2*ttl 後に捨てる
+        self._blooms = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(account: str, object_type: str, object_id: str) -> str:
+        return f"{account}:{object_type}:{object_id}"
+
+    def _expire_blooms(self, now: float) -> None:
+        self._blooms = [(created_at, bloom) for created_at, bloom in self._blooms if now - created_at < 2 * self.ttl]
+
+    def get(self, account: str, object_type: str, object_id: str) -> Optional[str]:
+        """
+        覚えているIDならエラーメッセージを、そうでなければ None を返す。
+        """
+        if self.ttl <= 0:
+            return None
+        key = self._key(account, object_type, object_id)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                message, expires_at = entry
+                if expires_at > now:
+                    return message
+                del self._entries[key]
+            self._expire_blooms(now)
+            if any(key in bloom for _, bloom in self._blooms):
+                return f"No such {object_type}: '{object_id}'"
+        return None
+
+    def add(self, account: str, object_type: str, object_id: str, message: str) -> None:
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._entries[self._key(account, object_type, object_id)] = (message, now + self.ttl)
+            while len(self._entries) > self.max_entries:
+                key, (_, expires_at) = self._entries.popitem(last=False)
+                if expires_at > now:
+                    self._add_to_bloom(key, now)
+
+    def _add_to_bloom(self, key: str, now: float) -> None:
+        # 最新のフィルタが ttl より古いか capacity に達していれば新しく作る
+        # （入れたIDは、フィルタが MAX_BLOOMS 個を超えて押し出されない限り少なくとも ttl のあいだ残る）
+        self._expire_blooms(now)
+        if not self._blooms or now - self._blooms[-1][0] >= self.ttl or self._blooms[-1][1].is_full():
+            self._blooms.append((now, BloomFilter(self.bloom_capacity, self.bloom_error_rate)))
+            del self._blooms[:-self.MAX_BLOOMS]
+        self._blooms[-1][1].add(key)
+
+    def discard(self, account: str, object_type: str, object_id: str) -> None:
+        # ブルームフィルタからは消せないため、正確に覚えているIDだけが対象
+        with self._lock:
+            self._entries.pop(self._key(account, object_type, object_id), None)
+
+
+negative_cache = NegativeCache(
+    NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_MAX_ENTRIES, NEGATIVE_CACHE_BLOOM_CAPACITY, NEGATIVE_CACHE_BLOOM_ERROR_RATE
+)
+
+# 一覧APIのフィルタのうち、存在しないIDを指定すると resource_missing になるもの
+# （invoice は InvoicePayment.list の絞り込み。Charge.list には invoice の絞り込みが無い）
+NEGATIVE_CACHE_LIST_FILTERS = ("customer", "subscription", "invoice")
+
+
+def is_resource_missing(error: Exception, object_id: Optional[str] = None) -> bool:
+    """
+    Stripe の resource_missing エラーか（object_id を渡した場合は、そのIDについてのエラーか）を判定する。
+    """
+    if getattr(error, "code", None) != "resource_missing":
+        return False
+    return object_id is None or f"'{object_id}'" in str(error)
+
+
+def add_missing_ids(payload: dict, missing_ids: Optional[List[str]]) -> dict:
+    # partial=true（missing_ids がリスト）のときだけ、存在しなかったIDを結果に含める
+    if missing_ids is not None:
+        payload["missing_ids"] = missing_ids
+    return payload
+
+
+def missing_resource_error(message: str, param: str) -> stripe.error.InvalidRequestError:
+    # Stripe から返るものと同じ種類のエラーを作る（呼び出し側のエラー処理をそのまま通す）
+    return stripe.error.InvalidRequestError(message, param, code="resource_missing", http_status=404)
+
+
+# ============ Stripeオブジェクト取得の単一化（single-flight） ============
+
+class SingleFlight:
+    """
+    同じキーに対する同時実行中の呼び出しを1回にまとめ、結果（または例外）を待機中の呼び出し元に配る。
+    uvicorn のスレッドプールで並行に処理されるリクエストが同じ顧客・サブスクリプションを
+    取得しようとした場合でも、Stripe へのリクエストは1回になる。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn: Callable):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["event"].set()
+        return call["result"]
+
+
+stripe_single_flight = SingleFlight()
+
+
+def retrieve_object(api_key: str, resource, object_id: str, expand: Optional[List[str]] = None):
+    """
+    resource.retrieve を (アカウント, オブジェクト種別, ID, expand) 単位で single-flight 化して呼び出す。
+    返却される StripeObject は並行するリクエスト間で共有されるため、呼び出し側では変更せず to_dict() してから加工すること。
+    """
+    account = account_key(api_key)
+    # 直前に resource_missing だったIDは Stripe に問い合わせずに同じエラーにする
+    message = negative_cache.get(account, resource.OBJECT_NAME, object_id)
+    if message is not None:
+        record_skipped_call(f"{resource.OBJECT_NAME}_retrieve", "missing")
+        raise missing_resource_error(message, "id")
+
+    key = (account, resource.OBJECT_NAME, object_id, tuple(expand or ()))
+    params = {"api_key": api_key}
+    if expand:
+        params["expand"] = list(expand)
+
+    def retrieve():
+        throttle_stripe_call()
+        return resource.retrieve(object_id, **params)
+
+    try:
+        return stripe_single_flight.do(key, retrieve)
+    except stripe.error.InvalidRequestError as e:
+        if is_resource_missing(e):
+            negative_cache.add(account, resource.OBJECT_NAME, object_id, e.user_message or str(e))
+        raise
+
+
+# ============ Stripe一覧APIの生JSON取得 ============
+
+# SDK の StripeObject を経由せずに一覧APIを呼ぶための HTTP クライアント（初回使用時に作成）
+raw_http_client = None
+raw_http_client_lock = threading.Lock()
+
+
+def get_raw_http_client():
+    global raw_http_client
+    with raw_http_client_lock:
+        if raw_http_client is None:
+            raw_http_client = stripe.new_default_http_client(proxy=stripe.proxy)
+        return raw_http_client
+
+
+def raw_request_headers(api_key: str) -> dict:
+    """
+    SDK を通さない一覧リクエストのヘッダー（User-Agent は SDK と同じ形式にする）。
+    """
+    user_agent = f"Stripe/v1 PythonBindings/{stripe.VERSION}"
+    if stripe.app_info:
+        app_info = stripe.app_info
+        user_agent += " " + app_info["name"] + (f"/{app_info['version']}" if app_info.get("version") else "")
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Stripe-Version": stripe.api_version,
+        "User-Agent": user_agent,
+        "X-Stripe-Client-User-Agent": json.dumps(
+            {"bindings_version": stripe.VERSION, "lang": "python", "httplib": get_raw_http_client().name}
+        ),
+    }
+
+
+def raw_stripe_error(body, status: int, headers) -> stripe.error.StripeError:
+    """
+    エラー応答の本文から、SDK が送出するのと同じ種類の StripeError（RateLimitError, InvalidRequestError など）を作る。
+    """
+    http_body = body.decode("utf-8", errors="replace") if isinstance(body, bytes) else body
+    try:
+        json_body = parse_json(body)
+        error = json_body["error"]
+        message = error.get("message")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return stripe.error.APIError(
+            f"Invalid response body from API: {http_body} (HTTP response code was {status})",
+            http_body, status, None, headers,
+        )
+    # 古いAPIバージョンではレート制限が 400 の rate_limit で返る
+    if status == 429 or (status == 400 and error.get("code") == "rate_limit"):
+        return stripe.error.RateLimitError(message, http_body, status, json_body, headers)
+    if status in (400, 404):
+        if error.get("type") == "idempotency_error":
+            return stripe.error.IdempotencyError(message, http_body, status, json_body, headers)
+        return stripe.error.InvalidRequestError(
+            message, error.get("param"), error.get("code"), http_body, status, json_body, headers
+        )
+    if status == 401:
+        return stripe.error.AuthenticationError(message, http_body, status, json_body, headers)
+    if status == 402:
+        return stripe.error.CardError(
+            message, error.get("param"), error.get("code"), http_body, status, json_body, headers
+        )
+    if status == 403:
+        return stripe.error.PermissionError(message, http_body, status, json_body, headers)
+    return stripe.error.APIError(message, http_body, status, json_body, headers)
+
+
+def encode_stripe_params(params: dict, prefix: Optional[str] = None) -> List[tuple]:
+    """
+    Stripe APIのクエリ形式（created[gt]=..., expand[]=...）に変換する。
+    """
+    pairs = []
+    for key, value in params.items():
+        name = f"{prefix}[{key}]" if prefix else key
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            pairs.extend(encode_stripe_params(value, name))
+        elif isinstance(value, (list, tuple)):
+            pairs.extend((f"{name}[]", v) for v in value)
+        elif isinstance(value, bool):
+            pairs.append((name, "true" if value else "false"))
+        else:
+            pairs.append((name, str(value)))
+    return pairs
+
+
+def parse_json(body):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+# リクエストごとの一覧API取得数と省略した呼び出し（ミドルウェアが設定し、レスポンスヘッダーに載せる）
+list_stats: ContextVar[Optional[dict]] = ContextVar("list_stats", default=None)
+list_stats_lock = threading.Lock()
+
+# Stripe呼び出しごとに待機させるレート制限（エクスポートジョブが設定する。先読み・区間取得のスレッドにも引き継がれる）
+stripe_call_governor: ContextVar[Optional["RateGovernor"]] = ContextVar("stripe_call_governor", default=None)
+
+# 次ページの先読み用スレッドプール（先読みは list_page だけを実行し、他の先読みを待たない）
+list_prefetch_executor = ThreadPoolExecutor(
+    max_workers=LIST_PREFETCH_WORKERS, thread_name_prefix="stripe-list-prefetch"
+)
+# 区間ごとの一覧取得用。区間の取得は先読みを待つため、先読みとは別のプールで動かす
+list_shard_executor = ThreadPoolExecutor(
+    max_workers=LIST_SHARD_WORKERS, thread_name_prefix="stripe-list-shard"
+)
+
+
+def throttle_stripe_call() -> None:
+    governor = stripe_call_governor.get()
+    if governor is not None:
+        governor.acquire()
+
+
+def record_list_page(object_count: int) -> None:
+    stats = list_stats.get()
+    if stats is None:
+        return
+    with list_stats_lock:
+        stats["pages"] += 1
+        stats["objects"] += object_count
+
+
+def record_skipped_call(call: str, reason: str) -> None:
+    """
+    結果が分かっている・要求されていないために省いたStripe呼び出しを記録する（例: upcoming_invoice, canceled）。
+    """
+    stats = list_stats.get()
+    if stats is None:
+        return
+    key = f"{call}:{reason}"
+    with list_stats_lock:
+        stats["skipped"][key] = stats["skipped"].get(key, 0) + 1
+
+
+def record_stale_data(stored_at: float, after_error: bool = False) -> None:
+    """
+    期限切れのキャッシュ（stale-while-revalidate / stale-if-error）から返した部分結果の保存時刻を記録する。
+    リクエスト内で最も古いものを Age ヘッダーにし、その結果から作ったレスポンスはキャッシュしない。
+    after_error=True は Stripe のエラーのために古い結果を使った（stale-if-error）ことを表す（X-Cache: STALE-ERROR）。
+    """
+    stats = list_stats.get()
+    if stats is None:
+        return
+    with list_stats_lock:
+        if stats.get("stale_since") is None or stored_at < stats["stale_since"]:
+            stats["stale_since"] = stored_at
+        stats["stale_error"] = stats.get("stale_error") or after_error
+
+
+def stale_data_since() -> Optional[float]:
+    stats = list_stats.get()
+    return stats.get("stale_since") if stats is not None else None
+
+
+def stale_data_after_error() -> bool:
+    stats = list_stats.get()
+    return bool(stats.get("stale_error")) if stats is not None else False
+
+
+def list_page(api_key: str, resource, params: dict, method: str = "list") -> dict:
+    """
+    Stripe の一覧API（method="search" なら検索API）を1ページ取得し、{"data": [...], "has_more": ...} を素の dict で返す。
+    SDK は応答を StripeObject に組み立ててから to_dict() でコピーし直すため、
+    件数の多い一覧ではレスポンス本文を直接 JSON としてパースする。
+    エラー応答の場合は本文から SDK と同じ StripeError（RateLimitError など）を作って送出する
+    （429 / 5xx の再試行は SDK の HTTP クライアントが stripe.max_network_retries まで行う）。
+    """
+    account = account_key(api_key)
+    for field in NEGATIVE_CACHE_LIST_FILTERS:
+        value = params.get(field)
+        message = negative_cache.get(account, field, value) if isinstance(value, str) else None
+        if message is not None:
+            record_skipped_call(f"{resource.OBJECT_NAME}_list", "missing")
+            raise missing_resource_error(message, field)
+
+    query = urlencode(encode_stripe_params(params))
+    path = resource.class_url() + ("/search" if method == "search" else "")
+    url = f"{stripe.api_base}{path}" + (f"?{query}" if query else "")
+    throttle_stripe_call()
+    body, status, response_headers = get_raw_http_client().request_with_retries(
+        "get", url, raw_request_headers(api_key), max_network_retries=stripe.max_network_retries
+    )
+    if status != 200:
+        error = raw_stripe_error(body, status, response_headers)
+        field = getattr(error, "param", None)
+        if is_resource_missing(error) and field in NEGATIVE_CACHE_LIST_FILTERS and isinstance(params.get(field), str):
+            negative_cache.add(account, field, params[field], error.user_message or str(error))
+        raise error
+    page = parse_json(body)
+    record_list_page(len(page.get("data", [])))
+    return page
+
+
+def iter_list(api_key: str, resource, params: dict, method: str = "list"):
+    """
+    一覧APIの全ページを starting_after で辿り、オブジェクトを dict で順に返す。
+    method="search" の場合は検索APIの全ページを next_page で辿る。
+    limit を省略した場合は LIST_PAGE_SIZE 件ずつ取得する。
+    呼び出し側が N ページ目を処理している間に N+1 ページ目を別スレッドで取得しておき、
+    フラット化などの処理とStripeへの往復を重ねる。
+    """
+    params = dict(params)
+    params.setdefault("limit", LIST_PAGE_SIZE)
+    page = list_page(api_key, resource, params, method)
+    while True:
+        data = page.get("data", [])
+        following = None
+        if page.get("has_more") and data:
+            if method == "search":
+                params = dict(params, page=page["next_page"])
+            else:
+                params = dict(params, starting_after=data[-1]["id"])
+            # 取得数を同じリクエストに記録できるよう、コンテキストごと先読みスレッドに渡す
+            following = list_prefetch_executor.submit(
+                copy_context().run, list_page, api_key, resource, params, method
+            )
+        try:
+            yield from data
+        except GeneratorExit:
+            # 途中で打ち切られた場合、まだ始まっていない先読みは取り消す
+            if following is not None:
+                following.cancel()
+            raise
+        if following is None:
+            return
+        page = following.result()
+
+
+def run_sharded(func: Callable, args_list: List[tuple]) -> List[list]:
+    """
+    func(*args) を区間ごとに並行して実行し、結果を args_list と同じ順に返す。
+    """
+    futures = [list_shard_executor.submit(copy_context().run, func, *args) for args in args_list]
+    try:
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def list_sharded(api_key: str, resource, params: dict, lower_bound: Callable[[], int], shards: int) -> List[dict]:
+    """
+    一覧APIを created の区間に分けて並行に取得し、通常の一覧と同じ新しい順の dict リストで返す。
+    1ページ目は通常どおり取得し、続きがある場合だけ、その最後のオブジェクトの created から
+    lower_bound()（サブスクリプションの作成日時など）までを shards 個の区間に等分する。
+    区間は created[gte] / created[lt] で重ならないように区切り、最も新しい区間は1ページ目のカーソルから、
+    最も古い区間は下限なしで読むため、重複も取りこぼしもない。
+    """
+    params = dict(params)
+    params.setdefault("limit", LIST_PAGE_SIZE)
+    first = list_page(api_key, resource, params)
+    data = first.get("data", [])
+    if not first.get("has_more") or not data:
+        return data
+
+    base_created = dict(params.get("created") or {})
+    upper = data[-1]["created"]
+    lower = lower_bound()
+    if "gt" in base_created:
+        lower = max(lower, base_created["gt"] + 1)
+    if "gte" in base_created:
+        lower = max(lower, base_created["gte"])
+    span = upper - lower
+    following = dict(params, starting_after=data[-1]["id"])
+    if shards <= 1 or span < shards:
+        return data + list(iter_list(api_key, resource, following))
+
+    # 新しい順の区切り（upper > bounds[0] > bounds[1] > ... > lower）
+    bounds = [upper - span * k // shards for k in range(1, shards)]
+    windows = [dict(following, created=dict(base_created, gte=bounds[0]))]
+    for newer, older in zip(bounds, bounds[1:]):
+        windows.append(dict(params, created=dict(base_created, gte=older, lt=newer)))
+    windows.append(dict(params, created=dict(base_created, lt=bounds[-1])))
+
+    pages = run_sharded(lambda window: list(iter_list(api_key, resource, window)), [(w,) for w in windows])
+    for page in pages:
+        data.extend(page)
+    return data
+
+
+# ============ 不変オブジェクトのディスクキャッシュ ============
+
+class ObjectStore:
+    """
+    一度確定したら変化しないStripeオブジェクトを、アカウントごとのディレクトリに
+    zlib圧縮したJSONとして保存するディスクキャッシュ。
+    合計サイズが max_bytes を超えたら、最終アクセス（mtime）が古いファイルから削除する。
+    """
+
+    _SAFE_KEY = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.root)
+
+    def _path(self, account: str, key: str) -> str:
+        if not self._SAFE_KEY.match(key):
+            key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, account, key + ".json.z")
+
+    def _scan_size(self) -> int:
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+
+    def get(self, account: str, key: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        path = self._path(account, key)
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(zlib.decompress(f.read()))
+            os.utime(path)  # LRU判定のためアクセス時刻を更新
+            return data
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning(f"Discarding unreadable object store entry {path}: {str(e)}")
+            self.delete(account, key)
+            return None
+
+    def put(self, account: str, key: str, obj: dict) -> None:
+        if not self.enabled:
+            return
+        path = self._path(account, key)
+        data = zlib.compress(json.dumps(obj, separators=(",", ":"), default=str).encode("utf-8"))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            with self._lock:
+                if self._total_bytes is None:
+                    self._total_bytes = self._scan_size()
+                try:
+                    self._total_bytes -= os.path.getsize(path)
+                except OSError:
+                    pass
+                os.replace(tmp_path, path)
+                self._total_bytes += len(data)
+                if self._total_bytes > self.max_bytes:
+                    self._evict()
+        except OSError as e:
+            logger.warning(f"Failed to write object store entry {path}: {str(e)}")
+
+    def delete(self, account: str, key: str) -> None:
+        if not self.enabled:
+            return
+        path = self._path(account, key)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                if self._total_bytes is not None:
+                    self._total_bytes -= size
+            except OSError:
+                pass
+
+    def _evict(self) -> None:
+        """
+        上限の9割まで、mtimeが古い順に削除する（ロック取得済みの状態で呼ぶこと）。
+        """
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        target = int(self.max_bytes * 0.9)
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._total_bytes = total
+
+
+object_store = ObjectStore(OBJECT_STORE_DIR, OBJECT_STORE_MAX_BYTES)
+
+
+def is_immutable_invoice(invoice: dict) -> bool:
+    # 支払済み・無効化済みのインボイスは以後変更されない
+    return invoice.get("status") in ("paid", "void")
+
+
+def invoice_subscription_id(invoice: dict) -> Optional[str]:
+    """
+    インボイスが属するサブスクリプションのID。
+    新しいAPIバージョンでは subscription が parent.subscription_details.subscription に移っているため、そちらを先に見る。
+    """
+    details = (invoice.get("parent") or {}).get("subscription_details") or {}
+    subscription = details.get("subscription") or invoice.get("subscription")
+    return subscription.get("id") if isinstance(subscription, dict) else subscription
+
+
+def invoice_line_price_id(line: dict) -> Optional[str]:
+    """
+    インボイス明細の価格ID。
+    新しいAPIバージョンでは price が pricing.price_details.price に移っているため、そちらを先に見る。
+    """
+    details = (line.get("pricing") or {}).get("price_details") or {}
+    price = details.get("price") or line.get("price")
+    return price.get("id") if isinstance(price, dict) else price
+
+
+def charge_invoice(api_key: str, charge: dict) -> Optional[dict]:
+    """
+    請求を支払ったインボイスを dict で返す（インボイスの無い請求は None）。
+    新しいAPIバージョン（basil 以降）では請求に invoice が無いため、請求の PaymentIntent の
+    インボイス支払い（InvoicePayment.list、インボイスは展開して取得）から求める。古いAPIバージョンでは請求の invoice を使う。
+    """
+    if "invoice" in charge:
+        invoice = charge["invoice"]
+        if isinstance(invoice, str):
+            invoice = retrieve_object(api_key, stripe.Invoice, invoice).to_dict()
+        return invoice or None
+    payment_intent = charge.get("payment_intent")
+    if isinstance(payment_intent, dict):
+        payment_intent = payment_intent.get("id")
+    if not payment_intent:
+        return None
+    page = list_page(api_key, stripe.InvoicePayment, {
+        "payment": {"type": "payment_intent", "payment_intent": payment_intent},
+        "expand": ["data.invoice"],
+        "limit": 10,
+    })
+    # 支払いをやり直したインボイスでは取り消された支払いも並ぶため、支払済みのものを優先する
+    for payment in sorted(page.get("data", []), key=lambda payment: payment.get("status") != "paid"):
+        invoice = payment.get("invoice")
+        if isinstance(invoice, str):
+            invoice = retrieve_object(api_key, stripe.Invoice, invoice).to_dict()
+        if invoice:
+            return invoice
+    return None
+
+
+def is_immutable_charge(charge: dict, now: Optional[float] = None) -> bool:
+    """
+    失敗した請求と、支払済みで全額返金済みか不審請求の申請期間（CHARGE_DISPUTE_WINDOW_DAYS）を過ぎた請求を確定済みとして扱う。
+    申請中の請求は決着まで変わるため対象外。
+    """
+    if charge.get("status") == "failed":
+        return True
+    if charge.get("paid") is not True or charge.get("status") != "succeeded" or charge.get("disputed"):
+        return False
+    if charge.get("refunded") is True:
+        return True
+    now = time.time() if now is None else now
+    return now - charge["created"] >= CHARGE_DISPUTE_WINDOW_DAYS * 86400
+
+
+def fetch_subscription_invoices(api_key: str, subscription_id: str, params: dict, shards: int = 1) -> List[dict]:
+    """
+    サブスクリプションのインボイス一覧を取得する。shards が2以上なら created の区間ごとに並行して取得する
+    （インボイスはサブスクリプション作成後に発行されるため、その作成日時を区間の下限の目安にする）。
+    """
+    if shards <= 1:
+        return list(iter_list(api_key, stripe.Invoice, params))
+    return list_sharded(
+        api_key, stripe.Invoice, params,
+        lambda: retrieve_object(api_key, stripe.Subscription, subscription_id)["created"],
+        shards,
+    )
+
+
+def list_subscription_invoices(
+    api_key: str, subscription_id: str, since: Optional[int] = None, shards: int = 1
+) -> List[dict]:
+    """
+    サブスクリプションのインボイスを新しい順の dict リストで返す。
+    since（UNIXタイムスタンプ）を指定した場合は、それより後に作成されたインボイスだけを返す。
+    オブジェクトストアが有効な場合は、確定済みの古いインボイスをディスクから読み、
+    Stripe には保存済みの最新インボイスと同時刻以降のもの（created[gte]）だけを問い合わせ、保存済みのIDは除く
+    （同じ秒に作成されたインボイスを取りこぼさないため）。
+    """
+    account = account_key(api_key)
+    index_key = f"idx_invoices_{subscription_id}"
+    index = object_store.get(account, index_key) if object_store.enabled else None
+    params = {"subscription": subscription_id}
+    if since is not None and (index is None or since >= index["watermark"]):
+        # ディスク上の履歴が役に立たない範囲なので、差分だけをStripeに問い合わせる
+        params["created"] = {"gt": since}
+        return fetch_subscription_invoices(api_key, subscription_id, params, shards)
+    if not object_store.enabled:
+        return fetch_subscription_invoices(api_key, subscription_id, params, shards)
+
+    settled = []
+    if index:
+        settled = [object_store.get(account, inv_id) for inv_id in index["ids"]]
+        if any(inv is None for inv in settled):
+            # 一部が削除されていたら全件取り直す
+            settled = []
         else:
-            # UNIXタイムスタンプをJSTに変換する特定のキーをチェック
-            if new_key in [
-                'billing_cycle_anchor', 'created', 'current_period_end',
-                'current_period_start', 'start_date', 'trial_end', 'trial_start'
-            ]:
-                # UNIXタイムスタンプをJSTに変換
-                v = datetime.fromtimestamp(v, tz=timezone.utc).astimezone(JST).strftime('%Y/%m/%d %H:%M:%S')
-            items.append((new_key, v))
-    return dict(items)
+            params["created"] = {"gte": index["watermark"]}
+
+    fresh = fetch_subscription_invoices(api_key, subscription_id, params, shards)
+    stored_ids = {inv["id"] for inv in settled}
+    invoices = [inv for inv in fresh if inv["id"] not in stored_ids] + settled
+
+    # 未確定インボイスのうち最も古いものより前に作成されたインボイスだけを「確定済み」として保存する
+    mutable_created = [inv["created"] for inv in invoices if not is_immutable_invoice(inv)]
+    cutoff = min(mutable_created) if mutable_created else None
+    new_settled = [inv for inv in invoices if cutoff is None or inv["created"] < cutoff]
+    for inv in new_settled:
+        if inv["id"] not in stored_ids:
+            object_store.put(account, inv["id"], inv)
+    if new_settled:
+        object_store.put(account, index_key, {
+            "watermark": new_settled[0]["created"],
+            "ids": [inv["id"] for inv in new_settled],
+        })
+    elif index:
+        object_store.delete(account, index_key)
+    if since is not None:
+        invoices = [inv for inv in invoices if inv["created"] > since]
+    return invoices
+
+
+def search_query_value(value: str) -> str:
+    # 検索クエリの文字列値。' と \ はバックスラッシュでエスケープする
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def search_subscription_invoices(api_key: str, subscription_ids: List[str]) -> Dict[str, List[dict]]:
+    """
+    複数サブスクリプションのインボイスを Invoice Search API の OR クエリでまとめて取得し、
+    サブスクリプションIDごとに新しい順の dict リストに振り分けて返す。
+    1クエリの条件数は Stripe の上限（INVOICE_SEARCH_MAX_CLAUSES）ごとに区切る。
+    検索APIは反映が最大1分程度遅れるため、作成直後のインボイスが含まれないことがある。
+    """
+    results = {subscription_id: [] for subscription_id in subscription_ids}
+    for i in range(0, len(subscription_ids), INVOICE_SEARCH_MAX_CLAUSES):
+        group = subscription_ids[i:i + INVOICE_SEARCH_MAX_CLAUSES]
+        query = " OR ".join(f"subscription:{search_query_value(subscription_id)}" for subscription_id in group)
+        for inv in iter_list(api_key, stripe.Invoice, {"query": query}, method="search"):
+            bucket = results.get(invoice_subscription_id(inv))
+            if bucket is not None:
+                bucket.append(inv)
+    for invoices in results.values():
+        # 検索結果の並び順は保証されないため、一覧APIと同じ新しい順に揃える
+        invoices.sort(key=lambda inv: inv["created"], reverse=True)
+    return results
+
+
+def list_customer_invoices(
+    api_key: str, customer_ids: List[str], subscription_ids: List[str], since: Optional[int] = None
+) -> Dict[str, List[dict]]:
+    """
+    顧客ごとの Invoice.list でインボイスを取得し、指定したサブスクリプションIDごとに新しい順で振り分ける。
+    同じ顧客の多数のサブスクリプションを1本の一覧で読むために使う。
+    """
+    results = {subscription_id: [] for subscription_id in subscription_ids}
+    for customer_id in customer_ids:
+        params = {"customer": customer_id}
+        if since is not None:
+            params["created"] = {"gt": since}
+        for inv in iter_list(api_key, stripe.Invoice, params):
+            bucket = results.get(invoice_subscription_id(inv))
+            if bucket is not None:
+                bucket.append(inv)
+    return results
+
+
+def fetch_invoice_charges(api_key: str, invoice: dict) -> List[dict]:
+    """
+    インボイスを支払った PaymentIntent ごとに Charge.list(payment_intent=...) で請求を取得し、新しい順に返す
+    （Charge.list には invoice で絞り込むパラメータが無い）。
+    PaymentIntent は、古いAPIバージョンではインボイスの payment_intent から、
+    新しいAPIバージョン（basil 以降）では InvoicePayment.list(invoice=...) の各支払いから求める。
+    """
+    if "payment_intent" in invoice:
+        payment_intents = [invoice["payment_intent"]]
+        if not invoice["payment_intent"] and isinstance(invoice.get("charge"), str):
+            # PaymentIntent 導入前の請求で支払われたインボイス
+            return [retrieve_object(api_key, stripe.Charge, invoice["charge"]).to_dict()]
+    else:
+        payment_intents = [
+            (payment.get("payment") or {}).get("payment_intent")
+            for payment in iter_list(api_key, stripe.InvoicePayment, {"invoice": invoice["id"]})
+        ]
+    payment_intent_ids = dict.fromkeys(
+        payment_intent.get("id") if isinstance(payment_intent, dict) else payment_intent
+        for payment_intent in payment_intents
+        if payment_intent
+    )
+    charges = {}
+    for payment_intent_id in payment_intent_ids:
+        for ch in iter_list(api_key, stripe.Charge, {"payment_intent": payment_intent_id}):
+            charges[ch["id"]] = ch
+    return sorted(charges.values(), key=lambda ch: (ch["created"], ch["id"]), reverse=True)
+
+
+def list_invoice_charges(api_key: str, invoice: dict) -> List[dict]:
+    """
+    インボイスに紐づく請求を dict リストで返す（fetch_invoice_charges）。
+    インボイスとその請求がすべて確定済みであれば、2回目以降はディスクから返す。
+    新しいAPIバージョンの請求には invoice が無いため、変更フィードで請求の変更から索引を破棄できるよう、
+    PaymentIntent からインボイスへの対応（idx_payment_intent_*）も保存する。
+    """
+    account = account_key(api_key)
+    index_key = f"idx_charges_{invoice['id']}"
+    cacheable = object_store.enabled and is_immutable_invoice(invoice)
+    if cacheable:
+        index = object_store.get(account, index_key)
+        if index:
+            charges = [object_store.get(account, ch_id) for ch_id in index["ids"]]
+            if all(ch is not None for ch in charges):
+                return charges
+
+    charges = fetch_invoice_charges(api_key, invoice)
+    if cacheable and all(is_immutable_charge(ch) for ch in charges):
+        refs = {"invoice": invoice["id"], "subscription": invoice_subscription_id(invoice)}
+        for ch in charges:
+            object_store.put(account, ch["id"], ch)
+            if isinstance(ch.get("payment_intent"), str):
+                object_store.put(account, f"idx_payment_intent_{ch['payment_intent']}", refs)
+        object_store.put(account, index_key, {"ids": [ch["id"] for ch in charges]})
+    return charges
+
+
+# ============ 次回インボイスのプレビューキャッシュ ============
+
+def project_upcoming_invoice(preview: Optional[dict]) -> Optional[dict]:
+    """
+    フルデータ検索で使う項目だけを残した次回インボイスのプレビュー（明細は説明・金額・数量・価格IDのみ）。
+    """
+    if not preview:
+        return None
+    return {
+        "amount_due": preview.get("amount_due"),
+        "currency": preview.get("currency"),
+        "due_date": preview.get("due_date"),
+        "lines": [
+            {
+                "description": line.get("description"),
+                "amount": line.get("amount"),
+                "quantity": line.get("quantity"),
+                "price_id": invoice_line_price_id(line),
+            }
+            for line in (preview.get("lines") or {}).get("data", [])
+        ],
+    }
+
+
+class UpcomingInvoiceCache(BoundedLRUCache):
+    """
+    次回インボイスのプレビュー（project_upcoming_invoice で必要な項目だけにしたもの）を
+    (アカウント, サブスクリプションID) ごとに保持するLRUキャッシュ。
+    取得時のサブスクリプションの請求状態のフィンガープリントを一緒に保存し、
+    アイテム・数量・価格・期間・割引などが変わってフィンガープリントが一致しなくなったら使わない。
+    従量課金の利用量などフィンガープリントに現れない変化は ttl 秒で反映される。
+    """
+
+    def get(self, account: str, subscription_id: str, fingerprint: str) -> Optional[dict]:
+        """
+        フィンガープリントが一致するエントリ（{"preview", "expires_at", ...}）を返す。
+        プレビューが存在しないこと（preview が None）もキャッシュする。期限切れでも stale_ttl 以内なら返す。
+        """
+        return self.get_entry((account, subscription_id), lambda entry: entry["fingerprint"] == fingerprint)
+
+    def set(
+        self, account: str, subscription_id: str, customer_id: Optional[str], fingerprint: str, preview: Optional[dict]
+    ) -> None:
+        entry = {"fingerprint": fingerprint, "preview": preview, "customer": customer_id}
+        self.put((account, subscription_id), entry, len(serialize_payload(preview)))
+
+    def invalidate(self, account: str, ids: Optional[List[str]] = None) -> int:
+        """
+        指定アカウントのエントリを破棄する。ids を渡した場合はサブスクリプションIDか顧客IDが含まれるものだけを破棄する。
+        """
+        return self.remove_where(
+            lambda key, entry: key[0] == account and (ids is None or key[1] in ids or entry["customer"] in ids)
+        )
+
+
+upcoming_cache = UpcomingInvoiceCache(
+    UPCOMING_CACHE_TTL,
+    UPCOMING_CACHE_MAX_ENTRIES,
+    max(CACHE_STALE_WHILE_REVALIDATE, CACHE_STALE_IF_ERROR, 0),
+    UPCOMING_CACHE_MAX_BYTES,
+)
+
+
+def billing_fingerprint(subscription: dict) -> str:
+    """
+    次回インボイスの内容を左右するサブスクリプションの状態（アイテム・価格・数量・期間・割引・解約予定など）のハッシュ。
+    """
+    items = sorted(
+        (
+            item.get("id"),
+            (item.get("price") or {}).get("id"),
+            item.get("quantity"),
+            item.get("current_period_end"),  # 新しいAPIバージョンでは期間がアイテムごとに付く
+        )
+        for item in subscription.get("items", {}).get("data", [])
+    )
+    discounts = [
+        discount if isinstance(discount, str) else discount.get("id")
+        for discount in subscription.get("discounts") or []
+    ]
+    state = {
+        "items": items,
+        "current_period_end": subscription.get("current_period_end"),
+        "discount": (subscription.get("discount") or {}).get("id"),
+        "discounts": discounts,
+        "status": subscription.get("status"),
+        "cancel_at_period_end": subscription.get("cancel_at_period_end"),
+        "cancel_at": subscription.get("cancel_at"),
+        "trial_end": subscription.get("trial_end"),
+        "pause_collection": subscription.get("pause_collection"),
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def fetch_upcoming_invoice(api_key: str, subscription_id: str) -> Optional[dict]:
+    """
+    次回インボイスのプレビューを project_upcoming_invoice の形で返す（次回インボイスが無い場合は None）。
+    SDK に Invoice.create_preview（新しいプレビューAPI）があればそれを使い、無ければ Invoice.upcoming を使う。
+    """
+    throttle_stripe_call()
+    try:
+        if hasattr(stripe.Invoice, "create_preview"):
+            preview = stripe.Invoice.create_preview(subscription=subscription_id, api_key=api_key)
+        else:
+            preview = stripe.Invoice.upcoming(subscription=subscription_id, api_key=api_key)
+    except stripe.error.InvalidRequestError:
+        return None
+    return project_upcoming_invoice(preview.to_dict()) if preview else None
+
+
+def get_upcoming_invoice(api_key: str, subscription: dict) -> Optional[dict]:
+    """
+    請求状態が前回と同じサブスクリプションはキャッシュしたプレビューを返し、Stripe を呼ばない。
+    期限切れから CACHE_STALE_WHILE_REVALIDATE 秒以内なら古いプレビューを返して裏で取り直し、
+    それより古ければ取り直して、Stripe が 429 / 5xx / 接続エラーなら CACHE_STALE_IF_ERROR 秒以内の古いプレビューを返す。
+    返す dict はキャッシュと共有されるため、呼び出し側では変更しないこと。
+    """
+    account = account_key(api_key)
+    subscription_id = subscription["id"]
+    customer_id = subscription.get("customer")
+    fingerprint = billing_fingerprint(subscription)
+
+    def fetch():
+        preview = stripe_single_flight.do(
+            ("upcoming_invoice", account, subscription_id, fingerprint),
+            lambda: fetch_upcoming_invoice(api_key, subscription_id),
+        )
+        upcoming_cache.set(account, subscription_id, customer_id, fingerprint, preview)
+        return preview
+
+    entry = upcoming_cache.get(account, subscription_id, fingerprint)
+    now = time.time()
+    if entry is not None and entry["expires_at"] > now:
+        record_skipped_call("upcoming_invoice", "cached")
+        return entry["preview"]
+    if entry is not None and now - entry["expires_at"] < CACHE_STALE_WHILE_REVALIDATE:
+        record_skipped_call("upcoming_invoice", "stale")
+        record_stale_data(entry["stored_at"])
+        refresh_in_background(("upcoming_invoice", account, subscription_id), fetch)
+        return entry["preview"]
+    try:
+        return fetch()
+    except stripe.error.StripeError as e:
+        if entry is None or now - entry["expires_at"] >= CACHE_STALE_IF_ERROR or not is_transient_stripe_error(e):
+            raise
+        logger.warning(f"Serving stale upcoming invoice for {subscription_id}: {str(e)}")
+        record_skipped_call("upcoming_invoice", "stale_if_error")
+        record_stale_data(entry["stored_at"], after_error=True)
+        return entry["preview"]
+
+
+# ============ 顧客ミラー（SQLite） ============
+
+class CustomerMirror:
+    """
+    アカウントの全顧客をSQLiteに複製し、小文字化したメールアドレスのインデックスで検索できるようにする。
+    Customer.list による全件同期のあと、Events API の customer.* イベントで差分を取り込む。
+    """
+
+    def __init__(self, path: str, refresh_interval: int):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS customers (
+                    account TEXT NOT NULL,
+                    cus_id TEXT NOT NULL,
+                    email TEXT,
+                    created INTEGER,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (account, cus_id)
+                );
+                CREATE INDEX IF NOT EXISTS idx_customers_email ON customers (account, email);
+                CREATE TABLE IF NOT EXISTS mirror_state (
+                    account TEXT PRIMARY KEY,
+                    event_cursor TEXT,
+                    synced_at REAL,
+                    refreshed_at REAL
+                );
+            """)
+            self._conn = conn
+        return self._conn
+
+    def _state(self, account: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT event_cursor, synced_at, refreshed_at FROM mirror_state WHERE account = ?", (account,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"event_cursor": row[0], "synced_at": row[1], "refreshed_at": row[2]}
+
+    def is_synced(self, account: str) -> bool:
+        return self.enabled and self._state(account) is not None
+
+    def _upsert(self, conn: sqlite3.Connection, account: str, customer: dict) -> None:
+        email = customer.get("email")
+        conn.execute(
+            "INSERT OR REPLACE INTO customers (account, cus_id, email, created, data) VALUES (?, ?, ?, ?, ?)",
+            (account, customer["id"], email.lower() if email else None, customer.get("created"),
+             json.dumps(customer, separators=(",", ":"), default=str)),
+        )
+
+    def apply_customer(self, account: str, customer: dict, deleted: bool = False) -> None:
+        """
+        変更フィード等で受け取った顧客オブジェクトをミラーに反映する（未同期のアカウントは対象外）。
+        """
+        if not self.is_synced(account) or not customer.get("id"):
+            return
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                if deleted or customer.get("deleted"):
+                    conn.execute("DELETE FROM customers WHERE account = ? AND cus_id = ?", (account, customer["id"]))
+                else:
+                    self._upsert(conn, account, customer)
+
+    def full_sync(self, api_key: str) -> dict:
+        """
+        Customer.list を全件ページングしてミラーを作り直す。
+        同期中に発生した変更を取りこぼさないよう、一覧取得の前に最新イベントIDを控えておく。
+        """
+        account = account_key(api_key)
+        latest_events = stripe.Event.list(limit=1, api_key=api_key)
+        event_cursor = latest_events.data[0].id if latest_events.data else None
+
+        customers = list(iter_list(api_key, stripe.Customer, {}))
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("DELETE FROM customers WHERE account = ?", (account,))
+                for customer in customers:
+                    self._upsert(conn, account, customer)
+                conn.execute(
+                    "INSERT OR REPLACE INTO mirror_state (account, event_cursor, synced_at, refreshed_at) VALUES (?, ?, ?, ?)",
+                    (account, event_cursor, now, now),
+                )
+        logger.info(f"Customer mirror synced {len(customers)} customers for account {account}")
+        return {"customers": len(customers), "cursor": event_cursor}
+
+    def refresh(self, api_key: str, force: bool = False) -> None:
+        """
+        前回の取り込み以降の customer.* イベントを反映する。refresh_interval 以内の再実行は省略する。
+        """
+        account = account_key(api_key)
+        state = self._state(account)
+        if state is None:
+            return
+        if not force and time.time() - (state["refreshed_at"] or 0) < self.refresh_interval:
+            return
+
+        cursor = state["event_cursor"]
+        while True:
+            params = {"limit": 100, "api_key": api_key}
+            if cursor:
+                params["ending_before"] = cursor
+            try:
+                events = stripe.Event.list(**params)
+            except stripe.error.InvalidRequestError as e:
+                # イベントの保持期間（30日）を過ぎたカーソルは使えないため全件同期し直す
+                logger.warning(f"Customer mirror cursor {cursor} is no longer valid, resyncing: {str(e)}")
+                self.full_sync(api_key)
+                return
+            if not events.data:
+                break
+            for event in reversed(events.data):
+                event_dict = event.to_dict()
+                obj = event_dict.get("data", {}).get("object", {})
+                if obj.get("object") == "customer":
+                    self.apply_customer(account, obj, deleted=event_dict.get("type") == "customer.deleted")
+            cursor = events.data[0].id
+            if not cursor or not events.has_more:
+                break
+
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "UPDATE mirror_state SET event_cursor = ?, refreshed_at = ? WHERE account = ?",
+                    (cursor, time.time(), account),
+                )
+
+    def lookup(self, account: str, emails: List[str]) -> Dict[str, List[dict]]:
+        """
+        小文字化したメールアドレスごとに、一致する顧客を作成日時の新しい順で返す。
+        """
+        lowered = sorted({email.lower() for email in emails})
+        found = {email: [] for email in lowered}
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(lowered), 500):
+                chunk = lowered[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT email, data FROM customers WHERE account = ? AND email IN ({placeholders}) "
+                    "ORDER BY created DESC, cus_id DESC",
+                    [account, *chunk],
+                ).fetchall()
+                for email, data in rows:
+                    found[email].append(json.loads(data))
+        return found
+
+
+customer_mirror = CustomerMirror(CUSTOMER_MIRROR_PATH, CUSTOMER_MIRROR_REFRESH_INTERVAL)
+
+
+# ============ 取得戦略のプランナー ============
+
+class AccountStats:
+    """
+    アカウントごとの統計（サブスクリプションの総数、サブスクリプションごとの顧客IDとインボイス数）をメモリに保持する。
+    一覧・検索の結果から随時更新し、プランナーが取得方法ごとのStripe呼び出し回数を見積もるのに使う。
+    ttl 秒より古い値は使わない。
+    """
+
+    def __init__(self, ttl: int, max_subscriptions: int):
+        self.ttl = ttl
+        self.max_subscriptions = max_subscriptions
+        self._accounts = {}
+        self._lock = threading.Lock()
+
+    def _account(self, account: str) -> dict:
+        return self._accounts.setdefault(account, {"subscription_total": None, "subscriptions": OrderedDict()})
+
+    def observe_subscription_total(self, account: str, total: int) -> None:
+        with self._lock:
+            self._account(account)["subscription_total"] = (total, time.time())
+
+    def observe_subscription(
+        self, account: str, subscription_id: str, customer_id: Optional[str] = None, invoice_count: Optional[int] = None
+    ) -> None:
+        with self._lock:
+            subscriptions = self._account(account)["subscriptions"]
+            entry = subscriptions.pop(subscription_id, None) or {}
+            if customer_id is not None:
+                entry["customer"] = customer_id
+            if invoice_count is not None:
+                entry["invoices"] = invoice_count
+            entry["observed_at"] = time.time()
+            subscriptions[subscription_id] = entry
+            while len(subscriptions) > self.max_subscriptions:
+                subscriptions.popitem(last=False)
+
+    def snapshot(self, account: str) -> dict:
+        """
+        有効期限内の統計を返す（subscription_total は未計測なら None）。
+        """
+        now = time.time()
+        with self._lock:
+            stats = self._accounts.get(account)
+            if stats is None:
+                return {"subscription_total": None, "subscriptions": {}}
+            total = stats["subscription_total"]
+            return {
+                "subscription_total": total[0] if total and now - total[1] < self.ttl else None,
+                "subscriptions": {
+                    subscription_id: dict(entry)
+                    for subscription_id, entry in stats["subscriptions"].items()
+                    if now - entry["observed_at"] < self.ttl
+                },
+            }
+
+
+account_stats = AccountStats(ACCOUNT_STATS_TTL, ACCOUNT_STATS_MAX_SUBSCRIPTIONS)
+
+
+def observe_subscriptions(api_key: str, subscriptions, total: bool = False) -> None:
+    """
+    取得したサブスクリプション（dict）の顧客IDを統計に記録する。total=True なら全件の一覧として総数も記録する。
+    """
+    account = account_key(api_key)
+    count = 0
+    for subscription in subscriptions:
+        account_stats.observe_subscription(account, subscription["id"], customer_id=subscription.get("customer"))
+        count += 1
+    if total:
+        account_stats.observe_subscription_total(account, count)
+
+
+def list_all_subscriptions(api_key: str) -> List[dict]:
+    """
+    アカウントの全サブスクリプション（解約済みを含む）を取得し、総数を統計に記録する。
+    """
+    subscriptions = list(iter_list(api_key, stripe.Subscription, {"status": "all"}))
+    observe_subscriptions(api_key, subscriptions, total=True)
+    return subscriptions
+
+
+def probe_subscriptions(api_key: str, subscription_ids: List[str]) -> Dict[str, dict]:
+    """
+    総数が分からないアカウントで Subscription.list(status=all) を1ページずつ読み、指定IDのサブスクリプションを取り出す。
+    1ページから取り出せたIDが1件以下（retrieve より得にならない）になったら読むのをやめ、残りは呼び出し側が retrieve する。
+    最後まで読めた場合は総数を統計に記録し、以後は list / retrieve を見積もりで選べるようにする。
+    """
+    wanted = set(subscription_ids)
+    params = {"status": "all", "limit": LIST_PAGE_SIZE}
+    found = {}
+    count = 0
+    while True:
+        page = list_page(api_key, stripe.Subscription, params)
+        data = page.get("data", [])
+        observe_subscriptions(api_key, data)
+        count += len(data)
+        hits = [subscription for subscription in data if subscription["id"] in wanted]
+        found.update((subscription["id"], subscription) for subscription in hits)
+        if not page.get("has_more") or not data:
+            account_stats.observe_subscription_total(account_key(api_key), count)
+            return found
+        if len(hits) <= 1:
+            return found
+        params = dict(params, starting_after=data[-1]["id"])
+
+
+def list_pages(object_count: float) -> int:
+    # 一覧APIで object_count 件を読むのに必要なページ数（0件でも1回は呼ぶ）
+    return max(1, math.ceil(object_count / LIST_PAGE_SIZE))
+
+
+def make_plan(endpoint: str, costs: Dict[str, int], ids: List[str], stats: dict, **inputs) -> dict:
+    """
+    見積もった呼び出し回数が最小の戦略を選ぶ（同数なら costs の先頭に近いものを優先する）。
+    """
+    strategy = min(costs, key=costs.get)
+    known = stats["subscriptions"]
+    invoice_counts = [entry["invoices"] for entry in known.values() if "invoices" in entry]
+    plan = {
+        "endpoint": endpoint,
+        "strategy": strategy,
+        "estimated_calls": costs[strategy],
+        "alternatives": costs,
+        "inputs": dict(inputs, ids=len(ids)),
+        "stats": {
+            "subscription_total": stats["subscription_total"],
+            "known_subscriptions": len(known),
+            "average_invoices_per_subscription": (
+                round(sum(invoice_counts) / len(invoice_counts), 1) if invoice_counts else None
+            ),
+        },
+    }
+    logger.info(f"Plan for {endpoint}: {strategy} (~{costs[strategy]} Stripe calls, alternatives {costs})")
+    return plan
+
+
+def plan_subscriptions_by_ids(api_key: str, subscription_ids: List[str]) -> dict:
+    """
+    retrieve: IDごとに Subscription.retrieve
+    list: Subscription.list(status=all) でアカウントの全件を読み、指定IDを取り出す（総数が分かっている場合のみ）
+    probe: 総数が分からない場合に、一覧を指定IDが見つかる間だけ読む（probe_subscriptions）。
+           見積もりはアカウントに指定IDしか無い場合の下限で、1ページに収まるID数以下では使わない
+    """
+    stats = account_stats.snapshot(account_key(api_key))
+    costs = {"retrieve": len(subscription_ids)}
+    if stats["subscription_total"] is not None:
+        costs["list"] = list_pages(stats["subscription_total"])
+    elif len(subscription_ids) > LIST_PAGE_SIZE:
+        costs["probe"] = list_pages(len(subscription_ids))
+    return make_plan("/search_subscriptions_by_id", costs, subscription_ids, stats)
+
+
+def plan_invoices_by_subscription(
+    api_key: str,
+    subscription_ids: List[str],
+    since: Optional[int] = None,
+    shards: int = 1,
+    limit: Optional[int] = None,
+    consistency: str = "eventual",
+) -> dict:
+    """
+    list: サブスクリプションごとに Invoice.list(subscription=...)
+    search: Invoice.search の OR クエリ（10件ずつ）。反映が遅れるため eventual で since / shards 指定が無い場合のみ
+    customer_list: 顧客ごとに Invoice.list(customer=...)。全サブスクリプションの顧客が分かっている場合のみ
+    page: limit 指定時のページング（最小の見積もり）
+    インボイス数が分からないサブスクリプションは既知の平均で見積もる（平均も無ければ1ページ分）。
+    """
+    stats = account_stats.snapshot(account_key(api_key))
+    inputs = {"since": since, "shards": shards, "limit": limit, "consistency": consistency}
+    if limit is not None:
+        return make_plan("/search_invoices_by_subscription", {"page": list_pages(limit)}, subscription_ids, stats, **inputs)
+
+    known = stats["subscriptions"]
+    invoice_counts = [entry["invoices"] for entry in known.values() if "invoices" in entry]
+    average = sum(invoice_counts) / len(invoice_counts) if invoice_counts else 0
+
+    def estimated_invoices(subscription_id):
+        return known.get(subscription_id, {}).get("invoices", average)
+
+    costs = {"list": sum(list_pages(estimated_invoices(s)) for s in subscription_ids)}
+    if consistency == "eventual" and since is None and shards <= 1 and len(subscription_ids) > 1:
+        costs["search"] = sum(
+            list_pages(sum(estimated_invoices(s) for s in subscription_ids[i:i + INVOICE_SEARCH_MAX_CLAUSES]))
+            for i in range(0, len(subscription_ids), INVOICE_SEARCH_MAX_CLAUSES)
+        )
+    customers = {known.get(s, {}).get("customer") for s in subscription_ids}
+    if shards <= 1 and None not in customers:
+        # 顧客の一覧には指定外のサブスクリプションのインボイスも含まれる
+        costs["customer_list"] = sum(
+            list_pages(sum(estimated_invoices(s) for s, entry in known.items() if entry.get("customer") == customer))
+            for customer in customers
+        )
+    return make_plan("/search_invoices_by_subscription", costs, subscription_ids, stats, **inputs)
+
+
+def plan_invoice_by_charge(api_key: str, charge_ids: List[str]) -> dict:
+    """
+    invoice_payment: Charge.retrieve と、インボイスを展開した InvoicePayment.list で2回
+    （新しいAPIバージョンの請求には invoice が無く、expand=["invoice"] は使えない）
+    """
+    stats = account_stats.snapshot(account_key(api_key))
+    costs = {"invoice_payment": 2 * len(charge_ids)}
+    return make_plan("/search_invoice_by_charge", costs, charge_ids, stats)
+
+
+# サブスクリプションIDでItemsデータを1階層だけフラット化し、関連するプロダクト情報も取得
+# shape="normalized" の場合は、商品を各アイテムにコピーせず subscriptions / items / prices / products のテーブルで返す
+def search_subscription_items_by_id(
+    api_key: str, subscription_ids: List[str], shape: str = "rows", time_format: str = "jst", partial: bool = False
+):
+    results = []
+    missing_ids = [] if partial else None
+    tables = EntityTables(("subscriptions", "items", "prices", "products")) if shape == "normalized" else None
+
+    for subscription_id in subscription_ids:
+        try:
+            if tables is not None:
+                # 商品まで expand して1回の retrieve で取得する
+                subscription = retrieve_object(
+                    api_key, stripe.Subscription, subscription_id, expand=["items.data.price.product"]
+                )
+                add_subscription_entities(tables, subscription.to_dict(), with_items=True, time_format=time_format)
+                continue
+
+            # 単一サブスクリプションを直接retrieve
+            subscription = retrieve_object(api_key, stripe.Subscription, subscription_id)
+            subscription_dict = rename_id_field(subscription.to_dict(), "subscription")
+
+            # items.data の要素を処理
+            for item in subscription_dict['items']['data']:
+                item_dict = rename_id_field(item, "subscription_item")
+
+                # price から product を取得
+                price_product_id = item_dict.get("price", {}).get("product")
+                if price_product_id:
+                    try:
+                        product_obj = retrieve_object(api_key, stripe.Product, price_product_id)
+                        product_dict = rename_id_field(product_obj.to_dict(), "product")
+                        # フラット化して item_dict に統合
+                        flat_product = flatten_json(product_dict, parent_key='product', time_format=time_format)
+                        item_dict.update(flat_product)
+                    except stripe.error.StripeError as e:
+                        logger.error(f"Stripe API error for product ID {price_product_id}: {str(e)}")
+                        raise HTTPException(status_code=400, detail=f"Stripe API error for product ID {price_product_id}: {str(e)}")
+                    except Exception as e:
+                        logger.error(f"Unexpected error during search for product ID {price_product_id}: {str(e)}")
+                        raise HTTPException(status_code=500, detail=f"Unexpected error during search for product ID {price_product_id}: {str(e)}")
+
+                flat_item = flatten_json(item_dict, time_format=time_format)
+                results.append(flat_item)
+
+        except stripe.error.StripeError as e:
+            if missing_ids is not None and is_resource_missing(e, subscription_id):
+                missing_ids.append(subscription_id)
+                continue
+            logger.error(f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
+
+    return add_missing_ids(tables.to_dict() if tables is not None else {"records": results}, missing_ids)
+
+
+# 顧客のメールアドレスで顧客情報を検索
+def search_customers_by_email(
+    api_key: str, email_addresses: List[str], consistency: str = "eventual", time_format: str = "jst"
+):
+    results = []
+
+    # 顧客ミラーが同期済みなら、Stripeに問い合わせずローカルのメールアドレス索引から返す
+    account = account_key(api_key)
+    if consistency != "strong" and customer_mirror.is_synced(account):
+        try:
+            customer_mirror.refresh(api_key)
+        except stripe.error.StripeError as e:
+            logger.warning(f"Customer mirror refresh failed, serving local data: {str(e)}")
+        found = customer_mirror.lookup(account, email_addresses)
+        for email in email_addresses:
+            for customer in found.get(email.lower(), []):
+                customer_dict = rename_id_field(customer, "customer")
+                results.append(flatten_json(customer_dict, time_format=time_format))
+        return {"records": results}
+
+    for email in email_addresses:
+        try:
+            # 顧客を検索（全ページを100件ずつ取得）
+            for customer in iter_list(api_key, stripe.Customer, {"email": email}):
+                results.append(flatten_record(customer, "customer", time_format))
+
+        except stripe.error.StripeError as e:
+            logger.error(f"Stripe API error for email {email}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for {email}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error during search for {email}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Unexpected error during search for {email}: {str(e)}")
+
+    return {"records": results}
+
+
+# 顧客IDでサブスクリプション情報を検索
+def search_subscriptions_by_customer_ids(
+    api_key: str, cus_ids: List[str], time_format: str = "jst", partial: bool = False
+):
+    results = []
+    missing_ids = [] if partial else None
+
+    for cus_id in cus_ids:
+        try:
+            # サブスクリプションを取得（全ページを100件ずつ取得）
+            for subscription in iter_list(api_key, stripe.Subscription, {"customer": cus_id}):
+                observe_subscriptions(api_key, [subscription])
+                subscription_dict = rename_id_field(subscription, "subscription")
+
+                # item_names (例) を作る
+                item_names = []
+                for item in subscription_dict["items"]["data"]:
+                    product_id = item["price"]["product"]
+                    try:
+                        product_obj = retrieve_object(api_key, stripe.Product, product_id)
+                        item_names.append(product_obj["name"])
+                    except stripe.error.StripeError as e:
+                        logger.error(f"Stripe API error for product ID {product_id}: {str(e)}")
+                        raise HTTPException(status_code=400, detail=f"Stripe API error for product ID {product_id}: {str(e)}")
+                    except Exception as e:
+                        logger.error(f"Unexpected error during search for product ID {product_id}: {str(e)}")
+                        raise HTTPException(status_code=500, detail=f"Unexpected error during search for product ID {product_id}: {str(e)}")
+
+                subscription_dict["subscription_item_names"] = " ".join(item_names)
+                flat_subscription = flatten_json(subscription_dict, time_format=time_format)
+                results.append(flat_subscription)
+
+        except stripe.error.StripeError as e:
+            if missing_ids is not None and is_resource_missing(e, cus_id):
+                missing_ids.append(cus_id)
+                continue
+            logger.error(f"Stripe API error for customer ID {cus_id}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for customer ID {cus_id}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error during search for customer ID {cus_id}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Unexpected error during search for customer ID {cus_id}: {str(e)}")
+
+    return add_missing_ids({"records": results}, missing_ids)
+
+
+# サブスクリプションIDからサブスクリプション情報を検索
+def search_subscriptions_by_ids(
+    api_key: str, subscription_ids: List[str], time_format: str = "jst", partial: bool = False
+):
+    results = []
+    missing_ids = [] if partial else None
+
+    # アカウントの大半を指定された場合は、1件ずつ retrieve するより全件の一覧を読むほうが少ない
+    listed = {}
+    strategy = plan_subscriptions_by_ids(api_key, subscription_ids)["strategy"]
+    if strategy != "retrieve":
+        try:
+            if strategy == "list":
+                listed = {subscription["id"]: subscription for subscription in list_all_subscriptions(api_key)}
+            else:
+                listed = probe_subscriptions(api_key, subscription_ids)
+        except stripe.error.StripeError as e:
+            logger.error(f"Stripe API error for subscription list: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription list: {str(e)}")
+
+    for sub_id in subscription_ids:
+        try:
+            # 一覧に無いIDは retrieve で確認する（存在しないIDは従来どおりエラーになる）
+            subscription = listed.get(sub_id) or retrieve_object(api_key, stripe.Subscription, sub_id).to_dict()
+            observe_subscriptions(api_key, [subscription])
+            subscription_dict = rename_id_field(dict(subscription), "subscription")
+            flat_subscription = flatten_json(subscription_dict, time_format=time_format)
+            results.append(flat_subscription)
+        except stripe.error.StripeError as e:
+            if missing_ids is not None and is_resource_missing(e, sub_id):
+                missing_ids.append(sub_id)
+                continue
+            logger.error(f"Stripe API error for subscription ID {sub_id}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription ID {sub_id}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error during search for subscription ID {sub_id}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Unexpected error during search for subscription ID {sub_id}: {str(e)}")
+    return add_missing_ids({"records": results}, missing_ids)
+
+
+# ============ 自APIのページング（limit / starting_after） ============
+
+def encode_page_cursor(ids: List[str], index: int, after: Optional[str], skip: int = 0) -> str:
+    """
+    次ページの位置（入力IDリスト上の位置、そのIDでの Stripe の starting_after、同じインボイス内で返却済みの件数）を
+    クライアントに渡す不透明な文字列にする。
+    """
+    position = {"i": index, "id": ids[index], "after": after, "skip": skip}
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_page_cursor(cursor: Optional[str], ids: List[str]):
+    """
+    encode_page_cursor の逆変換。指定がなければ先頭から。
+    ID リストが作成時と変わっている場合は、位置がずれるため 400 にする。
+    """
+    if not cursor:
+        return 0, None, 0
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        index, after, skip = int(position["i"]), position["after"], int(position["skip"])
+        valid = 0 <= index < len(ids) and ids[index] == position["id"] and skip >= 0
+    except Exception:
+        valid = False
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid starting_after cursor for the given IDs")
+    return index, after, skip
+
+
+def page_result(records: List[dict], ids: List[str], index: int, after: Optional[str], skip: int = 0) -> dict:
+    has_more = index < len(ids)
+    return {
+        "records": records,
+        "has_more": has_more,
+        "next_starting_after": encode_page_cursor(ids, index, after, skip) if has_more else None,
+    }
+
+
+# サブスクリプションIDに連なる請求(Charge)を取得
+def search_charges_by_subscription(
+    api_key: str,
+    subscription_ids: List[str],
+    time_format: str = "jst",
+    limit: Optional[int] = None,
+    starting_after: Optional[str] = None,
+    shards: int = 1,
+    partial: bool = False,
+):
+    if limit is not None:
+        return search_charges_page(api_key, subscription_ids, time_format, limit, starting_after)
+    results = []
+    missing_ids = [] if partial else None
+    for subscription_id in subscription_ids:
+        try:
+            invoices = list_subscription_invoices(api_key, subscription_id, shards=shards)
+            if shards > 1:
+                # インボイスごとの請求の取得も、連続した区間に分けて並行に行う
+                size = -(-len(invoices) // shards)
+                chunks = [invoices[i:i + size] for i in range(0, len(invoices), size)]
+                charge_lists = []
+                for chunk_charges in run_sharded(
+                    lambda chunk: [list_invoice_charges(api_key, inv) for inv in chunk],
+                    [(chunk,) for chunk in chunks],
+                ):
+                    charge_lists.extend(chunk_charges)
+            else:
+                charge_lists = (list_invoice_charges(api_key, inv) for inv in invoices)
+            for charges in charge_lists:
+                for ch in charges:
+                    results.append(flatten_record(ch, "charge", time_format))
+
+        except stripe.error.StripeError as e:
+            if missing_ids is not None and is_resource_missing(e, subscription_id):
+                missing_ids.append(subscription_id)
+                continue
+            logger.error(f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
+
+    return add_missing_ids({"records": results}, missing_ids)
+
+
+def search_charges_page(
+    api_key: str, subscription_ids: List[str], time_format: str, limit: int, starting_after: Optional[str]
+):
+    """
+    請求を limit 件ずつ返す。インボイスは Stripe の starting_after で続きから読み、
+    1つのインボイスの請求がページをまたぐ場合は、返却済みの件数（skip）をカーソルに残す。
+    """
+    index, after, skip = decode_page_cursor(starting_after, subscription_ids)
+    results = []
+    while index < len(subscription_ids) and len(results) < limit:
+        subscription_id = subscription_ids[index]
+        try:
+            params = {"subscription": subscription_id, "limit": min(limit, LIST_PAGE_SIZE)}
+            if after:
+                params["starting_after"] = after
+            page = list_page(api_key, stripe.Invoice, params)
+            for position, inv in enumerate(page["data"]):
+                charges = list_invoice_charges(api_key, inv)[skip:]
+                taken = charges[:limit - len(results)]
+                results.extend(flatten_record(ch, "charge", time_format) for ch in taken)
+                if len(taken) < len(charges):
+                    # このインボイスの途中でページが埋まった
+                    return page_result(results, subscription_ids, index, after, skip + len(taken))
+                after, skip = inv["id"], 0
+                if len(results) >= limit:
+                    if position == len(page["data"]) - 1 and not page["has_more"]:
+                        # このサブスクリプションの最後のインボイスでちょうど埋まった場合は、次のサブスクリプションから続ける
+                        # （最後のサブスクリプションなら has_more は false）
+                        index, after = index + 1, None
+                    return page_result(results, subscription_ids, index, after)
+        except stripe.error.StripeError as e:
+            logger.error(f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
+        if not page["has_more"]:
+            index, after, skip = index + 1, None, 0
+    return page_result(results, subscription_ids, index, after, skip)
+
+
+# サブスクリプションIDに連なるインボイスを取得
+# since を指定すると、その時刻より後に作成されたインボイスだけを返す（watermark は次回の since に使う）
+def get_invoices_by_subscription_id(
+    api_key: str,
+    subscription_ids: List[str],
+    since: Optional[int] = None,
+    time_format: str = "jst",
+    limit: Optional[int] = None,
+    starting_after: Optional[str] = None,
+    shards: int = 1,
+    consistency: str = "eventual",
+    partial: bool = False,
+):
+    if limit is not None:
+        return get_invoices_page(api_key, subscription_ids, since, time_format, limit, starting_after)
+
+    # サブスクリプションごとの一覧・検索APIでの一括取得・顧客ごとの一覧のうち、呼び出しが少ないものを使う
+    plan = plan_invoices_by_subscription(api_key, subscription_ids, since, shards, limit, consistency)
+    batched = {}
+    search_complete_before = None
+    try:
+        if plan["strategy"] == "search":
+            # 検索で見つからなかったものは、反映待ちや存在しないIDの可能性があるため一覧で確認し直す
+            search_complete_before = int(time.time()) - INVOICE_SEARCH_LAG_SECONDS
+            searched = search_subscription_invoices(api_key, subscription_ids)
+            batched = {subscription_id: invoices for subscription_id, invoices in searched.items() if invoices}
+        elif plan["strategy"] == "customer_list":
+            # 顧客の一覧に1件も無かったものは、一覧で確認し直す
+            known = account_stats.snapshot(account_key(api_key))["subscriptions"]
+            listed = list_customer_invoices(
+                api_key, sorted({known[s]["customer"] for s in subscription_ids}), subscription_ids, since
+            )
+            batched = {subscription_id: invoices for subscription_id, invoices in listed.items() if invoices}
+    except stripe.error.StripeError as e:
+        logger.error(f"Stripe API error for invoice {plan['strategy']}: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Stripe API error for invoice {plan['strategy']}: {str(e)}")
+
+    account = account_key(api_key)
+    results = []
+    missing_ids = [] if partial else None
+    watermark = since
+    for subscription_id in subscription_ids:
+        try:
+            if subscription_id in batched:
+                invoices = batched[subscription_id]
+            else:
+                invoices = list_subscription_invoices(api_key, subscription_id, since, shards)
+            if since is None:
+                account_stats.observe_subscription(
+                    account, subscription_id,
+                    customer_id=invoices[0].get("customer") if invoices else None,
+                    invoice_count=len(invoices),
+                )
+            for inv in invoices:
+                if watermark is None or inv["created"] > watermark:
+                    watermark = inv["created"]
+                results.append(flatten_record(inv, "invoice", time_format))
+        except stripe.error.StripeError as e:
+            if missing_ids is not None and is_resource_missing(e, subscription_id):
+                missing_ids.append(subscription_id)
+                continue
+            logger.error(f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
+    payload = {"records": results, "watermark": watermark}
+    if batched and search_complete_before is not None:
+        # 検索APIで取得したサブスクリプションは、この時刻より後に作成・更新されたインボイスが欠けている可能性がある
+        payload["search_complete_before"] = search_complete_before
+    return add_missing_ids(payload, missing_ids)
+
+
+def get_invoices_page(
+    api_key: str,
+    subscription_ids: List[str],
+    since: Optional[int],
+    time_format: str,
+    limit: int,
+    starting_after: Optional[str],
+):
+    """
+    インボイスを limit 件ずつ返す。各サブスクリプションの Invoice.list を Stripe の starting_after で続きから読むため、
+    1回の呼び出しで Stripe に問い合わせる件数は limit 件程度に収まる。
+    """
+    index, after, _ = decode_page_cursor(starting_after, subscription_ids)
+    results = []
+    watermark = since
+    while index < len(subscription_ids) and len(results) < limit:
+        subscription_id = subscription_ids[index]
+        try:
+            params = {"subscription": subscription_id, "limit": min(limit - len(results), LIST_PAGE_SIZE)}
+            if after:
+                params["starting_after"] = after
+            if since is not None:
+                params["created"] = {"gt": since}
+            page = list_page(api_key, stripe.Invoice, params)
+            for inv in page["data"]:
+                if watermark is None or inv["created"] > watermark:
+                    watermark = inv["created"]
+                results.append(flatten_record(inv, "invoice", time_format))
+                after = inv["id"]
+        except stripe.error.StripeError as e:
+            logger.error(f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
+        if not page["has_more"]:
+            index, after = index + 1, None
+    return dict(page_result(results, subscription_ids, index, after), watermark=watermark)
+
+
+# 請求IDに連なるインボイスを取得
+def get_invoice_by_charge_id(
+    api_key: str, charge_ids: List[str], time_format: str = "jst", partial: bool = False
+):
+    """
+    請求に紐づくインボイスを返す。インボイスは charge_invoice で、請求の PaymentIntent のインボイス支払いから求める
+    （古いAPIバージョンでは請求の invoice から）。
+    同じインボイスに属する請求が複数あってもインボイスは1件だけ返し、
+    インボイスの無い請求（単発の支払いなど）は charges_without_invoice に列挙する。
+    """
+    results = []
+    missing_ids = [] if partial else None
+    seen_invoice_ids = set()
+    charges_without_invoice = []
+    for charge_id in charge_ids:
+        try:
+            charge_dict = retrieve_object(api_key, stripe.Charge, charge_id).to_dict()
+            inv_dict = charge_invoice(api_key, charge_dict)
+            if not inv_dict:
+                charges_without_invoice.append(charge_id)
+                continue
+            if inv_dict["id"] in seen_invoice_ids:
+                continue
+            seen_invoice_ids.add(inv_dict["id"])
+            results.append(flatten_record(inv_dict, "invoice", time_format))
+
+        except stripe.error.StripeError as e:
+            if missing_ids is not None and is_resource_missing(e, charge_id):
+                missing_ids.append(charge_id)
+                continue
+            logger.error(f"Stripe API error for charge ID {charge_id}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for charge ID {charge_id}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error during search for charge ID {charge_id}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Unexpected error during search for charge ID {charge_id}: {str(e)}")
+    return add_missing_ids({"records": results, "charges_without_invoice": charges_without_invoice}, missing_ids)
+
+
+# ============ 顧客グラフ（正規化レスポンス） ============
+
+class EntityTables:
+    """
+    ID をキーにしたエンティティテーブルの集合。同じIDのエンティティは最初の1件だけ保持し、
+    他のテーブルからは外部キー（cus_id, sub_id, price_id など）で参照する。
+    """
+
+    def __init__(self, names):
+        self.tables = {name: {} for name in names}
+
+    def add(self, table: str, entity_id: str, row: dict) -> None:
+        self.tables[table].setdefault(entity_id, row)
+
+    def project(self, projection: Dict[str, List[str]]) -> None:
+        """
+        テーブルごとに残すフィールドを絞り込む。フラット化済みのキーは接頭辞でも指定できる（例: address → address_city）。
+        """
+        for table, fields in projection.items():
+            for entity_id, row in self.tables[table].items():
+                self.tables[table][entity_id] = {
+                    key: value for key, value in row.items()
+                    if any(key == field or key.startswith(field + "_") for field in fields)
+                }
+
+    def to_dict(self) -> dict:
+        return self.tables
+
+
+# customer_graph で返すテーブルと、depth ごとに追加されるテーブル
+GRAPH_TABLES = ("customers", "subscriptions", "items", "prices", "products", "invoices", "charges")
+
+
+def parse_field_projection(fields: Optional[str], table_names) -> Dict[str, List[str]]:
+    """
+    "customers:cus_id,email;subscriptions:sub_id,status" 形式のフィールド指定を解析する。
+    """
+    projection = {}
+    if not fields:
+        return projection
+    for part in fields.split(";"):
+        if not part.strip():
+            continue
+        table, _, names = part.partition(":")
+        table = table.strip()
+        if table not in table_names:
+            raise HTTPException(status_code=422, detail=f"Validation error: unknown table '{table}' in fields")
+        projection[table] = [name.strip() for name in names.split(",") if name.strip()]
+    return projection
+
+
+def add_subscription_entities(
+    tables: EntityTables, subscription: dict, with_items: bool, time_format: str = "jst"
+) -> None:
+    """
+    サブスクリプションと、そのアイテム・価格・商品をそれぞれのテーブルに分解して追加する。
+    アイテムに含まれる price / product は埋め込まずに price_id / prod_id で参照する。
+    """
+    items = subscription.pop("items", None) or {}
+    subscription.pop("plan", None)  # price と同じ内容のため正規化では持たない
+    sub_row = flatten_json(rename_id_field(subscription, "subscription"), time_format=time_format)
+    tables.add("subscriptions", sub_row["sub_id"], sub_row)
+    if not with_items:
+        return
+
+    for item in items.get("data", []):
+        item.pop("plan", None)
+        price = item.pop("price", None) or {}
+        product = price.get("product")
+        product_id = product.get("id") if isinstance(product, dict) else product
+        if isinstance(product, dict):
+            tables.add("products", product_id, flatten_json(rename_id_field(dict(product), "product"), time_format=time_format))
+            price["product"] = product_id
+        if price.get("id"):
+            price_row = flatten_json(rename_id_field(dict(price), "price"), time_format=time_format)
+            tables.add("prices", price_row["price_id"], price_row)
+
+        item["subscription"] = sub_row["sub_id"]
+        item_row = flatten_json(rename_id_field(item, "subscription_item"), time_format=time_format)
+        item_row["price_id"] = price.get("id")
+        item_row["prod_id"] = product_id
+        tables.add("items", item_row["si_id"], item_row)
+
+
+def attach_products(api_key: str, subscriptions: List[dict], products: Dict[str, dict]) -> None:
+    """
+    アイテムの価格が参照する商品を、まだ products に無いIDだけ並行に retrieve し、price["product"] に埋め込む。
+    products は呼び出し全体で共有し、同じ商品を取り直さない。
+    """
+    prices = [
+        item["price"]
+        for subscription in subscriptions
+        for item in subscription.get("items", {}).get("data", [])
+        if isinstance((item.get("price") or {}).get("product"), str)
+    ]
+    missing = sorted({price["product"] for price in prices} - products.keys())
+    fetched = run_sharded(lambda product_id: retrieve_object(api_key, stripe.Product, product_id).to_dict(),
+                          [(product_id,) for product_id in missing])
+    products.update(zip(missing, fetched))
+    for price in prices:
+        price["product"] = products[price["product"]]
+
+
+def build_customer_graph(
+    api_key: str,
+    email_addresses: List[str],
+    cus_ids: List[str],
+    depth: int,
+    projection: Dict[str, List[str]],
+):
+    """
+    メールアドレスまたは顧客IDから、顧客 → サブスクリプション → アイテム → インボイス → 請求 をサーバー側でまとめて辿る。
+    - サブスクリプションは顧客ごとに1回の list（価格まで expand）で取得し、商品は重複を除いて retrieve する
+    - インボイスと請求はサブスクリプションごとではなく顧客ごとに list する
+    - 結果はIDをキーにしたテーブルに正規化し、同じ商品・価格を重複して返さない
+    """
+    account = account_key(api_key)
+    tables = EntityTables(GRAPH_TABLES)
+    products = {}
+
+    customers = []
+    for email in email_addresses:
+        try:
+            if customer_mirror.is_synced(account):
+                customers.extend(customer_mirror.lookup(account, [email]).get(email.lower(), []))
+            else:
+                customers.extend(iter_list(api_key, stripe.Customer, {"email": email}))
+        except stripe.error.StripeError as e:
+            logger.error(f"Stripe API error for email {email}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for {email}: {str(e)}")
+    for cus_id in cus_ids:
+        try:
+            customers.append(retrieve_object(api_key, stripe.Customer, cus_id).to_dict())
+        except stripe.error.StripeError as e:
+            logger.error(f"Stripe API error for customer ID {cus_id}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for customer ID {cus_id}: {str(e)}")
+
+    for customer in customers:
+        customer_row = flatten_json(rename_id_field(customer, "customer"))
+        tables.add("customers", customer_row["cus_id"], customer_row)
+
+    for cus_id in list(tables.tables["customers"]):
+        try:
+            if depth >= 2:
+                params = {"customer": cus_id, "status": "all"}
+                if depth >= 3:
+                    # Stripe の expand は4階層までのため、一覧からは価格までにとどめる
+                    params["expand"] = ["data.items.data.price"]
+                subscriptions = list(iter_list(api_key, stripe.Subscription, params))
+                if depth >= 3:
+                    attach_products(api_key, subscriptions, products)
+                for subscription in subscriptions:
+                    add_subscription_entities(tables, subscription, with_items=depth >= 3)
+
+            if depth >= 4:
+                for inv in iter_list(api_key, stripe.Invoice, {"customer": cus_id}):
+                    inv_row = flatten_record(inv, "invoice")
+                    tables.add("invoices", inv_row["inv_id"], inv_row)
+
+            if depth >= 5:
+                for ch in iter_list(api_key, stripe.Charge, {"customer": cus_id}):
+                    charge_row = flatten_record(ch, "charge")
+                    tables.add("charges", charge_row["ch_id"], charge_row)
+
+        except stripe.error.StripeError as e:
+            logger.error(f"Stripe API error for customer ID {cus_id}: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Stripe API error for customer ID {cus_id}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error during search for customer ID {cus_id}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Unexpected error during search for customer ID {cus_id}: {str(e)}")
+
+    tables.project(projection)
+    return tables.to_dict()
+
+
+# ============ 一括エクスポートジョブ ============
+
+class RateGovernor:
+    """
+    トークンバケットで呼び出しレートを制限する。acquire() はトークンが貯まるまで待機する。
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ExportJobLeaseLost(Exception):
+    """
+    ジョブのリースが切れ、別のプロセスがジョブを引き継いだ。
+    """
+
+
+class ExportJobStore:
+    """
+    ジョブの状態（job.json）・対象ID一覧（ids.json）・結果（results.ndjson）をファイルシステムに保存する。
+    job.json の results_bytes は処理済みユニットまでの結果ファイルのサイズで、再開時はここまで切り詰める。
+    job.json の lease_owner / lease_expires_at は実行中のプロセスとリースの期限で、
+    複数のワーカー（uvicorn の複数プロセスなど）が同じジョブを同時に実行しないようにする。
+    """
 
+    def __init__(self, root: str):
+        self.root = root
+
+    def _dir(self, job_id: str) -> str:
+        if not re.match(r"^[0-9a-f]{32}$", job_id):
+            raise KeyError(job_id)
+        return os.path.join(self.root, job_id)
+
+    def _write_json(self, path: str, data) -> None:
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def create(self, kind: str, account: str, ids: Optional[List[str]]) -> dict:
+        job_id = uuid.uuid4().hex
+        os.makedirs(self._dir(job_id), exist_ok=True)
+        now = time.time()
+        job = {
+            "job_id": job_id,
+            "kind": kind,
+            "account": account,
+            "status": "queued",
+            "scope": "ids" if ids is not None else "account",
+            "total": len(ids) if ids is not None else None,
+            "done": 0,
+            "records": 0,
+            "results_bytes": 0,
+            "error": None,
+            "lease_owner": None,
+            "lease_expires_at": 0,
+            "created_at": now,
+            "updated_at": now,
+        }
+        if ids is not None:
+            self.save_ids(job_id, ids)
+        self.save(job)
+        open(self.results_path(job_id), "wb").close()
+        return job
+
+    def load(self, job_id: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self._dir(job_id), "job.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (KeyError, FileNotFoundError):
+            return None
+
+    def save(self, job: dict) -> None:
+        job["updated_at"] = time.time()
+        self._write_json(os.path.join(self._dir(job["job_id"]), "job.json"), job)
+
+    def _locked(self, job_id: str):
+        # job.json の読み取りと書き込みの間に他のプロセスが割り込まないよう、ジョブごとのロックファイルを flock する
+        f = open(os.path.join(self._dir(job_id), "lease.lock"), "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def acquire_lease(self, job_id: str, owner: str, ttl: int) -> Optional[dict]:
+        """
+        未完了でリースが切れている（または owner 自身が持つ）ジョブのリースを取得して返す。
+        別のプロセスが有効なリースを持っている場合は None を返す。
+        """
+        with self._locked(job_id):
+            job = self.load(job_id)
+            if job is None or job["status"] not in ("queued", "running"):
+                return None
+            now = time.time()
+            if job.get("lease_owner") not in (None, owner) and job.get("lease_expires_at", 0) > now:
+                return None
+            job["lease_owner"] = owner
+            job["lease_expires_at"] = now + ttl
+            self.save(job)
+            return job
+
+    def save_leased(self, job: dict, owner: str, ttl: int) -> None:
+        """
+        リースを延長して job を保存する。リースが別のプロセスに移っていれば ExportJobLeaseLost を送出する。
+        """
+        with self._locked(job["job_id"]):
+            current = self.load(job["job_id"])
+            if current is None or current.get("lease_owner") != owner:
+                raise ExportJobLeaseLost(job["job_id"])
+            job["lease_owner"] = owner
+            # 完了・失敗したジョブはリースを手放す
+            job["lease_expires_at"] = time.time() + ttl if job["status"] in ("queued", "running") else 0
+            self.save(job)
+
+    def load_ids(self, job_id: str) -> Optional[List[str]]:
+        try:
+            with open(os.path.join(self._dir(job_id), "ids.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
 
-# サブスクリプションIDでItemsデータを1階層だけフラット化し、関連するプロダクト情報も取得
-def search_subscription_items_by_id(api_key: str, subscription_ids: List[str]):
-    stripe.api_key = api_key
-    results = []
+    def save_ids(self, job_id: str, ids: List[str]) -> None:
+        self._write_json(os.path.join(self._dir(job_id), "ids.json"), ids)
 
-    for subscription_id in subscription_ids:
-        try:
-            # 単一サブスクリプションを直接retrieve
-            subscription = stripe.Subscription.retrieve(subscription_id)
-            subscription_dict = rename_id_field(subscription.to_dict(), "subscription")
+    def results_path(self, job_id: str) -> str:
+        return os.path.join(self._dir(job_id), "results.ndjson")
 
-            # items.data の要素を処理
-            for item in subscription_dict['items']['data']:
-                item_dict = rename_id_field(item, "subscription_item")
+    def read_results(self, job_id: str, offset: int, limit: int) -> List[bytes]:
+        lines = []
+        with open(self.results_path(job_id), "rb") as f:
+            for line_no, line in enumerate(f):
+                if line_no < offset:
+                    continue
+                if len(lines) >= limit:
+                    break
+                lines.append(line)
+        return lines
 
-                # price から product を取得
-                price_product_id = item_dict.get("price", {}).get("product")
-                if price_product_id:
-                    try:
-                        product_obj = stripe.Product.retrieve(price_product_id)
-                        product_dict = rename_id_field(product_obj.to_dict(), "product")
-                        # フラット化して item_dict に統合
-                        flat_product = flatten_json(product_dict, parent_key='product')
-                        item_dict.update(flat_product)
-                    except stripe.error.StripeError as e:
-                        logger.error(f"Stripe API error for product ID {price_product_id}: {str(e)}")
-                        raise HTTPException(status_code=400, detail=f"Stripe API error for product ID {price_product_id}: {str(e)}")
-                    except Exception as e:
-                        logger.error(f"Unexpected error during search for product ID {price_product_id}: {str(e)}")
-                        raise HTTPException(status_code=500, detail=f"Unexpected error during search for product ID {price_product_id}: {str(e)}")
 
-                flat_item = flatten_json(item_dict)
-                results.append(flat_item)
+export_job_store = ExportJobStore(JOBS_DIR)
+export_job_threads: Dict[str, threading.Thread] = {}
+export_job_threads_lock = threading.Lock()
+# このプロセスを表すリースの持ち主
+EXPORT_JOB_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
 
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
-        except Exception as e:
-            logger.error(f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
 
-    return {"records": results}
+def enumerate_export_ids(api_key: str, kind: str) -> List[str]:
+    """
+    アカウント全体が対象のジョブについて、処理単位となるIDを列挙する。
+    """
+    if kind == "fulldata":
+        return [customer["id"] for customer in iter_list(api_key, stripe.Customer, {})]
+    return [subscription["id"] for subscription in list_all_subscriptions(api_key)]
 
 
-# 顧客のメールアドレスで顧客情報を検索
-def search_customers_by_email(api_key: str, email_addresses: List[str]):
-    stripe.api_key = api_key
-    results = []
+def export_records_for_id(api_key: str, kind: str, object_id: str) -> List[dict]:
+    if kind == "fulldata":
+        return search_subscriptions_fulldata_by_customer_ids(api_key, [object_id])["records"]
+    return get_invoices_by_subscription_id(api_key, [object_id])["records"]
 
-    for email in email_addresses:
-        try:
-            # 顧客を検索 (listオブジェクト)
-            customers_response = stripe.Customer.list(email=email)
-            # auto_paging_iter() または .data いずれかでループ可
-            for customer in customers_response.auto_paging_iter():
-                customer_dict = rename_id_field(customer.to_dict(), "customer")
-                flat_customer = flatten_json(customer_dict)
-                results.append(flat_customer)
 
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe API error for email {email}: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Stripe API error for {email}: {str(e)}")
-        except Exception as e:
-            logger.error(f"Unexpected error during search for {email}: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Unexpected error during search for {email}: {str(e)}")
+def run_export_job(job_id: str, api_key: str) -> None:
+    """
+    ジョブのリースを取得し、処理済みのIDの次から再開して、IDごとに結果を追記して進捗をチェックポイントする。
+    実行中は別スレッドでリースを延長し、リースを失った（別のプロセスが引き継いだ）場合は結果を書かずに終了する。
+    Stripe のレート制限（429）に当たった場合は指数バックオフで同じIDを再試行する。
+    """
+    try:
+        job = export_job_store.acquire_lease(job_id, EXPORT_JOB_WORKER_ID, JOB_LEASE_SECONDS)
+        if job is None:
+            logger.info(f"Export job {job_id} is finished or leased by another worker")
+            return
 
-    return {"records": results}
+        job_lock = threading.Lock()
+        stop_heartbeat = threading.Event()
 
+        def checkpoint():
+            with job_lock:
+                export_job_store.save_leased(job, EXPORT_JOB_WORKER_ID, JOB_LEASE_SECONDS)
 
-# 顧客IDでサブスクリプション情報を検索
-def search_subscriptions_by_customer_ids(api_key: str, cus_ids: List[str]):
-    stripe.api_key = api_key
-    results = []
+        def heartbeat():
+            while not stop_heartbeat.wait(max(JOB_LEASE_SECONDS / 3, 1)):
+                try:
+                    checkpoint()
+                except ExportJobLeaseLost:
+                    return
+                except Exception as e:
+                    logger.warning(f"Failed to renew lease of export job {job_id}: {str(e)}")
 
-    for cus_id in cus_ids:
+        threading.Thread(target=heartbeat, daemon=True).start()
         try:
-            # サブスクリプションを取得 (listオブジェクト)
-            subs_response = stripe.Subscription.list(customer=cus_id)
-            # auto_paging_iter でループしながら取得
-            for subscription in subs_response.auto_paging_iter():
-                subscription_dict = rename_id_field(subscription.to_dict(), "subscription")
+            run_leased_export_job(job, api_key, job_lock, checkpoint)
+        finally:
+            stop_heartbeat.set()
+    except ExportJobLeaseLost:
+        logger.warning(f"Export job {job_id} lost its lease to another worker, stopping")
+    finally:
+        with export_job_threads_lock:
+            export_job_threads.pop(job_id, None)
+
+
+def run_leased_export_job(job: dict, api_key: str, job_lock: threading.Lock, checkpoint: Callable[[], None]) -> None:
+    job_id = job["job_id"]
+    # 1件のIDで呼ぶStripe APIの回数は種別や件数で変わるため、IDではなく呼び出しごとにトークンを取る
+    stripe_call_governor.set(RateGovernor(JOB_MAX_REQUESTS_PER_SECOND))
+    try:
+        with job_lock:
+            job["status"] = "running"
+            job["error"] = None
+        checkpoint()
+
+        ids = export_job_store.load_ids(job_id)
+        if ids is None:
+            ids = enumerate_export_ids(api_key, job["kind"])
+            export_job_store.save_ids(job_id, ids)
+            with job_lock:
+                job["total"] = len(ids)
+            checkpoint()
+
+        results_path = export_job_store.results_path(job_id)
+        with open(results_path, "ab") as f:
+            f.truncate(job["results_bytes"])
+
+        for object_id in ids[job["done"]:]:
+            for attempt in range(6):
+                try:
+                    records = export_records_for_id(api_key, job["kind"], object_id)
+                    break
+                except HTTPException as e:
+                    context = e.__context__
+                    if attempt < 5 and isinstance(context, stripe.error.RateLimitError):
+                        time.sleep(2 ** attempt)
+                        continue
+                    raise
+
+            # 追記の直前にリースを確認し、引き継がれていれば結果ファイルに触れない
+            checkpoint()
+            with open(results_path, "ab") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+                results_bytes = f.tell()
+            with job_lock:
+                job["results_bytes"] = results_bytes
+                job["done"] += 1
+                job["records"] += len(records)
+            checkpoint()
+
+        with job_lock:
+            job["status"] = "completed"
+        checkpoint()
+        logger.info(f"Export job {job_id} completed: {job['records']} records")
+    except ExportJobLeaseLost:
+        raise
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Export job {job_id} failed at {job['done']}/{job['total']}: {detail}")
+        with job_lock:
+            job["status"] = "failed"
+            job["error"] = detail
+        checkpoint()
 
-                # item_names (例) を作る
-                item_names = []
-                for item in subscription.items.data:
-                    product_id = item["price"]["product"]
-                    try:
-                        product_obj = stripe.Product.retrieve(product_id)
-                        item_names.append(product_obj["name"])
-                    except stripe.error.StripeError as e:
-                        logger.error(f"Stripe API error for product ID {product_id}: {str(e)}")
-                        raise HTTPException(status_code=400, detail=f"Stripe API error for product ID {product_id}: {str(e)}")
-                    except Exception as e:
-                        logger.error(f"Unexpected error during search for product ID {product_id}: {str(e)}")
-                        raise HTTPException(status_code=500, detail=f"Unexpected error during search for product ID {product_id}: {str(e)}")
 
-                subscription_dict["subscription_item_names"] = " ".join(item_names)
-                flat_subscription = flatten_json(subscription_dict)
-                results.append(flat_subscription)
+def start_export_job(job_id: str, api_key: str) -> None:
+    with export_job_threads_lock:
+        thread = export_job_threads.get(job_id)
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(target=run_export_job, args=(job_id, api_key), daemon=True)
+        export_job_threads[job_id] = thread
+        thread.start()
 
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe API error for customer ID {cus_id}: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Stripe API error for customer ID {cus_id}: {str(e)}")
-        except Exception as e:
-            logger.error(f"Unexpected error during search for customer ID {cus_id}: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Unexpected error during search for customer ID {cus_id}: {str(e)}")
 
-    return {"records": results}
+def load_export_job(job_id: str, api_key: str) -> dict:
+    """
+    ジョブを読み込む。別アカウントのAPIキーでは存在しないものとして扱う。
+    """
+    job = export_job_store.load(job_id)
+    if job is None or job["account"] != account_key(api_key):
+        raise HTTPException(status_code=404, detail=f"Export job {job_id} not found")
+    return job
 
 
-# サブスクリプションIDからサブスクリプション情報を検索
-def search_subscriptions_by_ids(api_key: str, subscription_ids: List[str]):
-    stripe.api_key = api_key
-    results = []
-    for sub_id in subscription_ids:
-        try:
-            subscription = stripe.Subscription.retrieve(sub_id)
-            subscription_dict = rename_id_field(subscription.to_dict(), "subscription")
-            flat_subscription = flatten_json(subscription_dict)
-            results.append(flat_subscription)
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe API error for subscription ID {sub_id}: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription ID {sub_id}: {str(e)}")
-        except Exception as e:
-            logger.error(f"Unexpected error during search for subscription ID {sub_id}: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Unexpected error during search for subscription ID {sub_id}: {str(e)}")
-    return {"records": results}
+def export_job_status(job: dict) -> dict:
+    return {
+        "job_id": job["job_id"],
+        "kind": job["kind"],
+        "scope": job["scope"],
+        "status": job["status"],
+        "total": job["total"],
+        "done": job["done"],
+        "records": job["records"],
+        "error": job["error"],
+        "results": f"/jobs/{job['job_id']}/results",
+    }
 
 
-# サブスクリプションIDに連なる請求(Charge)を取得
-def search_charges_by_subscription(api_key: str, subscription_ids: List[str]):
-    stripe.api_key = api_key
-    results = []
-    for subscription_id in subscription_ids:
-        try:
-            invoices = stripe.Invoice.list(subscription=subscription_id)
-            for inv in invoices.auto_paging_iter():
-                inv_dict = rename_id_field(inv.to_dict(), "invoice")
-                charges = stripe.Charge.list(invoice=inv_dict.get("inv_id"))
+# ============ 変更フィード（Events API） ============
 
-                # chargesも listオブジェクト
-                for ch in charges.auto_paging_iter():
-                    charge_dict = rename_id_field(ch.to_dict(), "charge")
-                    flat_charge = flatten_json(charge_dict)
-                    results.append(flat_charge)
+# このAPIで扱うオブジェクト種別（これ以外のイベントは変更フィードに含めない）
+CHANGE_FEED_OBJECT_TYPES = ("customer", "subscription", "invoice", "charge", "product", "price")
 
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
-        except Exception as e:
-            logger.error(f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
 
-    return {"records": results}
+def charge_invoice_refs(account: str, charge: dict) -> dict:
+    """
+    変更された請求が属するインボイスとサブスクリプションのID（{"invoice", "subscription"}、分からなければ None）。
+    古いAPIバージョンでは請求の invoice を、新しいAPIバージョンでは list_invoice_charges が保存した
+    PaymentIntent からインボイスへの対応を使う（Stripe には問い合わせない）。
+    """
+    if isinstance(charge.get("invoice"), str):
+        return {"invoice": charge["invoice"], "subscription": None}
+    payment_intent = charge.get("payment_intent")
+    refs = object_store.get(account, f"idx_payment_intent_{payment_intent}") if isinstance(payment_intent, str) else None
+    return refs or {"invoice": None, "subscription": None}
 
 
-# サブスクリプションIDに連なるインボイスを取得
-def get_invoices_by_subscription_id(api_key: str, subscription_ids: List[str]):
-    stripe.api_key = api_key
-    results = []
-    for subscription_id in subscription_ids:
-        try:
-            invoices = stripe.Invoice.list(subscription=subscription_id)
-            for inv in invoices.auto_paging_iter():
-                inv_dict = rename_id_field(inv.to_dict(), "invoice")
-                flattened_invoices = flatten_json(inv_dict)
-                results.append(flattened_invoices)
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Stripe API error for subscription ID {subscription_id}: {str(e)}")
-        except Exception as e:
-            logger.error(f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Unexpected error during search for subscription ID {subscription_id}: {str(e)}")
-    return {"records": results}
+def invalidate_caches_for_object(account: str, object_type: str, obj: dict, deleted: bool = False) -> None:
+    """
+    Stripe上で変更されたオブジェクトに関係するローカルキャッシュを破棄する（顧客ミラーには変更を反映する）。
+    """
+    object_id = obj.get("id")
+    email = obj.get("email")
+    related_ids = [object_id, email, email.lower() if isinstance(email, str) else None]
+    for field in ("customer", "subscription", "invoice"):
+        if isinstance(obj.get(field), str):
+            related_ids.append(obj[field])
+    if object_type == "invoice":
+        related_ids.append(invoice_subscription_id(obj))
+    charge_refs = charge_invoice_refs(account, obj) if object_type == "charge" else {}
+    related_ids.extend(charge_refs.values())
+    related_ids = [id_ for id_ in related_ids if id_]
+
+    if object_type in ("product", "price"):
+        # 商品・価格はどのサブスクリプションの結果に含まれるか分からないため、アカウント単位で破棄する
+        response_cache.invalidate(account)
+        upcoming_cache.invalidate(account)
+    else:
+        response_cache.invalidate(account, related_ids)
+        # 請求明細（invoiceitem）の追加などはフィンガープリントに現れないため、顧客・サブスクリプション単位で破棄する
+        upcoming_cache.invalidate(account, related_ids)
+
+    if object_id:
+        object_store.delete(account, object_id)
+        negative_cache.discard(account, object_type, object_id)
+    if object_type == "invoice":
+        object_store.delete(account, f"idx_charges_{object_id}")
+        subscription_id = invoice_subscription_id(obj)
+        if subscription_id:
+            object_store.delete(account, f"idx_invoices_{subscription_id}")
+    elif object_type == "charge" and charge_refs["invoice"]:
+        object_store.delete(account, f"idx_charges_{charge_refs['invoice']}")
+    elif object_type == "customer":
+        customer_mirror.apply_customer(account, obj, deleted=deleted)
+
+
+def get_changes(api_key: str, cursor: Optional[str], limit: int):
+    """
+    cursor（イベントID）より後に発生したイベントを stripe.Event.list で取得し、
+    このAPIで扱うオブジェクトの変更だけをフラット化して古い順に返す。
+    cursor を省略した場合は最新のイベントから返し、以後は返却された cursor を指定してポーリングする。
+    取得した変更に関係するローカルキャッシュはこの時点で破棄する。
+    """
+    account = account_key(api_key)
+    params = {"limit": limit, "api_key": api_key}
+    if cursor:
+        params["ending_before"] = cursor
 
+    try:
+        events = stripe.Event.list(**params)
+    except stripe.error.StripeError as e:
+        logger.error(f"Stripe API error for event cursor {cursor}: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Stripe API error for event cursor {cursor}: {str(e)}")
+
+    event_dicts = [event.to_dict() for event in events.data]
+    next_cursor = event_dicts[0]["id"] if event_dicts else cursor
 
-# 請求IDに連なるインボイスを取得
-def get_invoice_by_charge_id(api_key: str, charge_ids: List[str]):
-    stripe.api_key = api_key
     results = []
-    for charge_id in charge_ids:
-        try:
-            charge_obj = stripe.Charge.retrieve(charge_id)
-            charge_dict = rename_id_field(charge_obj.to_dict(), "charge")
+    for event in reversed(event_dicts):
+        obj = event.get("data", {}).get("object", {})
+        object_type = obj.get("object")
+        if object_type not in CHANGE_FEED_OBJECT_TYPES:
+            continue
 
-            if 'invoice' in charge_dict:
-                invoice_id = charge_dict['invoice']
-                invoice_obj = stripe.Invoice.retrieve(invoice_id)
-                inv_dict = rename_id_field(invoice_obj.to_dict(), "invoice")
-                flattened_invoice = flatten_json(inv_dict)
-                results.append(flattened_invoice)
+        invalidate_caches_for_object(account, object_type, obj, deleted=event.get("type") == f"{object_type}.deleted")
+        record = {
+            "event_id": event["id"],
+            "event_type": event.get("type"),
+            "event_created": format_jst(event["created"]),
+        }
+        record.update(flatten_json(rename_id_field(dict(obj), object_type)))
+        results.append(record)
 
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe API error for charge ID {charge_id}: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Stripe API error for charge ID {charge_id}: {str(e)}")
-        except Exception as e:
-            logger.error(f"Unexpected error during search for charge ID {charge_id}: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Unexpected error during search for charge ID {charge_id}: {str(e)}")
-    return {"records": results}
+    return {"records": results, "cursor": next_cursor, "has_more": bool(events.has_more)}
+
+
+# ============ レスポンス圧縮 ============
+
+COMPRESSIBLE_MEDIA_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+
+def choose_content_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Accept-Encoding（q値付き）から使用する圧縮方式を選ぶ。brotli はライブラリがある場合のみ候補にする。
+    """
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            weights[coding.strip()] = q
+
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best = None
+    best_q = 0.0
+    for coding in candidates:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        # brotli の quality は 0〜11 なので、gzip と同じ 1〜9 の設定値をそのまま使う
+        return brotli.compress(body, quality=COMPRESSION_LEVEL)
+    # mtime=0 にして、同じ本文からは常に同じバイト列（＝同じETag）になるようにする
+    return gzip.compress(body, compresslevel=COMPRESSION_LEVEL, mtime=0)
+
+
+@app.middleware("http")
+async def compress_response(request: Request, call_next):
+    """
+    Accept-Encoding に応じて JSON / NDJSON のレスポンスを gzip（または brotli）で圧縮する。
+    フラット化したレコードは長いキー名の繰り返しが多く、圧縮で大幅に小さくなるため
+    API Gateway / Lambda のレスポンスサイズ上限に達しにくくなる。
+    """
+    response = await call_next(request)
+    encoding = choose_content_encoding(request.headers.get("accept-encoding", ""))
+    if response.status_code == 304:
+        # 304 には、クライアントが保持している圧縮版のETagをそのまま返す
+        etag = response.headers.get("etag", "")
+        encoded_etag = f'{etag[:-1]}-{encoding}"'
+        if encoding is not None and etag.endswith('"') and encoded_etag in request.headers.get("if-none-match", ""):
+            response.headers["ETag"] = encoded_etag
+        response.headers.add_vary_header("Accept-Encoding")
+        return response
+    if (
+        response.status_code < 200
+        or response.status_code == 204
+        or "content-encoding" in response.headers
+        or not response.headers.get("content-type", "").startswith(COMPRESSIBLE_MEDIA_TYPES)
+    ):
+        return response
+    if encoding is None:
+        # 圧縮しない場合も、Accept-Encoding によって表現が変わることを共有キャッシュに伝える
+        response.headers.add_vary_header("Accept-Encoding")
+        return response
+
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    headers = MutableHeaders(raw=[(k, v) for k, v in response.raw_headers if k != b"content-length"])
+    if len(body) >= COMPRESSION_MIN_SIZE:
+        body = await run_in_threadpool(compress_body, body, encoding)
+        headers["Content-Encoding"] = encoding
+        etag = headers.get("etag")
+        if etag and etag.endswith('"'):
+            # 圧縮後の表現は別物なので、弱いETagにせず接尾辞で区別する（If-None-Match では取り除いて比較）
+            headers["ETag"] = f'{etag[:-1]}-{encoding}"'
+    headers.add_vary_header("Accept-Encoding")
+    return Response(content=body, status_code=response.status_code, headers=headers)
+
+
+# ============ Stripe呼び出しの記録 ============
+
+@app.middleware("http")
+async def record_list_stats(request: Request, call_next):
+    """
+    リクエスト中にStripeの一覧APIから取得したページ数・オブジェクト数を数え、
+    X-Stripe-List-Pages / X-Stripe-List-Objects ヘッダーで返す（キャッシュヒット時は0）。
+    省いた呼び出しは X-Stripe-Skipped-Calls に件数を返し、内訳（呼び出し:理由）をログに出す。
+    """
+    stats = {"pages": 0, "objects": 0, "skipped": {}, "stale_since": None, "stale_error": False}
+    token = list_stats.set(stats)
+    try:
+        response = await call_next(request)
+    finally:
+        list_stats.reset(token)
+    if stats["pages"]:
+        logger.info(f"{request.url.path} fetched {stats['pages']} list pages ({stats['objects']} objects)")
+    response.headers["X-Stripe-List-Pages"] = str(stats["pages"])
+    response.headers["X-Stripe-List-Objects"] = str(stats["objects"])
+    skipped = sum(stats["skipped"].values())
+    if skipped:
+        breakdown = ", ".join(f"{key}={count}" for key, count in sorted(stats["skipped"].items()))
+        logger.info(f"{request.url.path} skipped {skipped} Stripe calls ({breakdown})")
+    response.headers["X-Stripe-Skipped-Calls"] = str(skipped)
+    return response
 
 
 # ============ FastAPIのエンドポイント定義 ============
 
 @app.get("/search_customers")
 def get_customers(
+    request: Request,
     api_key: str = Query(..., description="Stripe API key"),
-    email_addresses: Optional[str] = Query(None, description="Comma separated list of email addresses")
+    email_addresses: Optional[str] = Query(None, description="Comma separated list of email addresses"),
+    consistency: str = Query("eventual", description="'strong' bypasses the local customer mirror and caches and reads from Stripe"),
+    time_format: str = Query("jst", description="jst: 'YYYY/MM/DD HH:MM:SS' in JST, iso: ISO 8601 (+09:00), epoch: UNIX seconds")
 ):
     try:
         if email_addresses is None or email_addresses.strip() == "":
             email_list = ["hori@revol.co.jp"]
         else:
-            email_list = [email.strip() for email in email_addresses.split(',')]
+            email_list = normalize_ids(email_addresses.split(','))
 
-        validated_request = SearchRequest(api_key=api_key, email_addresses=email_list)
-        customers = search_customers_by_email(validated_request.api_key, validated_request.email_addresses)
-        return customers
+        validated_request = SearchRequest(
+            api_key=api_key, email_addresses=email_list, consistency=consistency, time_format=time_format
+        )
+        # 顧客ミラーから返す場合は大文字・小文字を区別せずに検索するため、キャッシュキーも小文字にそろえる
+        # （Stripe の Customer.list の email は大文字・小文字を区別するため、そのときは入力のまま）
+        cache_ids = validated_request.email_addresses
+        if validated_request.consistency != "strong" and customer_mirror.is_synced(account_key(validated_request.api_key)):
+            cache_ids = [email.lower() for email in cache_ids]
+        return cached_json_response(
+            request, "/search_customers", validated_request.api_key, cache_ids,
+            lambda: search_customers_by_email(
+                validated_request.api_key,
+                validated_request.email_addresses,
+                validated_request.consistency,
+                validated_request.time_format,
+            ),
+            params={"consistency": validated_request.consistency, "time_format": validated_request.time_format},
+            bypass=validated_request.consistency == "strong",
+        )
 
     except ValidationError as e:
         logger.error(f"Validation error: {str(e)}")
@@ -333,18 +3340,29 @@ def get_customers(
 
 @app.get("/search_subscriptions")
 def get_subscriptions(
+    request: Request,
     api_key: str = Query(..., description="Stripe API key"),
-    cus_ids: Optional[str] = Query(None, description="Comma separated list of customer IDs")
+    cus_ids: Optional[str] = Query(None, description="Comma separated list of customer IDs"),
+    format: str = Query("json", description="json, columnar ({columns, rows}), arrow (Arrow IPC stream) or parquet"),
+    time_format: str = Query("jst", description="jst: 'YYYY/MM/DD HH:MM:SS' in JST, iso: ISO 8601 (+09:00), epoch: UNIX seconds"),
+    partial: bool = Query(False, description="Skip IDs that do not exist in Stripe and list them in missing_ids instead of failing with 400"),
 ):
     try:
         if cus_ids is None or cus_ids.strip() == "":
             cus_id_list = ["cus_PCvnk7s61noGQW"]
         else:
-            cus_id_list = [cus_id.strip() for cus_id in cus_ids.split(',')]
-
-        validated_request = SubscriptionSearchRequest(api_key=api_key, cus_ids=cus_id_list)
-        subscriptions = search_subscriptions_by_customer_ids(validated_request.api_key, validated_request.cus_ids)
-        return subscriptions
+            cus_id_list = normalize_ids(cus_ids.split(','))
+
+        validated_request = SubscriptionSearchRequest(api_key=api_key, cus_ids=cus_id_list, format=format, time_format=time_format)
+        return records_response(
+            request, "/search_subscriptions", validated_request.api_key, validated_request.cus_ids,
+            lambda time_format: search_subscriptions_by_customer_ids(
+                validated_request.api_key, validated_request.cus_ids, time_format, partial=partial
+            ),
+            validated_request.format,
+            params={"partial": partial},
+            time_format=validated_request.time_format,
+        )
 
     except ValidationError as e:
         logger.error(f"Validation error: {str(e)}")
@@ -356,132 +3374,221 @@ def get_subscriptions(
         raise HTTPException(status_code=500, detail="Internal server error. Please try again later.")
 
 
-def search_subscriptions_fulldata_by_customer_ids(api_key: str, cus_ids: List[str]):
+# フルデータ検索で include により選べるセクション
+FULLDATA_SECTIONS = ("items", "upcoming", "invoices")
+# 次回インボイスが存在しない（Invoice.upcoming が必ず失敗する）サブスクリプションの状態
+NO_UPCOMING_INVOICE_STATUSES = frozenset({"canceled", "incomplete_expired"})
+
+
+def add_fulldata_entities(tables: EntityTables, subscription_dict: dict, time_format: str = "jst") -> None:
+    """
+    フルデータ検索の1サブスクリプション分を、subscriptions / items / invoices テーブルに分解して追加する。
+    商品・価格は取得時に products / prices テーブルへ追加済みのため、アイテムからは prod_id / price_id で参照する。
+    """
+    items_expanded = subscription_dict.pop("items_expanded", [])
+    invoices = subscription_dict.pop("invoices", [])
+    subscription_dict.pop("items", None)
+    subscription_dict.pop("plan", None)
+    sub_id = subscription_dict["sub_id"]
+    tables.add("subscriptions", sub_id, flatten_json(subscription_dict, time_format=time_format))
+
+    for item_dict in items_expanded:
+        item_dict.pop("plan", None)
+        price = item_dict.pop("price", None) or {}
+        for key in ("product_name", "price_nickname", "price_unit_amount", "price_currency"):
+            item_dict.pop(key, None)
+        item_row = flatten_json(item_dict, time_format=time_format)
+        item_row["subscription"] = sub_id
+        item_row["price_id"] = price.get("id")
+        item_row["prod_id"] = price.get("product")
+        tables.add("items", item_row["si_id"], item_row)
+
+    for invoice in invoices:
+        tables.add("invoices", invoice["inv_id"], dict(invoice, subscription=sub_id))
+
+
+def search_subscriptions_fulldata_by_customer_ids(
+    api_key: str,
+    cus_ids: List[str],
+    since: Optional[int] = None,
+    shape: str = "rows",
+    time_format: str = "jst",
+    include: Optional[List[str]] = None,
+    partial: bool = False,
+):
     """
     顧客IDからサブスクリプションを取得し、以下の追加情報を取得して返す:
       - 各SubscriptionItem の Product名, Price名 等
       - 次回のインボイス (upcoming invoice)
-      - これまで発行されたインボイス一覧
+      - これまで発行されたインボイス一覧（since 指定時はそれより後に作成されたもののみ）
       - 必要に応じて計算（例: 税額など）
+    shape="normalized" の場合は subscriptions / items / prices / products / invoices のテーブルで返す。
+    include で取得するセクション（items / upcoming / invoices）を絞ると、含めないセクションのStripe呼び出しを省く。
+    解約済みなど次回インボイスが存在しない状態のサブスクリプションでは upcoming を呼ばない。
+    省いた呼び出しは record_skipped_call で記録する。
     """
-    stripe.api_key = api_key
+    include = set(include if include is not None else FULLDATA_SECTIONS)
     results = []
+    missing_ids = [] if partial else None
+    tables = EntityTables(("subscriptions", "items", "prices", "products", "invoices")) if shape == "normalized" else None
+
+    # 同じ呼び出しの中で同じ商品・価格を取り直さないための控え
+    catalog = {}
+
+    # items を含めない場合に、取得を省いた商品・価格（同じIDは1回だけ数える）
+    skipped_catalog = set()
+
+    def fetch_catalog_object(resource, object_id):
+        key = (resource.OBJECT_NAME, object_id)
+        if key not in catalog:
+            catalog[key] = retrieve_object(api_key, resource, object_id).to_dict()
+        return catalog[key]
 
     for cus_id in cus_ids:
         try:
-            # 全サブスクリプション
-            subs_response = stripe.Subscription.list(customer=cus_id)
-            for subscription in subs_response.auto_paging_iter():
-                subscription_dict = rename_id_field(subscription.to_dict(), "subscription")
+            # 全サブスクリプション（全ページを100件ずつ取得）
+            for subscription in iter_list(api_key, stripe.Subscription, {"customer": cus_id}):
+                observe_subscriptions(api_key, [subscription])
+                subscription_id = subscription["id"]
+                subscription_dict = rename_id_field(dict(subscription), "subscription")
 
-                # SubscriptionItemごとに詳細取得
+                status = subscription.get("status")
+
+                # SubscriptionItemごとに詳細取得（items の中身は書き換えないようコピーする）
                 items_expanded = []
-                for item in subscription.items.data:
-                    item_dict = rename_id_field(item.to_dict(), "subscription_item")
+                items_data = subscription["items"]["data"]
+                if "items" not in include:
+                    for item in items_data:
+                        price = item.get("price") or {}
+                        for key in (("product", price.get("product")), ("price", price.get("id"))):
+                            if key[1] and key not in skipped_catalog:
+                                skipped_catalog.add(key)
+                                record_skipped_call(f"{key[0]}_retrieve", "excluded")
+                    items_data = []
+                for item in items_data:
+                    item_dict = rename_id_field(dict(item), "subscription_item")
 
                     price_id = item_dict.get("price", {}).get("id")
                     product_id = item_dict.get("price", {}).get("product")
 
                     if product_id:
                         try:
-                            product_obj = stripe.Product.retrieve(product_id)
-                            product_dict = rename_id_field(product_obj.to_dict(), "product")
+                            product_dict = fetch_catalog_object(stripe.Product, product_id)
                             item_dict["product_name"] = product_dict.get("name", "Unnamed Product")
+                            if tables is not None:
+                                tables.add("products", product_id, flatten_json(rename_id_field(dict(product_dict), "product"), time_format=time_format))
                         except Exception as e:
                             logger.error(f"Error retrieving product {product_id}: {str(e)}")
                             item_dict["product_name"] = f"Error retrieving product {product_id}"
 
                     if price_id:
                         try:
-                            price_obj = stripe.Price.retrieve(price_id)
+                            price_obj = fetch_catalog_object(stripe.Price, price_id)
                             item_dict["price_nickname"] = price_obj.get("nickname")
                             item_dict["price_unit_amount"] = price_obj.get("unit_amount")
                             item_dict["price_currency"] = price_obj.get("currency")
+                            if tables is not None:
+                                tables.add("prices", price_id, flatten_json(rename_id_field(dict(price_obj), "price"), time_format=time_format))
                         except Exception as e:
                             logger.error(f"Error retrieving price {price_id}: {str(e)}")
                             item_dict["price_nickname"] = None
 
                     items_expanded.append(item_dict)
 
-                subscription_dict["items_expanded"] = items_expanded
+                if "items" in include:
+                    subscription_dict["items_expanded"] = items_expanded
 
-                # 次回インボイス(プレビュー)
-                try:
-                    upcoming_invoice = stripe.Invoice.upcoming(subscription=subscription.id)
+                # 次回インボイス(プレビュー)。終了したサブスクリプションでは必ず失敗するため呼ばない
+                if "upcoming" not in include:
+                    record_skipped_call("upcoming_invoice", "excluded")
+                elif status in NO_UPCOMING_INVOICE_STATUSES:
+                    record_skipped_call("upcoming_invoice", status)
+                    subscription_dict["next_invoice_preview"] = None
+                else:
+                    # 請求状態が変わっていなければキャッシュしたプレビューを使う
+                    upcoming_invoice = get_upcoming_invoice(api_key, subscription)
                     if upcoming_invoice:
                         subscription_dict["next_invoice_preview"] = {
                             "amount_due": upcoming_invoice.get("amount_due"),
                             "currency": upcoming_invoice.get("currency"),
-                            "next_invoice_date": datetime.fromtimestamp(
-                                upcoming_invoice.get("due_date", 0), tz=timezone.utc
-                            ).astimezone(JST).strftime('%Y/%m/%d %H:%M:%S') if upcoming_invoice.get("due_date") else None,
+                            "next_invoice_date": format_timestamp(
+                                upcoming_invoice.get("due_date"), time_format
+                            ) if upcoming_invoice.get("due_date") else None,
                             "lines": []
                         }
-                        for line in upcoming_invoice.lines:
-                            subscription_dict["next_invoice_preview"]["lines"].append({
-                                "description": line.get("description"),
-                                "amount": line.get("amount"),
-                                "quantity": line.get("quantity"),
-                                "price_id": line.get("price", {}).get("id"),
-                            })
-                except stripe.error.InvalidRequestError:
-                    subscription_dict["next_invoice_preview"] = None
+                        for line in upcoming_invoice["lines"]:
+                            subscription_dict["next_invoice_preview"]["lines"].append(dict(line))
+                    else:
+                        subscription_dict["next_invoice_preview"] = None
 
                 # これまでのインボイス
-                invoices_data = []
-                try:
-                    inv_response = stripe.Invoice.list(subscription=subscription.id)
-                    for inv in inv_response.auto_paging_iter():
-                        inv_dict = rename_id_field(inv.to_dict(), "invoice")
-                        invoices_data.append({
-                            "inv_id": inv_dict["inv_id"],
-                            "status": inv_dict.get("status"),
-                            "amount_paid": inv_dict.get("amount_paid"),
-                            "amount_due": inv_dict.get("amount_due"),
-                            "currency": inv_dict.get("currency"),
-                            "created_at": datetime.fromtimestamp(
-                                inv.created, tz=timezone.utc
-                            ).astimezone(JST).strftime('%Y/%m/%d %H:%M:%S')
-                        })
-                except Exception as e:
-                    logger.error(f"Error retrieving invoices for subscription {subscription.id}: {str(e)}")
+                if "invoices" not in include:
+                    record_skipped_call("invoice_list", "excluded")
+                else:
+                    invoices_data = []
+                    try:
+                        for inv in list_subscription_invoices(api_key, subscription_id, since):
+                            inv_dict = rename_id_field(inv, "invoice")
+                            invoices_data.append({
+                                "inv_id": inv_dict["inv_id"],
+                                "status": inv_dict.get("status"),
+                                "amount_paid": inv_dict.get("amount_paid"),
+                                "amount_due": inv_dict.get("amount_due"),
+                                "currency": inv_dict.get("currency"),
+                                "created_at": format_timestamp(inv_dict["created"], time_format)
+                            })
+                    except Exception as e:
+                        logger.error(f"Error retrieving invoices for subscription {subscription_id}: {str(e)}")
 
-                subscription_dict["invoices"] = invoices_data
+                    subscription_dict["invoices"] = invoices_data
 
-                # 簡易計算（例: 合計金額+10%税）
-                try:
-                    monthly_total = 0
-                    for item_e in items_expanded:
-                        if item_e.get("price_unit_amount") is not None and isinstance(item_e.get("quantity"), int):
-                            monthly_total += item_e["price_unit_amount"] * item_e["quantity"]
-                    subscription_dict["calculated_monthly_total"] = monthly_total
-                    subscription_dict["calculated_monthly_tax"] = int(monthly_total * 0.1)
-                    subscription_dict["calculated_monthly_grand_total"] = (
-                        subscription_dict["calculated_monthly_total"] 
-                        + subscription_dict["calculated_monthly_tax"]
-                    )
-                except Exception as e:
-                    logger.error(f"Error calculating monthly total for subscription {subscription.id}: {str(e)}")
-                    subscription_dict["calculated_monthly_total"] = None
-                    subscription_dict["calculated_monthly_tax"] = None
-                    subscription_dict["calculated_monthly_grand_total"] = None
+                # 簡易計算（例: 合計金額+10%税）。items を含めない場合は計算しない
+                if "items" in include:
+                    try:
+                        monthly_total = 0
+                        for item_e in items_expanded:
+                            if item_e.get("price_unit_amount") is not None and isinstance(item_e.get("quantity"), int):
+                                monthly_total += item_e["price_unit_amount"] * item_e["quantity"]
+                        subscription_dict["calculated_monthly_total"] = monthly_total
+                        subscription_dict["calculated_monthly_tax"] = int(monthly_total * 0.1)
+                        subscription_dict["calculated_monthly_grand_total"] = (
+                            subscription_dict["calculated_monthly_total"] 
+                            + subscription_dict["calculated_monthly_tax"]
+                        )
+                    except Exception as e:
+                        logger.error(f"Error calculating monthly total for subscription {subscription_id}: {str(e)}")
+                        subscription_dict["calculated_monthly_total"] = None
+                        subscription_dict["calculated_monthly_tax"] = None
+                        subscription_dict["calculated_monthly_grand_total"] = None
 
-                results.append(subscription_dict)
+                if tables is not None:
+                    add_fulldata_entities(tables, subscription_dict, time_format)
+                else:
+                    results.append(subscription_dict)
 
         except stripe.error.StripeError as e:
+            if missing_ids is not None and is_resource_missing(e, cus_id):
+                missing_ids.append(cus_id)
+                continue
             logger.error(f"Stripe API error for customer ID {cus_id}: {str(e)}")
             raise HTTPException(status_code=400, detail=f"Stripe API error for customer ID {cus_id}: {str(e)}")
         except Exception as e:
             logger.error(f"Unexpected error during search for customer ID {cus_id}: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Unexpected error during search for customer ID {cus_id}: {str(e)}")
 
-    return {"records": results}
+    return add_missing_ids(tables.to_dict() if tables is not None else {"records": results}, missing_ids)
 
 
 @app.get("/search_subscriptions_fulldata")
 def get_subscriptions_fulldata(
+    request: Request,
     api_key: str = Query(..., description="Stripe API key"),
-    cus_ids: Optional[str] = Query(None, description="カンマ区切りの顧客IDリスト")
+    cus_ids: Optional[str] = Query(None, description="カンマ区切りの顧客IDリスト"),
+    since: Optional[int] = Query(None, ge=0, description="このUNIXタイムスタンプより後に作成されたインボイスだけを invoices に含める"),
+    shape: str = Query("rows", description="rows: サブスクリプションごとのレコード, normalized: エンティティごとのテーブル"),
+    time_format: str = Query("jst", description="jst: 'YYYY/MM/DD HH:MM:SS' in JST, iso: ISO 8601 (+09:00), epoch: UNIX seconds"),
+    include: Optional[str] = Query(None, description="取得するセクションのカンマ区切り（items, upcoming, invoices）。省略時はすべて"),
+    partial: bool = Query(False, description="Stripeに存在しない顧客IDは400にせず、missing_ids に列挙して残りを返す"),
 ):
     """
     顧客IDをもとにサブスクリプションを検索し、
@@ -496,12 +3603,34 @@ def get_subscriptions_fulldata(
         if not cus_ids or cus_ids.strip() == "":
             cus_id_list = ["cus_PCvnk7s61noGQW"]
         else:
-            cus_id_list = [c.strip() for c in cus_ids.split(",")]
+            cus_id_list = normalize_ids(cus_ids.split(","))
+
+        if not include or include.strip() == "":
+            include_list = list(FULLDATA_SECTIONS)
+        else:
+            include_list = normalize_ids(include.split(","))
 
-        validated_request = SubscriptionSearchRequest(api_key=api_key, cus_ids=cus_id_list)
-        return search_subscriptions_fulldata_by_customer_ids(
-            validated_request.api_key,
-            validated_request.cus_ids
+        validated_request = SubscriptionSearchRequest(
+            api_key=api_key, cus_ids=cus_id_list, shape=shape, time_format=time_format, include=include_list
+        )
+        return cached_json_response(
+            request, "/search_subscriptions_fulldata", validated_request.api_key, validated_request.cus_ids,
+            lambda: search_subscriptions_fulldata_by_customer_ids(
+                validated_request.api_key,
+                validated_request.cus_ids,
+                since,
+                validated_request.shape,
+                validated_request.time_format,
+                validated_request.include,
+                partial=partial,
+            ),
+            params={
+                "since": since,
+                "shape": validated_request.shape,
+                "time_format": validated_request.time_format,
+                "include": ",".join(sorted(validated_request.include)),
+                "partial": partial,
+            },
         )
 
     except ValidationError as e:
@@ -516,18 +3645,33 @@ def get_subscriptions_fulldata(
 
 @app.get("/search_subscription_items")
 def get_subscription_items(
+    request: Request,
     api_key: str = Query(..., description="Stripe API key"),
-    subscription_ids: Optional[str] = Query(None, description="Comma separated list of Subscription IDs")
+    subscription_ids: Optional[str] = Query(None, description="Comma separated list of Subscription IDs"),
+    shape: str = Query("rows", description="rows: one flattened record per item, normalized: de-duplicated entity tables"),
+    time_format: str = Query("jst", description="jst: 'YYYY/MM/DD HH:MM:SS' in JST, iso: ISO 8601 (+09:00), epoch: UNIX seconds"),
+    partial: bool = Query(False, description="Skip IDs that do not exist in Stripe and list them in missing_ids instead of failing with 400"),
 ):
     try:
         if subscription_ids is None or subscription_ids.strip() == "":
             subscription_id_list = ["sub_1OOVw0APdno01lSPQNcrQCSC"]
         else:
-            subscription_id_list = [sub_id.strip() for sub_id in subscription_ids.split(',')]
+            subscription_id_list = normalize_ids(subscription_ids.split(','))
 
-        validated_request = SubscriptionItemSearchRequest(api_key=api_key, subscription_ids=subscription_id_list)
-        subscription_items = search_subscription_items_by_id(validated_request.api_key, validated_request.subscription_ids)
-        return subscription_items
+        validated_request = SubscriptionItemSearchRequest(
+            api_key=api_key, subscription_ids=subscription_id_list, shape=shape, time_format=time_format
+        )
+        return cached_json_response(
+            request, "/search_subscription_items", validated_request.api_key, validated_request.subscription_ids,
+            lambda: search_subscription_items_by_id(
+                validated_request.api_key,
+                validated_request.subscription_ids,
+                validated_request.shape,
+                validated_request.time_format,
+                partial=partial,
+            ),
+            params={"shape": validated_request.shape, "time_format": validated_request.time_format, "partial": partial},
+        )
     except ValidationError as e:
         logger.error(f"Validation error: {str(e)}")
         raise HTTPException(status_code=422, detail=f"Validation error: {str(e)}")
@@ -540,18 +3684,36 @@ def get_subscription_items(
 
 @app.get("/search_subscriptions_by_id")
 def get_subscriptions_by_id(
+    request: Request,
     api_key: str = Query(..., description="Stripe API key"),
-    subscription_ids: Optional[str] = Query(None, description="Comma separated list of Subscription IDs")
+    subscription_ids: Optional[str] = Query(None, description="Comma separated list of Subscription IDs"),
+    format: str = Query("json", description="json, columnar ({columns, rows}), arrow (Arrow IPC stream) or parquet"),
+    time_format: str = Query("jst", description="jst: 'YYYY/MM/DD HH:MM:SS' in JST, iso: ISO 8601 (+09:00), epoch: UNIX seconds"),
+    explain: bool = Query(False, description="Return the chosen fetch strategy and the estimated number of Stripe calls without executing"),
+    partial: bool = Query(False, description="Skip IDs that do not exist in Stripe and list them in missing_ids instead of failing with 400"),
 ):
     try:
         if subscription_ids is None or subscription_ids.strip() == "":
             subscription_id_list = ["sub_1OOVw0APdno01lSPQNcrQCSC"]
         else:
-            subscription_id_list = [sub_id.strip() for sub_id in subscription_ids.split(',')]
+            subscription_id_list = normalize_ids(subscription_ids.split(','))
 
-        validated_request = SubscriptionDirectSearchRequest(api_key=api_key, subscription_ids=subscription_id_list)
-        subscriptions = search_subscriptions_by_ids(validated_request.api_key, validated_request.subscription_ids)
-        return subscriptions
+        validated_request = SubscriptionDirectSearchRequest(
+            api_key=api_key, subscription_ids=subscription_id_list, format=format, time_format=time_format
+        )
+        if explain:
+            return FastJSONResponse({
+                "plan": plan_subscriptions_by_ids(validated_request.api_key, validated_request.subscription_ids)
+            })
+        return records_response(
+            request, "/search_subscriptions_by_id", validated_request.api_key, validated_request.subscription_ids,
+            lambda time_format: search_subscriptions_by_ids(
+                validated_request.api_key, validated_request.subscription_ids, time_format, partial=partial
+            ),
+            validated_request.format,
+            params={"partial": partial},
+            time_format=validated_request.time_format,
+        )
     except ValidationError as e:
         logger.error(f"Validation error: {str(e)}")
         raise HTTPException(status_code=422, detail=f"Validation error: {str(e)}")
@@ -564,18 +3726,52 @@ def get_subscriptions_by_id(
 
 @app.get("/search_charges_by_subscription")
 def get_charges(
+    request: Request,
     api_key: str = Query(..., description="Stripe API key"),
-    subscription_ids: Optional[str] = Query(None, description="Comma separated list of Subscription IDs")
+    subscription_ids: Optional[str] = Query(None, description="Comma separated list of Subscription IDs"),
+    limit: Optional[int] = Query(None, ge=1, le=100, description="Page size. When set, the response includes has_more and next_starting_after"),
+    starting_after: Optional[str] = Query(None, description="Cursor returned as next_starting_after by the previous page"),
+    shards: int = Query(1, ge=1, le=16, description="Split long histories into this many created-time windows and fetch them in parallel (ignored when limit is set)"),
+    format: str = Query("json", description="json, columnar ({columns, rows}), arrow (Arrow IPC stream) or parquet"),
+    time_format: str = Query("jst", description="jst: 'YYYY/MM/DD HH:MM:SS' in JST, iso: ISO 8601 (+09:00), epoch: UNIX seconds"),
+    partial: bool = Query(False, description="Skip IDs that do not exist in Stripe and list them in missing_ids instead of failing with 400 (ignored when limit is set)"),
 ):
     try:
         if subscription_ids is None or subscription_ids.strip() == "":
             subscription_id_list = ["sub_1OOVw0APdno01lSPQNcrQCSC"]
         else:
-            subscription_id_list = [sub_id.strip() for sub_id in subscription_ids.split(',')]
-
-        validated_request = ChargeSearchRequest(api_key=api_key, subscription_ids=subscription_id_list)
-        charges = search_charges_by_subscription(validated_request.api_key, validated_request.subscription_ids)
-        return charges
+            subscription_id_list = normalize_ids(subscription_ids.split(','))
+
+        if starting_after and limit is None:
+            limit = 100
+        validated_request = ChargeSearchRequest(
+            api_key=api_key,
+            subscription_ids=subscription_id_list,
+            limit=limit,
+            starting_after=starting_after,
+            shards=shards,
+            format=format,
+            time_format=time_format,
+        )
+        return records_response(
+            request, "/search_charges_by_subscription", validated_request.api_key, validated_request.subscription_ids,
+            lambda time_format: search_charges_by_subscription(
+                validated_request.api_key,
+                validated_request.subscription_ids,
+                time_format,
+                validated_request.limit,
+                validated_request.starting_after,
+                validated_request.shards,
+                partial=partial,
+            ),
+            validated_request.format,
+            params={
+                "limit": validated_request.limit,
+                "starting_after": validated_request.starting_after,
+                "partial": partial,
+            },
+            time_format=validated_request.time_format,
+        )
     except ValidationError as e:
         logger.error(f"Validation error: {str(e)}")
         raise HTTPException(status_code=422, detail=f"Validation error: {str(e)}")
@@ -588,18 +3784,72 @@ def get_charges(
 
 @app.get("/search_invoices_by_subscription")
 def get_invoices(
+    request: Request,
     api_key: str = Query(..., description="Stripe API key"),
-    subscription_ids: Optional[str] = Query(None, description="Comma separated list of Subscription IDs")
+    subscription_ids: Optional[str] = Query(None, description="Comma separated list of Subscription IDs"),
+    since: Optional[int] = Query(None, ge=0, description="Only return invoices created after this UNIX timestamp (use the previous response's watermark)"),
+    limit: Optional[int] = Query(None, ge=1, le=100, description="Page size. When set, the response includes has_more and next_starting_after"),
+    starting_after: Optional[str] = Query(None, description="Cursor returned as next_starting_after by the previous page"),
+    shards: int = Query(1, ge=1, le=16, description="Split long histories into this many created-time windows and fetch them in parallel (ignored when limit is set)"),
+    consistency: str = Query("eventual", description="'strong' reads each subscription with list calls instead of the batched Invoice Search API and bypasses caches"),
+    format: str = Query("json", description="json, columnar ({columns, rows}), arrow (Arrow IPC stream) or parquet"),
+    time_format: str = Query("jst", description="jst: 'YYYY/MM/DD HH:MM:SS' in JST, iso: ISO 8601 (+09:00), epoch: UNIX seconds"),
+    explain: bool = Query(False, description="Return the chosen fetch strategy and the estimated number of Stripe calls without executing"),
+    partial: bool = Query(False, description="Skip IDs that do not exist in Stripe and list them in missing_ids instead of failing with 400 (ignored when limit is set)"),
 ):
     try:
         if subscription_ids is None or subscription_ids.strip() == "":
             subscription_id_list = ["sub_1OOVw0APdno01lSPQNcrQCSC"]
         else:
-            subscription_id_list = [sub_id.strip() for sub_id in subscription_ids.split(',')]
-
-        validated_request = InvoiceSearchRequest(api_key=api_key, subscription_ids=subscription_id_list)
-        invoices = get_invoices_by_subscription_id(validated_request.api_key, validated_request.subscription_ids)
-        return invoices
+            subscription_id_list = normalize_ids(subscription_ids.split(','))
+
+        if starting_after and limit is None:
+            limit = 100
+        validated_request = InvoiceSearchRequest(
+            api_key=api_key,
+            subscription_ids=subscription_id_list,
+            limit=limit,
+            starting_after=starting_after,
+            shards=shards,
+            consistency=consistency,
+            format=format,
+            time_format=time_format,
+        )
+        if explain:
+            return FastJSONResponse({
+                "plan": plan_invoices_by_subscription(
+                    validated_request.api_key,
+                    validated_request.subscription_ids,
+                    since,
+                    validated_request.shards,
+                    validated_request.limit,
+                    validated_request.consistency,
+                )
+            })
+        return records_response(
+            request, "/search_invoices_by_subscription", validated_request.api_key, validated_request.subscription_ids,
+            lambda time_format: get_invoices_by_subscription_id(
+                validated_request.api_key,
+                validated_request.subscription_ids,
+                since,
+                time_format,
+                validated_request.limit,
+                validated_request.starting_after,
+                validated_request.shards,
+                validated_request.consistency,
+                partial=partial,
+            ),
+            validated_request.format,
+            params={
+                "since": since,
+                "limit": validated_request.limit,
+                "starting_after": validated_request.starting_after,
+                "consistency": validated_request.consistency,
+                "partial": partial,
+            },
+            time_format=validated_request.time_format,
+            bypass=validated_request.consistency == "strong",
+        )
     except ValidationError as e:
         logger.error(f"Validation error: {str(e)}")
         raise HTTPException(status_code=422, detail=f"Validation error: {str(e)}")
@@ -612,18 +3862,125 @@ def get_invoices(
 
 @app.get("/search_invoice_by_charge")
 def get_invoice(
+    request: Request,
     api_key: str = Query(..., description="Stripe API key"),
-    charge_ids: Optional[str] = Query(None, description="Comma separated list of Charge IDs")
+    charge_ids: Optional[str] = Query(None, description="Comma separated list of Charge IDs"),
+    format: str = Query("json", description="json, columnar ({columns, rows}), arrow (Arrow IPC stream) or parquet"),
+    time_format: str = Query("jst", description="jst: 'YYYY/MM/DD HH:MM:SS' in JST, iso: ISO 8601 (+09:00), epoch: UNIX seconds"),
+    explain: bool = Query(False, description="Return the chosen fetch strategy and the estimated number of Stripe calls without executing"),
+    partial: bool = Query(False, description="Skip IDs that do not exist in Stripe and list them in missing_ids instead of failing with 400"),
 ):
     try:
         if charge_ids is None or charge_ids.strip() == "":
             charge_id_list = ["ch_3QPcaNAPdno01lSP0ZhfiKYJ"]
         else:
-            charge_id_list = [charge_id.strip() for charge_id in charge_ids.split(',')]
+            charge_id_list = normalize_ids(charge_ids.split(','))
+
+        validated_request = ChargeInvoiceSearchRequest(api_key=api_key, charge_ids=charge_id_list, format=format, time_format=time_format)
+        if explain:
+            return FastJSONResponse({
+                "plan": plan_invoice_by_charge(validated_request.api_key, validated_request.charge_ids)
+            })
+        return records_response(
+            request, "/search_invoice_by_charge", validated_request.api_key, validated_request.charge_ids,
+            lambda time_format: get_invoice_by_charge_id(
+                validated_request.api_key, validated_request.charge_ids, time_format, partial=partial
+            ),
+            validated_request.format,
+            params={"partial": partial},
+            time_format=validated_request.time_format,
+        )
+    except ValidationError as e:
+        logger.error(f"Validation error: {str(e)}")
+        raise HTTPException(status_code=422, detail=f"Validation error: {str(e)}")
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Unexpected server error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error. Please try again later.")
+
+
+@app.get("/changes")
+def get_change_feed(
+    api_key: str = Query(..., description="Stripe API key"),
+    cursor: Optional[str] = Query(None, description="Event ID returned as cursor by the previous call"),
+    limit: int = Query(100, ge=1, le=100, description="Number of events to read from Stripe per call")
+):
+    """
+    Events API をもとに、顧客・サブスクリプション・インボイス・請求・商品・価格の変更を返す。
+    has_more が true の間は、返却された cursor を指定して続けて呼び出す。
+    """
+    try:
+        validated_request = ChangeFeedRequest(api_key=api_key, cursor=cursor, limit=limit)
+        return FastJSONResponse(
+            get_changes(validated_request.api_key, validated_request.cursor, validated_request.limit)
+        )
+    except ValidationError as e:
+        logger.error(f"Validation error: {str(e)}")
+        raise HTTPException(status_code=422, detail=f"Validation error: {str(e)}")
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Unexpected server error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error. Please try again later.")
+
+
+@app.post("/customer_mirror/sync")
+def sync_customer_mirror(
+    api_key: str = Query(..., description="Stripe API key")
+):
+    """
+    顧客ミラーを Customer.list の全件取得で作り直す（CUSTOMER_MIRROR_PATH の設定が必要）。
+    """
+    if not customer_mirror.enabled:
+        raise HTTPException(status_code=400, detail="Customer mirror is disabled. Set CUSTOMER_MIRROR_PATH to enable it.")
+    try:
+        result = customer_mirror.full_sync(api_key)
+        response_cache.invalidate(account_key(api_key))
+        return FastJSONResponse(result)
+    except stripe.error.StripeError as e:
+        logger.error(f"Stripe API error during customer mirror sync: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Stripe API error during customer mirror sync: {str(e)}")
+    except Exception as e:
+        logger.error(f"Unexpected server error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error. Please try again later.")
+
+
+@app.get("/customer_graph")
+def get_customer_graph(
+    request: Request,
+    api_key: str = Query(..., description="Stripe API key"),
+    email_addresses: Optional[str] = Query(None, description="Comma separated list of email addresses"),
+    cus_ids: Optional[str] = Query(None, description="Comma separated list of customer IDs"),
+    depth: int = Query(5, ge=1, le=5, description="1: customers, 2: +subscriptions, 3: +items/prices/products, 4: +invoices, 5: +charges"),
+    fields: Optional[str] = Query(None, description="Per-table field projection, e.g. customers:cus_id,email;subscriptions:sub_id,status")
+):
+    """
+    顧客 → サブスクリプション → アイテム → インボイス → 請求 を1回の呼び出しで取得し、
+    cus_id / sub_id / si_id / price_id / prod_id / inv_id / ch_id をキーにしたテーブルで返す。
+    """
+    try:
+        email_list = normalize_ids(email_addresses.split(',')) if email_addresses else []
+        cus_id_list = normalize_ids(cus_ids.split(',')) if cus_ids else []
+        if not email_list and not cus_id_list:
+            cus_id_list = ["cus_PCvnk7s61noGQW"]
 
-        validated_request = ChargeInvoiceSearchRequest(api_key=api_key, charge_ids=charge_id_list)
-        invoice = get_invoice_by_charge_id(validated_request.api_key, validated_request.charge_ids)
-        return invoice
+        validated_request = CustomerGraphRequest(
+            api_key=api_key, email_addresses=email_list, cus_ids=cus_id_list, depth=depth
+        )
+        projection = parse_field_projection(fields, GRAPH_TABLES)
+        return cached_json_response(
+            request, "/customer_graph", validated_request.api_key,
+            [*validated_request.email_addresses, *validated_request.cus_ids],
+            lambda: build_customer_graph(
+                validated_request.api_key,
+                validated_request.email_addresses,
+                validated_request.cus_ids,
+                validated_request.depth,
+                projection,
+            ),
+            params={"depth": validated_request.depth, "fields": fields or ""},
+        )
     except ValidationError as e:
         logger.error(f"Validation error: {str(e)}")
         raise HTTPException(status_code=422, detail=f"Validation error: {str(e)}")
@@ -634,5 +3991,100 @@ def get_invoice(
         raise HTTPException(status_code=500, detail="Internal server error. Please try again later.")
 
 
+@app.post("/jobs", status_code=202)
+def create_export_job(body: ExportJobRequest):
+    """
+    フルデータ（顧客ID単位）またはインボイス（サブスクリプションID単位）の一括エクスポートをバックグラウンドで開始する。
+    ids を省略するとアカウント全体が対象になる。進捗は GET /jobs/{job_id}、結果は GET /jobs/{job_id}/results で取得する。
+    """
+    try:
+        ids = normalize_ids(body.ids) if body.ids is not None else None
+        job = export_job_store.create(body.kind, account_key(body.api_key), ids)
+        start_export_job(job["job_id"], body.api_key)
+        return FastJSONResponse(export_job_status(job), status_code=202)
+    except Exception as e:
+        logger.error(f"Unexpected server error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error. Please try again later.")
+
+
+@app.get("/jobs/{job_id}")
+def get_export_job(
+    job_id: str,
+    api_key: str = Query(..., description="Stripe API key used to create the job")
+):
+    """
+    ジョブの進捗を返す。実行中のはずのジョブのリースが切れていれば（プロセスの再起動後など）チェックポイントから再開する。
+    別のワーカーが有効なリースを持っているジョブは再開しない。
+    """
+    job = load_export_job(job_id, api_key)
+    if job["status"] in ("queued", "running") and job.get("lease_expires_at", 0) <= time.time():
+        with export_job_threads_lock:
+            thread = export_job_threads.get(job_id)
+        if thread is None or not thread.is_alive():
+            logger.info(f"Resuming export job {job_id} from {job['done']}/{job['total']}")
+            start_export_job(job_id, api_key)
+    return FastJSONResponse(export_job_status(job))
+
+
+@app.get("/jobs/{job_id}/results")
+def get_export_job_results(
+    job_id: str,
+    api_key: str = Query(..., description="Stripe API key used to create the job"),
+    offset: int = Query(0, ge=0, description="Number of records to skip"),
+    limit: int = Query(1000, ge=1, le=10000, description="Maximum number of records to return")
+):
+    """
+    ジョブの結果を NDJSON（1行1レコード）で返す。X-Next-Offset ヘッダーを次回の offset に使う。
+    """
+    job = load_export_job(job_id, api_key)
+    lines = export_job_store.read_results(job_id, offset, limit)
+    next_offset = offset + len(lines)
+    headers = {"X-Job-Status": job["status"], "X-Total-Records": str(job["records"])}
+    if next_offset < job["records"] or job["status"] in ("queued", "running"):
+        headers["X-Next-Offset"] = str(next_offset)
+    return Response(content=b"".join(lines), media_type="application/x-ndjson", headers=headers)
+
+
 # Lambda用のハンドラー
-handler = Mangum(app)
+mangum_handler = Mangum(app)
+
+
+def lambda_response_size(response: dict) -> int:
+    """
+    Lambda が返すレスポンス（ヘッダーと本文を含むJSON）の UTF-8 でのバイト数。
+    日本語を \\uXXXX にエスケープして数えると実際の倍近くになるため、エスケープせずに数える。
+    """
+    return len(json.dumps(response, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def handler(event, context):
+    """
+    Mangum のハンドラーを包み、Lambda のレスポンス上限を確認する。
+    - 圧縮した本文は必ず base64（isBase64Encoded=true）で返す
+      （Mangum は UTF-8 として読めてしまう本文をテキストのまま返すことがあるため）
+    - 上限を超える場合は Lambda のエラー（API Gateway の 502）になる前に 413 を返す
+    """
+    response = mangum_handler(event, context)
+    headers = {k.lower(): v for k, v in (response.get("headers") or {}).items()}
+    for k, v in (response.get("multiValueHeaders") or {}).items():
+        headers.setdefault(k.lower(), v[0] if v else "")
+    if headers.get("content-encoding") and not response.get("isBase64Encoded") and response.get("body"):
+        response["body"] = base64.b64encode(response["body"].encode("utf-8")).decode("ascii")
+        response["isBase64Encoded"] = True
+
+    size = lambda_response_size(response)
+    if LAMBDA_RESPONSE_MAX_BYTES > 0 and size > LAMBDA_RESPONSE_MAX_BYTES:
+        logger.error(f"Response of {size} bytes exceeds Lambda payload limit ({LAMBDA_RESPONSE_MAX_BYTES} bytes)")
+        detail = (
+            f"Response too large ({size} bytes, limit {LAMBDA_RESPONSE_MAX_BYTES} bytes). "
+            "Request fewer IDs, send Accept-Encoding: gzip, or use POST /jobs for bulk exports."
+        )
+        response = {
+            "statusCode": 413,
+            "headers": {"content-type": "application/json"},
+            "body": json.dumps({"detail": detail}),
+            "isBase64Encoded": False,
+        }
+        if "multiValueHeaders" in event:
+            response["multiValueHeaders"] = {"content-type": ["application/json"]}
+    return response
@@ -0,0 +1,191 @@
+import json
+import os
+import re
+import sys
+from urllib.parse import parse_qsl, urlsplit
+
+import pytest
+import stripe
+
+# main.py をリポジトリのルートから import する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+API_KEY = "sk_test_fake"
+
+
+class FakeStripe:
+    """
+    Stripe の HTTP クライアントの代わりに、メモリ上のオブジェクトで Stripe API（retrieve と一覧）に応答する。
+    SDK（stripe.default_http_client）と一覧の高速化（main.raw_http_client）の両方に差し込む。
+    """
+
+    name = "fake"
+    RESOURCES = {
+        "customers": "customer",
+        "subscriptions": "subscription",
+        "invoices": "invoice",
+        "charges": "charge",
+        "products": "product",
+        "prices": "price",
+        "invoice_payments": "invoice_payment",
+        "events": "event",
+    }
+    # 一覧APIが受け付けるパラメータ（Stripe のAPIリファレンスのとおり）。それ以外は Stripe と同じく 400 にする
+    LIST_PARAMS = {
+        "customer": ("email", "created", "test_clock"),
+        "subscription": ("customer", "status", "price", "plan", "created", "collection_method", "test_clock"),
+        "invoice": ("customer", "subscription", "status", "collection_method", "created", "due_date"),
+        "charge": ("customer", "payment_intent", "transfer_group", "created"),
+        "invoice_payment": ("invoice", "payment", "status", "created"),
+        "product": ("active", "ids", "created"),
+        "price": ("active", "product", "currency", "type", "created"),
+        "event": ("type", "types", "created", "delivery_success"),
+    }
+    PAGINATION_PARAMS = ("limit", "starting_after", "ending_before", "expand")
+    # 存在しないIDを指定すると resource_missing になる絞り込み
+    LIST_FILTERS = ("customer", "subscription", "invoice")
+
+    def __init__(self):
+        self.objects = {kind: {} for kind in self.RESOURCES.values()}
+        self.requests = []
+        # サブスクリプションIDごとの次回インボイスのプレビュー（無いものは invoice_upcoming_none）
+        self.previews = {}
+        # (ステータス, エラー種別) を設定すると、すべてのリクエストにそのエラーを返す（障害・レート制限の再現）
+        self.outage = None
+
+    def add(self, kind: str, **fields) -> dict:
+        obj = dict(fields, object=kind)
+        self.objects[kind][obj["id"]] = obj
+        return obj
+
+    def add_invoices(self, subscription_id: str, customer_id: str, created: list, status: str = "paid") -> list:
+        # created の順にインボイスを作る（IDは in_<サブスクリプション>_<連番>）
+        start = sum(1 for inv in self.objects["invoice"].values() if inv["subscription"] == subscription_id)
+        return [
+            self.add(
+                "invoice", id=f"in_{subscription_id}_{start + i:03d}", subscription=subscription_id,
+                customer=customer_id, status=status, created=ts, amount_due=1000, currency="jpy",
+            )
+            for i, ts in enumerate(created)
+        ]
+
+    def add_event(self, event_type: str, obj: dict) -> dict:
+        # イベントは追加した順に新しくなる（IDは evt_<連番>）
+        number = len(self.objects["event"])
+        return self.add(
+            "event", id=f"evt_{number:04d}", type=event_type, created=1_700_000_000 + number, data={"object": obj}
+        )
+
+    def count(self, path: str) -> int:
+        return sum(1 for _, request_path, _, _ in self.requests if request_path == path)
+
+    def request_with_retries(self, method, url, headers, post_data=None, max_network_retries=None, *, _usage=None):
+        parsed = urlsplit(url)
+        pairs = parse_qsl(parsed.query if method == "get" else post_data or "", keep_blank_values=True)
+        params = dict(pairs)
+        # SDK は expand[0]=...、一覧の高速化は expand[]=... の形で送る
+        expand = [value for name, value in pairs if re.fullmatch(r"expand\[\d*\]", name)]
+        self.requests.append((method, parsed.path, params, dict(headers)))
+        if self.outage is not None:
+            status, error_type = self.outage
+            return self._error(status, "Simulated outage", None, error_type=error_type)
+        if parsed.path == "/v1/invoices/create_preview":
+            preview = self.previews.get(params.get("subscription"))
+            if preview is None:
+                return self._error(400, "No upcoming invoices for subscription", None, "invoice_upcoming_none")
+            return self._json(dict(preview, object="invoice"))
+        parts = parsed.path.strip("/").split("/")[1:]
+        kind = self.RESOURCES.get(parts[0]) if parts else None
+        if kind is None:
+            return self._error(404, f"Unrecognized request URL ({parsed.path})", None)
+        if len(parts) == 2:
+            obj = self.objects[kind].get(parts[1])
+            if obj is None:
+                return self._error(404, f"No such {kind}: '{parts[1]}'", "id", "resource_missing")
+            return self._expanded(obj, expand)
+        return self._list(kind, parsed.path, params, expand)
+
+    def _expanded(self, obj: dict, expand: list):
+        # 実際の Stripe と同じく、オブジェクトに無いフィールドの展開は 400 にする
+        obj = dict(obj)
+        for field in expand:
+            if field not in obj:
+                return self._error(400, f"This property cannot be expanded ({field}).", None)
+            if isinstance(obj[field], str):
+                obj[field] = self.objects[field][obj[field]]
+        return self._json(obj)
+
+    def _list(self, kind: str, path: str, params: dict, expand: list):
+        for name in params:
+            base = name.split("[")[0]
+            if base not in self.PAGINATION_PARAMS and base not in self.LIST_PARAMS[kind]:
+                return self._error(400, f"Received unknown parameter: {name}", name)
+        items = list(self.objects[kind].values())
+        for field in ("payment_intent", "email"):
+            if params.get(field) is not None:
+                items = [obj for obj in items if obj.get(field) == params[field]]
+        for field in self.LIST_FILTERS:
+            value = params.get(field)
+            if value is None:
+                continue
+            if value not in self.objects[field]:
+                return self._error(404, f"No such {field}: '{value}'", field, "resource_missing")
+            items = [obj for obj in items if obj.get(field) == value]
+        payment_intent = params.get("payment[payment_intent]")
+        if payment_intent is not None:
+            items = [obj for obj in items if (obj.get("payment") or {}).get("payment_intent") == payment_intent]
+        for op in ("gt", "gte", "lt", "lte"):
+            bound = params.get(f"created[{op}]")
+            if bound is not None:
+                bound = int(bound)
+                items = [obj for obj in items if {
+                    "gt": obj["created"] > bound,
+                    "gte": obj["created"] >= bound,
+                    "lt": obj["created"] < bound,
+                    "lte": obj["created"] <= bound,
+                }[op]]
+        items.sort(key=lambda obj: (obj["created"], obj["id"]), reverse=True)
+        limit = int(params.get("limit", 10))
+        if params.get("ending_before"):
+            # ending_before はカーソルより新しいものを、カーソルに近い側から limit 件返す（並びは新しい順のまま）
+            ids = [obj["id"] for obj in items]
+            items = items[:ids.index(params["ending_before"])]
+            page, has_more = items[-limit:], len(items) > limit
+        else:
+            if params.get("starting_after"):
+                ids = [obj["id"] for obj in items]
+                items = items[ids.index(params["starting_after"]) + 1:]
+            page, has_more = items[:limit], len(items) > limit
+        data = []
+        for obj in page:
+            expanded = self._expanded(obj, [field[len("data."):] for field in expand if field.startswith("data.")])
+            if expanded[1] != 200:
+                return expanded
+            data.append(json.loads(expanded[0]))
+        return self._json({"object": "list", "data": data, "has_more": has_more, "url": path})
+
+    @staticmethod
+    def _json(body: dict, status: int = 200):
+        return json.dumps(body), status, {}
+
+    def _error(self, status: int, message: str, param, code=None, error_type="invalid_request_error"):
+        return self._json({"error": {"type": error_type, "code": code, "message": message, "param": param}}, status)
+
+
+@pytest.fixture
+def fake_stripe(monkeypatch, tmp_path):
+    """
+    Stripe への通信を FakeStripe に差し替え、プロセス内のキャッシュをテストごとに作り直す。
+    """
+    fake = FakeStripe()
+    monkeypatch.setattr(stripe, "default_http_client", fake)
+    monkeypatch.setattr(stripe, "max_network_retries", 0)
+    monkeypatch.setattr(main, "raw_http_client", fake)
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(0, 1))
+    monkeypatch.setattr(main, "upcoming_cache", main.UpcomingInvoiceCache(0, 1))
+    monkeypatch.setattr(main, "negative_cache", main.NegativeCache(60, 100, 1000, 0.01))
+    monkeypatch.setattr(main, "account_stats", main.AccountStats(3600, 1000))
+    monkeypatch.setattr(main, "object_store", main.ObjectStore("", 0))
+    return fake
@@ -0,0 +1,61 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from conftest import API_KEY
+
+
+@pytest.fixture
+def mirror(fake_stripe, monkeypatch, tmp_path):
+    customer_mirror = main.CustomerMirror(str(tmp_path / "mirror.db"), 3600)
+    monkeypatch.setattr(main, "customer_mirror", customer_mirror)
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(60, 100))
+    account = main.account_key(API_KEY)
+    conn = customer_mirror._connection()
+    with conn:
+        customer_mirror._upsert(conn, account, {"id": "cus_1", "object": "customer", "email": "Taro@Example.com", "created": 1})
+        # 直前に取り込んだことにして、イベントの取り込みを省略させる
+        conn.execute(
+            "INSERT INTO mirror_state (account, event_cursor, synced_at, refreshed_at) VALUES (?, ?, ?, ?)",
+            (account, None, time.time(), time.time()),
+        )
+    return customer_mirror
+
+
+def test_normalize_ids_keeps_order_and_duplicates():
+    assert main.normalize_ids([" sub_b", "sub_a ", "", "sub_b", "  "]) == ["sub_b", "sub_a", "sub_b"]
+
+
+def test_duplicate_ids_are_returned_twice(fake_stripe):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_1", customer="cus_1", created=1)
+    client = TestClient(main.app)
+
+    response = client.get("/search_subscriptions_by_id", params={"api_key": API_KEY, "subscription_ids": "sub_1,sub_1"})
+
+    assert [record["sub_id"] for record in response.json()["records"]] == ["sub_1", "sub_1"]
+
+
+def test_mirrored_email_search_shares_cache_across_case(mirror):
+    client = TestClient(main.app)
+
+    first = client.get("/search_customers", params={"api_key": API_KEY, "email_addresses": "taro@example.com"})
+    second = client.get("/search_customers", params={"api_key": API_KEY, "email_addresses": "TARO@example.COM"})
+
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.json() == first.json()
+    assert [record["cus_id"] for record in first.json()["records"]] == ["cus_1"]
+
+
+def test_stripe_email_search_keeps_case_in_cache_key(mirror):
+    client = TestClient(main.app)
+    params = {"api_key": API_KEY, "consistency": "strong"}
+
+    client.get("/search_customers", params=dict(params, email_addresses="taro@example.com"))
+    second = client.get("/search_customers", params=dict(params, email_addresses="TARO@example.com"))
+
+    # Stripe の email 検索は大文字・小文字を区別するため、別のキーになる
+    assert second.headers["X-Cache"] == "MISS"
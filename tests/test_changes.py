@@ -0,0 +1,138 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from conftest import API_KEY
+
+ACCOUNT = main.account_key(API_KEY)
+
+
+def read_changes(client, cursor=None, limit=100):
+    params = {"api_key": API_KEY, "limit": limit}
+    if cursor:
+        params["cursor"] = cursor
+    response = client.get("/changes", params=params)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_cursor_pages_forward_until_has_more_is_false(fake_stripe):
+    client = TestClient(main.app)
+    for i in range(3):
+        fake_stripe.add_event("customer.created", {"id": f"cus_{i}", "object": "customer"})
+
+    latest = read_changes(client, limit=2)
+    # cursor を省略すると最新のイベントから返す
+    assert [record["cus_id"] for record in latest["records"]] == ["cus_1", "cus_2"]
+    assert latest["cursor"] == "evt_0002"
+
+    for i in range(3, 6):
+        fake_stripe.add_event("customer.updated", {"id": f"cus_{i}", "object": "customer"})
+    first = read_changes(client, latest["cursor"], limit=2)
+    second = read_changes(client, first["cursor"], limit=2)
+    idle = read_changes(client, second["cursor"], limit=2)
+
+    assert [record["event_id"] for record in first["records"]] == ["evt_0003", "evt_0004"]
+    assert first["has_more"] is True
+    assert [record["event_id"] for record in second["records"]] == ["evt_0005"]
+    assert second["has_more"] is False
+    assert idle == {"records": [], "cursor": "evt_0005", "has_more": False}
+    _, _, params, _ = fake_stripe.requests[-1]
+    assert params["ending_before"] == "evt_0005"
+
+
+def test_only_supported_object_types_are_returned(fake_stripe):
+    fake_stripe.add_event("payment_intent.created", {"id": "pi_1", "object": "payment_intent"})
+    fake_stripe.add_event("invoiceitem.created", {"id": "ii_1", "object": "invoiceitem"})
+    fake_stripe.add_event("price.updated", {"id": "price_1", "object": "price"})
+
+    result = read_changes(TestClient(main.app), "evt_0000")
+
+    assert [(record["event_type"], record["price_id"]) for record in result["records"]] == [("price.updated", "price_1")]
+    assert result["cursor"] == "evt_0002"
+
+
+@pytest.fixture
+def caches(fake_stripe, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(60, 100))
+    monkeypatch.setattr(main, "upcoming_cache", main.UpcomingInvoiceCache(300, 100))
+    monkeypatch.setattr(main, "object_store", main.ObjectStore(str(tmp_path / "objects"), 64 * 1024 * 1024))
+    mirror = main.CustomerMirror(str(tmp_path / "mirror.db"), 3600)
+    monkeypatch.setattr(main, "customer_mirror", mirror)
+    conn = mirror._connection()
+    with conn:
+        mirror._upsert(conn, ACCOUNT, {"id": "cus_1", "object": "customer", "email": "old@example.com", "created": 1})
+        conn.execute(
+            "INSERT INTO mirror_state (account, event_cursor, synced_at, refreshed_at) VALUES (?, ?, ?, ?)",
+            (ACCOUNT, None, time.time(), time.time()),
+        )
+
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_1", customer="cus_1", created=1)
+    invoice = fake_stripe.add_invoices("sub_1", "cus_1", [1000])[0]
+    fake_stripe.add("charge", id="ch_1", payment_intent="pi_1", status="failed", paid=False, created=1000)
+    fake_stripe.add(
+        "invoice_payment", id="inpay_1", invoice=invoice["id"], status="paid", created=1000,
+        payment={"type": "payment_intent", "payment_intent": "pi_1"},
+    )
+    main.list_subscription_invoices(API_KEY, "sub_1")
+    main.list_invoice_charges(API_KEY, invoice)
+    for route, ids in (("/search_subscriptions", ["cus_1"]), ("/search_invoices_by_subscription", ["sub_1"]),
+                       ("/search_customers", ["old@example.com"]), ("/other", ["sub_2"])):
+        main.response_cache.set(route, b"{}", '"etag"', ACCOUNT, ids)
+    main.upcoming_cache.set(ACCOUNT, "sub_1", "cus_1", "fp", None)
+    main.upcoming_cache.set(ACCOUNT, "sub_2", "cus_2", "fp", None)
+    return invoice
+
+
+def stored(key):
+    return main.object_store.get(ACCOUNT, key)
+
+
+def test_customer_event_updates_mirror_and_drops_cached_responses(fake_stripe, caches):
+    fake_stripe.add_event("customer.updated", {"id": "cus_1", "object": "customer", "email": "New@Example.com", "created": 1})
+
+    read_changes(TestClient(main.app))
+
+    assert main.response_cache.get("/search_subscriptions") is None
+    assert main.response_cache.get("/other") is not None
+    assert main.upcoming_cache.get(ACCOUNT, "sub_1", "fp") is None
+    assert main.upcoming_cache.get(ACCOUNT, "sub_2", "fp") is not None
+    assert list(main.customer_mirror.lookup(ACCOUNT, ["new@example.com"])["new@example.com"])[0]["id"] == "cus_1"
+    assert main.customer_mirror.lookup(ACCOUNT, ["old@example.com"])["old@example.com"] == []
+
+
+def test_invoice_event_drops_invoice_and_charge_indexes(fake_stripe, caches):
+    invoice = dict(caches, status="void")
+    fake_stripe.add_event("invoice.voided", invoice)
+
+    read_changes(TestClient(main.app))
+
+    assert stored("idx_invoices_sub_1") is None
+    assert stored(f"idx_charges_{invoice['id']}") is None
+    assert stored(invoice["id"]) is None
+    assert main.response_cache.get("/search_invoices_by_subscription") is None
+    assert main.upcoming_cache.get(ACCOUNT, "sub_1", "fp") is None
+
+
+def test_charge_event_without_invoice_field_drops_charge_index(fake_stripe, caches):
+    assert stored(f"idx_charges_{caches['id']}") is not None
+    # 新しいAPIバージョンの請求には invoice が無い
+    fake_stripe.add_event("charge.refunded", {"id": "ch_1", "object": "charge", "payment_intent": "pi_1", "customer": None})
+
+    read_changes(TestClient(main.app))
+
+    assert stored(f"idx_charges_{caches['id']}") is None
+    assert stored("ch_1") is None
+    assert main.response_cache.get("/search_invoices_by_subscription") is None
+    assert stored("idx_invoices_sub_1") is not None
+
+
+def test_charge_event_with_invoice_field_on_older_api(fake_stripe, caches):
+    fake_stripe.add_event("charge.refunded", {"id": "ch_1", "object": "charge", "invoice": caches["id"]})
+
+    read_changes(TestClient(main.app))
+
+    assert stored(f"idx_charges_{caches['id']}") is None
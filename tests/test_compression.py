@@ -0,0 +1,99 @@
+import gzip
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from conftest import API_KEY
+
+PARAMS = {"api_key": API_KEY, "subscription_ids": "sub_1"}
+
+
+@pytest.fixture
+def client(fake_stripe, monkeypatch):
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(60, 100))
+    monkeypatch.setattr(main, "COMPRESSION_MIN_SIZE", 64)
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_1", customer="cus_1", created=1, description="月額プラン" * 20)
+    return TestClient(main.app)
+
+
+def get(client, accept_encoding, **headers):
+    return client.get(
+        "/search_subscriptions_by_id", params=PARAMS, headers=dict(headers, **{"Accept-Encoding": accept_encoding})
+    )
+
+
+def test_gzip_response_has_suffixed_etag_and_vary(client):
+    identity = get(client, "identity")
+    compressed = get(client, "gzip")
+
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.headers["ETag"] == identity.headers["ETag"][:-1] + '-gzip"'
+    assert "Accept-Encoding" in compressed.headers["Vary"]
+    assert "Accept-Encoding" in identity.headers["Vary"]
+    assert compressed.content == identity.content
+    assert int(compressed.headers["Content-Length"]) < len(identity.content)
+
+
+def test_if_none_match_with_suffixed_etag_returns_304(client):
+    etag = get(client, "gzip").headers["ETag"]
+
+    response = get(client, "gzip", **{"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert "Content-Encoding" not in response.headers
+
+
+def test_if_none_match_with_plain_etag_under_gzip_returns_304(client):
+    etag = get(client, "identity").headers["ETag"]
+
+    response = get(client, "gzip", **{"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+def test_br_without_brotli_falls_back(client, monkeypatch):
+    monkeypatch.setattr(main, "brotli", None)
+
+    only_br = get(client, "br")
+    br_or_gzip = get(client, "br, gzip;q=0.5")
+
+    assert "Content-Encoding" not in only_br.headers
+    assert not only_br.headers["ETag"].endswith('-br"')
+    assert br_or_gzip.headers["Content-Encoding"] == "gzip"
+
+
+@pytest.mark.parametrize("accept_encoding,brotli_installed,expected", [
+    ("br, gzip", True, "br"),
+    ("br, gzip", False, "gzip"),
+    ("gzip;q=0.5, br;q=1", True, "br"),
+    ("gzip;q=1, br;q=0.5", True, "gzip"),
+    ("gzip;q=0", False, None),
+    ("*", False, "gzip"),
+    ("identity", True, None),
+])
+def test_choose_content_encoding(monkeypatch, accept_encoding, brotli_installed, expected):
+    monkeypatch.setattr(main, "brotli", object() if brotli_installed else None)
+
+    assert main.choose_content_encoding(accept_encoding) == expected
+
+
+def test_small_response_is_not_compressed(client, monkeypatch):
+    monkeypatch.setattr(main, "COMPRESSION_MIN_SIZE", 1024 * 1024)
+
+    response = get(client, "gzip")
+
+    assert "Content-Encoding" not in response.headers
+    assert not response.headers["ETag"].endswith('-gzip"')
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+
+def test_gzip_output_is_deterministic():
+    body = b'{"records": []}' * 100
+
+    assert main.compress_body(body, "gzip") == main.compress_body(body, "gzip")
+    assert gzip.decompress(main.compress_body(body, "gzip")) == body
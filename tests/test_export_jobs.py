@@ -0,0 +1,124 @@
+import json
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from conftest import API_KEY
+
+SUBSCRIPTIONS = ("sub_1", "sub_2", "sub_3")
+
+
+@pytest.fixture
+def store(fake_stripe, monkeypatch, tmp_path):
+    job_store = main.ExportJobStore(str(tmp_path / "jobs"))
+    monkeypatch.setattr(main, "export_job_store", job_store)
+    monkeypatch.setattr(main, "JOB_MAX_REQUESTS_PER_SECOND", 1000)
+    fake_stripe.add("customer", id="cus_1", created=1)
+    for subscription_id in SUBSCRIPTIONS:
+        fake_stripe.add("subscription", id=subscription_id, customer="cus_1", created=1)
+        fake_stripe.add_invoices(subscription_id, "cus_1", [1000, 1001])
+    return job_store
+
+
+def wait_for_job(job_id):
+    with main.export_job_threads_lock:
+        thread = main.export_job_threads.get(job_id)
+    if thread is not None:
+        thread.join(10)
+
+
+def result_ids(store, job_id):
+    with open(store.results_path(job_id), "rb") as f:
+        return [json.loads(line)["inv_id"] for line in f]
+
+
+def test_live_lease_cannot_be_taken_by_another_worker(store):
+    job = store.create("invoices", main.account_key(API_KEY), list(SUBSCRIPTIONS))
+
+    assert store.acquire_lease(job["job_id"], "worker_a", 60) is not None
+    assert store.acquire_lease(job["job_id"], "worker_b", 60) is None
+    # リースの持ち主は取り直せる
+    assert store.acquire_lease(job["job_id"], "worker_a", 60) is not None
+    with pytest.raises(main.ExportJobLeaseLost):
+        store.save_leased(dict(job, status="running"), "worker_b", 60)
+
+
+def test_finished_job_is_not_leased(store):
+    job = store.create("invoices", main.account_key(API_KEY), list(SUBSCRIPTIONS))
+    leased = store.acquire_lease(job["job_id"], "worker_a", 60)
+    leased["status"] = "completed"
+    store.save_leased(leased, "worker_a", 60)
+
+    assert store.load(job["job_id"])["lease_expires_at"] == 0
+    assert store.acquire_lease(job["job_id"], "worker_b", 60) is None
+
+
+def test_expired_lease_resumes_from_checkpoint_without_duplicates(fake_stripe, store):
+    job = store.create("invoices", main.account_key(API_KEY), list(SUBSCRIPTIONS))
+    job_id = job["job_id"]
+    # worker_a が sub_1 を書き終えてチェックポイントし、sub_2 の途中まで書いたところで止まった
+    leased = store.acquire_lease(job_id, "worker_a", 60)
+    records = main.export_records_for_id(API_KEY, "invoices", "sub_1")
+    with open(store.results_path(job_id), "ab") as f:
+        for record in records:
+            f.write(json.dumps(record).encode("utf-8") + b"\n")
+        leased.update(status="running", done=1, records=len(records), results_bytes=f.tell())
+        f.write(b'{"inv_id": "in_sub_2_001", "partial')
+    store.save_leased(leased, "worker_a", 60)
+    expired = store.load(job_id)
+    expired["lease_expires_at"] = time.time() - 1
+    store.save(expired)
+    requests_before = len(fake_stripe.requests)
+
+    status = TestClient(main.app).get(f"/jobs/{job_id}", params={"api_key": API_KEY})
+    wait_for_job(job_id)
+
+    assert status.status_code == 200
+    finished = store.load(job_id)
+    assert finished["status"] == "completed"
+    assert finished["lease_owner"] == main.EXPORT_JOB_WORKER_ID
+    assert result_ids(store, job_id) == [
+        f"in_{subscription_id}_{n:03d}" for subscription_id in SUBSCRIPTIONS for n in (1, 0)
+    ]
+    assert finished["records"] == 6
+    # 処理済みの sub_1 は読み直さない
+    resumed_requests = fake_stripe.requests[requests_before:]
+    assert not any(params.get("subscription") == "sub_1" for _, _, params, _ in resumed_requests)
+    # 引き継がれた worker_a はもう書き込めない
+    with pytest.raises(main.ExportJobLeaseLost):
+        store.save_leased(leased, "worker_a", 60)
+
+
+def test_results_are_paged_with_next_offset(store):
+    client = TestClient(main.app)
+    created = client.post("/jobs", json={"api_key": API_KEY, "kind": "invoices", "ids": list(SUBSCRIPTIONS)})
+    job_id = created.json()["job_id"]
+    wait_for_job(job_id)
+
+    lines = []
+    offset = 0
+    while True:
+        response = client.get(f"/jobs/{job_id}/results", params={"api_key": API_KEY, "offset": offset, "limit": 4})
+        assert response.headers["X-Job-Status"] == "completed"
+        assert response.headers["X-Total-Records"] == "6"
+        page = response.content.splitlines()
+        assert len(page) <= 4
+        lines.extend(page)
+        if "X-Next-Offset" not in response.headers:
+            break
+        offset = int(response.headers["X-Next-Offset"])
+
+    assert len(lines) == 6
+    assert [json.loads(line)["inv_id"] for line in lines] == result_ids(store, job_id)
+    status = client.get(f"/jobs/{job_id}", params={"api_key": API_KEY}).json()
+    assert (status["status"], status["done"], status["total"]) == ("completed", 3, 3)
+
+
+def test_job_is_hidden_from_other_accounts(store):
+    job = store.create("invoices", main.account_key(API_KEY), ["sub_1"])
+
+    response = TestClient(main.app).get(f"/jobs/{job['job_id']}", params={"api_key": "sk_test_other"})
+
+    assert response.status_code == 404
@@ -0,0 +1,68 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from conftest import API_KEY
+
+
+@pytest.fixture
+def client(fake_stripe):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("invoice", id="in_1", customer="cus_1", status="paid", created=1000, amount_due=1000)
+    return TestClient(main.app)
+
+
+def search(client, charge_ids):
+    response = client.get("/search_invoice_by_charge", params={"api_key": API_KEY, "charge_ids": charge_ids})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_invoice_is_resolved_through_invoice_payments(fake_stripe, client):
+    # basil 以降の形：請求に invoice は無く、PaymentIntent のインボイス支払いからたどる
+    fake_stripe.add("charge", id="ch_1", payment_intent="pi_1", created=1000)
+    fake_stripe.add("charge", id="ch_2", payment_intent="pi_1", created=1001)
+    fake_stripe.add("invoice_payment", id="inpay_0", invoice="in_1", status="canceled", created=999,
+                    payment={"type": "payment_intent", "payment_intent": "pi_1"})
+    fake_stripe.add("invoice_payment", id="inpay_1", invoice="in_1", status="paid", created=1000,
+                    payment={"type": "payment_intent", "payment_intent": "pi_1"})
+
+    result = search(client, "ch_1,ch_2")
+
+    assert [record["inv_id"] for record in result["records"]] == ["in_1"]
+    assert result["charges_without_invoice"] == []
+    _, _, params, _ = fake_stripe.requests[1]
+    assert params["payment[payment_intent]"] == "pi_1"
+    # インボイスは展開して受け取り、別に retrieve しない
+    assert fake_stripe.count("/v1/invoices/in_1") == 0
+
+
+@pytest.mark.parametrize("charge", [
+    {"id": "ch_1", "payment_intent": "pi_oneoff", "created": 1000},
+    {"id": "ch_1", "payment_intent": None, "created": 1000},
+])
+def test_charge_without_invoice_payment(fake_stripe, client, charge):
+    fake_stripe.add("charge", **charge)
+
+    result = search(client, "ch_1")
+
+    assert result == {"records": [], "charges_without_invoice": ["ch_1"]}
+
+
+def test_older_api_version_uses_charge_invoice(fake_stripe, client):
+    fake_stripe.add("charge", id="ch_1", invoice="in_1", payment_intent="pi_1", created=1000)
+    fake_stripe.add("charge", id="ch_2", invoice=None, payment_intent="pi_2", created=1001)
+
+    result = search(client, "ch_1,ch_2")
+
+    assert [record["inv_id"] for record in result["records"]] == ["in_1"]
+    assert result["charges_without_invoice"] == ["ch_2"]
+    assert fake_stripe.count("/v1/invoice_payments") == 0
+
+
+def test_fake_rejects_expanding_missing_invoice(fake_stripe, client):
+    # 新しいAPIバージョンの請求を expand=["invoice"] で取得すると Stripe は 400 を返す
+    fake_stripe.add("charge", id="ch_1", payment_intent="pi_1", created=1000)
+
+    with pytest.raises(main.stripe.error.InvalidRequestError):
+        main.stripe.Charge.retrieve("ch_1", expand=["invoice"], api_key=API_KEY)
@@ -0,0 +1,24 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("invoice,expected", [
+    ({"parent": {"subscription_details": {"subscription": "sub_new"}}, "subscription": None}, "sub_new"),
+    ({"parent": {"subscription_details": {"subscription": {"id": "sub_expanded"}}}}, "sub_expanded"),
+    ({"subscription": "sub_old"}, "sub_old"),
+    ({"parent": None, "subscription": {"id": "sub_old_expanded"}}, "sub_old_expanded"),
+    ({"parent": {"type": "quote_details", "subscription_details": None}}, None),
+])
+def test_invoice_subscription_id(invoice, expected):
+    assert main.invoice_subscription_id(invoice) == expected
+
+
+@pytest.mark.parametrize("line,expected", [
+    ({"pricing": {"type": "price_details", "price_details": {"price": "price_new", "product": "prod_1"}}}, "price_new"),
+    ({"pricing": {"price_details": {"price": {"id": "price_expanded"}}}, "price": None}, "price_expanded"),
+    ({"price": {"id": "price_old"}}, "price_old"),
+    ({"pricing": None, "price": None}, None),
+])
+def test_invoice_line_price_id(line, expected):
+    assert main.invoice_line_price_id(line) == expected
@@ -0,0 +1,32 @@
+import json
+
+import pytest
+
+import main
+
+
+def text_response(text: str) -> dict:
+    return {
+        "statusCode": 200,
+        "headers": {"content-type": "application/json"},
+        "body": json.dumps({"name": text}, ensure_ascii=False),
+        "isBase64Encoded": False,
+    }
+
+
+def test_response_size_counts_utf8_bytes():
+    response = text_response("山田太郎")
+
+    expected = len(json.dumps(response, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    assert main.lambda_response_size(response) == expected
+    assert main.lambda_response_size(response) < len(json.dumps(response))
+
+
+@pytest.mark.parametrize("characters,status", [(1000, 200), (1200, 413)])
+def test_japanese_body_is_measured_by_encoded_size(monkeypatch, characters, status):
+    # 1000文字の日本語は UTF-8 で約3KB（\uXXXX にエスケープすると約6KB）
+    response = text_response("あ" * characters)
+    monkeypatch.setattr(main, "mangum_handler", lambda event, context: dict(response))
+    monkeypatch.setattr(main, "LAMBDA_RESPONSE_MAX_BYTES", 3300)
+
+    assert main.handler({}, None)["statusCode"] == status
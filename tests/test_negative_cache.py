@@ -0,0 +1,87 @@
+import pytest
+import stripe
+from fastapi.testclient import TestClient
+
+import main
+from conftest import API_KEY
+
+
+def make_cache(max_entries=1, bloom_capacity=100):
+    return main.NegativeCache(ttl=60, max_entries=max_entries, bloom_capacity=bloom_capacity, bloom_error_rate=0.01)
+
+
+def test_remembers_missing_id():
+    cache = make_cache(max_entries=10)
+    cache.add("acct", "customer", "cus_missing", "No such customer: 'cus_missing'")
+
+    assert cache.get("acct", "customer", "cus_missing") == "No such customer: 'cus_missing'"
+    assert cache.get("acct", "customer", "cus_other") is None
+    assert cache.get("other_acct", "customer", "cus_missing") is None
+
+
+def test_discard_forgets_exact_entry():
+    cache = make_cache(max_entries=10)
+    cache.add("acct", "customer", "cus_missing", "missing")
+    cache.discard("acct", "customer", "cus_missing")
+
+    assert cache.get("acct", "customer", "cus_missing") is None
+
+
+def test_bloom_rotates_when_capacity_is_reached():
+    cache = make_cache(max_entries=1, bloom_capacity=100)
+    for i in range(1000):
+        cache.add("acct", "customer", f"cus_missing_{i}", "missing")
+
+    # ttl 内でも capacity ごとに新しいフィルタへ切り替え、フィルタ数は上限で抑える
+    assert len(cache._blooms) == main.NegativeCache.MAX_BLOOMS
+    assert all(bloom.count <= 100 for _, bloom in cache._blooms)
+    # 直近に入れたIDは覚えている
+    assert cache.get("acct", "customer", "cus_missing_998") is not None
+
+    # capacity を超えて詰め込まないので、偽陽性率は error_rate 程度に収まる
+    false_positives = sum(cache.get("acct", "customer", f"cus_present_{i}") is not None for i in range(2000))
+    assert false_positives / 2000 < 0.05
+
+
+def test_disabled_when_ttl_is_zero():
+    cache = main.NegativeCache(ttl=0, max_entries=10, bloom_capacity=100, bloom_error_rate=0.01)
+    cache.add("acct", "customer", "cus_missing", "missing")
+
+    assert cache.get("acct", "customer", "cus_missing") is None
+
+
+def test_retrieve_of_missing_id_is_answered_from_cache(fake_stripe):
+    for _ in range(2):
+        with pytest.raises(stripe.error.InvalidRequestError) as excinfo:
+            main.retrieve_object(API_KEY, stripe.Customer, "cus_missing")
+        assert main.is_resource_missing(excinfo.value)
+
+    assert fake_stripe.count("/v1/customers/cus_missing") == 1
+
+
+def test_partial_lists_missing_ids_and_skips_repeat_calls(fake_stripe):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_1", customer="cus_1", created=1, items={"object": "list", "data": []})
+    client = TestClient(main.app)
+    params = {"api_key": API_KEY, "cus_ids": "cus_missing,cus_1", "partial": "true"}
+
+    first = client.get("/search_subscriptions", params=params)
+    second = client.get("/search_subscriptions", params=params)
+
+    for response in (first, second):
+        assert response.status_code == 200
+        assert response.json()["missing_ids"] == ["cus_missing"]
+        assert [record["sub_id"] for record in response.json()["records"]] == ["sub_1"]
+    assert first.headers["X-Stripe-Skipped-Calls"] == "0"
+    assert second.headers["X-Stripe-Skipped-Calls"] == "1"
+    assert fake_stripe.count("/v1/subscriptions") == 3
+
+
+def test_missing_id_without_partial_is_400(fake_stripe):
+    client = TestClient(main.app)
+
+    for _ in range(2):
+        response = client.get("/search_subscriptions", params={"api_key": API_KEY, "cus_ids": "cus_missing"})
+        assert response.status_code == 400
+        assert "cus_missing" in response.json()["detail"]
+    assert fake_stripe.count("/v1/subscriptions") == 1
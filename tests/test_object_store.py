@@ -0,0 +1,135 @@
+import time
+
+import pytest
+
+import main
+from conftest import API_KEY
+
+
+@pytest.fixture
+def store(fake_stripe, monkeypatch, tmp_path):
+    object_store = main.ObjectStore(str(tmp_path / "objects"), 64 * 1024 * 1024)
+    monkeypatch.setattr(main, "object_store", object_store)
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_1", customer="cus_1", created=1)
+    return object_store
+
+
+def invoice_ids(invoices):
+    return [inv["id"] for inv in invoices]
+
+
+def test_second_read_only_asks_for_invoices_since_watermark(fake_stripe, store):
+    fake_stripe.add_invoices("sub_1", "cus_1", [1000, 1001, 1002])
+    fake_stripe.add_invoices("sub_1", "cus_1", [1003], status="open")
+
+    first = main.list_subscription_invoices(API_KEY, "sub_1")
+    second = main.list_subscription_invoices(API_KEY, "sub_1")
+
+    assert invoice_ids(second) == invoice_ids(first)
+    index = store.get(main.account_key(API_KEY), "idx_invoices_sub_1")
+    assert index["watermark"] == 1002
+    _, _, params, _ = fake_stripe.requests[-1]
+    assert params["created[gte]"] == "1002"
+
+
+def test_invoice_in_the_watermark_second_is_not_skipped(fake_stripe, store):
+    fake_stripe.add_invoices("sub_1", "cus_1", [1000, 1001, 1002])
+    main.list_subscription_invoices(API_KEY, "sub_1")
+
+    # 保存後に、保存済みの最新インボイスと同じ秒のインボイスが作成された
+    late = fake_stripe.add_invoices("sub_1", "cus_1", [1002], status="open")[0]
+    invoices = main.list_subscription_invoices(API_KEY, "sub_1")
+
+    assert late["id"] in invoice_ids(invoices)
+    assert len(invoice_ids(invoices)) == len(set(invoice_ids(invoices))) == 4
+
+
+def test_since_filters_stored_history(fake_stripe, store):
+    fake_stripe.add_invoices("sub_1", "cus_1", [1000, 1001, 1002, 1003])
+    main.list_subscription_invoices(API_KEY, "sub_1")
+
+    invoices = main.list_subscription_invoices(API_KEY, "sub_1", since=1001)
+
+    assert [inv["created"] for inv in invoices] == [1003, 1002]
+
+
+def test_missing_stored_invoice_refetches_everything(fake_stripe, store):
+    fake_stripe.add_invoices("sub_1", "cus_1", [1000, 1001])
+    first = main.list_subscription_invoices(API_KEY, "sub_1")
+    store.delete(main.account_key(API_KEY), first[-1]["id"])
+
+    invoices = main.list_subscription_invoices(API_KEY, "sub_1")
+
+    assert invoice_ids(invoices) == invoice_ids(first)
+    _, _, params, _ = fake_stripe.requests[-1]
+    assert "created[gte]" not in params
+
+
+@pytest.mark.parametrize("charge,immutable", [
+    ({"status": "failed", "paid": False}, True),
+    ({"status": "pending", "paid": False}, False),
+    ({"status": "succeeded", "paid": True, "refunded": True}, True),
+    ({"status": "succeeded", "paid": True, "refunded": False}, False),
+    ({"status": "succeeded", "paid": True, "refunded": False, "age_days": 400}, True),
+    ({"status": "succeeded", "paid": True, "refunded": False, "disputed": True, "age_days": 400}, False),
+])
+def test_charge_is_settled_only_when_refunded_or_past_dispute_window(charge, immutable):
+    now = time.time()
+    charge = dict(charge, created=int(now - charge.pop("age_days", 1) * 86400))
+
+    assert main.is_immutable_charge(charge, now) is immutable
+
+
+def add_paid_charge(fake_stripe, invoice, charge_id, payment_intent, created, old_api=False):
+    charge = fake_stripe.add(
+        "charge", id=charge_id, payment_intent=payment_intent, status="succeeded", paid=True,
+        refunded=True, created=created,
+    )
+    if old_api:
+        invoice["payment_intent"] = payment_intent
+    else:
+        fake_stripe.add(
+            "invoice_payment", id=f"inpay_{charge_id}", invoice=invoice["id"], status="paid", created=created,
+            payment={"type": "payment_intent", "payment_intent": payment_intent},
+        )
+    return charge
+
+
+def test_invoice_charges_are_listed_by_payment_intent_and_stored(fake_stripe, store):
+    invoice = fake_stripe.add_invoices("sub_1", "cus_1", [1000])[0]
+    add_paid_charge(fake_stripe, invoice, "ch_1", "pi_1", 1000)
+    add_paid_charge(fake_stripe, invoice, "ch_2", "pi_2", 1001)
+    # 同じ顧客の別のインボイスの請求は含めない
+    fake_stripe.add("charge", id="ch_other", payment_intent="pi_other", customer="cus_1", created=1002)
+
+    first = main.list_invoice_charges(API_KEY, invoice)
+    requests = len(fake_stripe.requests)
+    second = main.list_invoice_charges(API_KEY, invoice)
+
+    assert [ch["id"] for ch in first] == [ch["id"] for ch in second] == ["ch_2", "ch_1"]
+    assert {params.get("payment_intent") for _, path, params, _ in fake_stripe.requests if path == "/v1/charges"} == {
+        "pi_1", "pi_2"
+    }
+    assert len(fake_stripe.requests) == requests
+    assert store.get(main.account_key(API_KEY), f"idx_charges_{invoice['id']}")["ids"] == ["ch_2", "ch_1"]
+
+
+def test_invoice_charges_on_older_api_use_invoice_payment_intent(fake_stripe, store):
+    invoice = fake_stripe.add_invoices("sub_1", "cus_1", [1000])[0]
+    add_paid_charge(fake_stripe, invoice, "ch_1", "pi_1", 1000, old_api=True)
+
+    charges = main.list_invoice_charges(API_KEY, invoice)
+
+    assert [ch["id"] for ch in charges] == ["ch_1"]
+    assert fake_stripe.count("/v1/invoice_payments") == 0
+
+
+def test_search_charges_by_subscription(fake_stripe, store):
+    first, second = fake_stripe.add_invoices("sub_1", "cus_1", [1000, 1001])
+    add_paid_charge(fake_stripe, first, "ch_1", "pi_1", 1000)
+    add_paid_charge(fake_stripe, second, "ch_2", "pi_2", 1001)
+
+    result = main.search_charges_by_subscription(API_KEY, ["sub_1"], "epoch")
+
+    assert [record["ch_id"] for record in result["records"]] == ["ch_2", "ch_1"]
@@ -0,0 +1,144 @@
+import pytest
+from fastapi import HTTPException
+
+import main
+from conftest import API_KEY
+
+
+def read_all_pages(subscription_ids, limit, since=None):
+    records = []
+    cursor = None
+    pages = 0
+    while True:
+        page = main.get_invoices_page(API_KEY, subscription_ids, since, "epoch", limit, cursor)
+        assert len(page["records"]) <= limit
+        records.extend(page["records"])
+        pages += 1
+        if not page["has_more"]:
+            assert page["next_starting_after"] is None
+            return records, pages
+        cursor = page["next_starting_after"]
+
+
+def test_cursor_round_trip():
+    ids = ["sub_a", "sub_b", "sub_c"]
+    cursor = main.encode_page_cursor(ids, 1, "in_123", skip=2)
+
+    assert main.decode_page_cursor(cursor, ids) == (1, "in_123", 2)
+    assert main.decode_page_cursor(None, ids) == (0, None, 0)
+
+
+def test_cursor_rejects_changed_id_list():
+    cursor = main.encode_page_cursor(["sub_a", "sub_b"], 1, None)
+
+    with pytest.raises(HTTPException) as excinfo:
+        main.decode_page_cursor(cursor, ["sub_a", "sub_c"])
+    assert excinfo.value.status_code == 400
+
+
+def test_cursor_rejects_garbage():
+    with pytest.raises(HTTPException) as excinfo:
+        main.decode_page_cursor("not-a-cursor", ["sub_a"])
+    assert excinfo.value.status_code == 400
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 7, 100])
+def test_pages_cover_every_invoice_once_in_order(fake_stripe, limit):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    for subscription_id, count in (("sub_a", 5), ("sub_b", 0), ("sub_c", 4)):
+        fake_stripe.add("subscription", id=subscription_id, customer="cus_1", created=1)
+        # 同じ秒に作成されたインボイスを含める
+        fake_stripe.add_invoices(subscription_id, "cus_1", [1000 + i // 2 for i in range(count)])
+
+    records, pages = read_all_pages(["sub_a", "sub_b", "sub_c"], limit)
+
+    expected = [
+        inv["id"]
+        for subscription_id in ("sub_a", "sub_b", "sub_c")
+        for inv in sorted(
+            (inv for inv in fake_stripe.objects["invoice"].values() if inv["subscription"] == subscription_id),
+            key=lambda inv: (inv["created"], inv["id"]),
+            reverse=True,
+        )
+    ]
+    assert [record["inv_id"] for record in records] == expected
+    assert pages >= -(-len(expected) // limit)
+
+
+def test_pages_respect_since(fake_stripe):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_a", customer="cus_1", created=1)
+    fake_stripe.add_invoices("sub_a", "cus_1", [1000, 1001, 1002, 1003])
+
+    records, _ = read_all_pages(["sub_a"], 1, since=1001)
+
+    assert [record["created"] for record in records] == [1003, 1002]
+
+
+def read_all_charge_pages(subscription_ids, limit):
+    records = []
+    cursor = None
+    pages = 0
+    while True:
+        page = main.search_charges_page(API_KEY, subscription_ids, "epoch", limit, cursor)
+        pages += 1
+        if page["has_more"]:
+            # has_more の次のページが空になることはない
+            assert page["records"]
+        records.extend(page["records"])
+        if not page["has_more"]:
+            assert page["next_starting_after"] is None
+            return records, pages
+        cursor = page["next_starting_after"]
+
+
+def add_charged_invoices(fake_stripe, subscription_id, charges_per_invoice):
+    invoices = fake_stripe.add_invoices(subscription_id, "cus_1", [1000 + i for i in range(len(charges_per_invoice))])
+    for inv, count in zip(invoices, charges_per_invoice):
+        for n in range(count):
+            payment_intent = f"pi_{inv['id']}_{n}"
+            fake_stripe.add("charge", id=f"ch_{inv['id']}_{n}", payment_intent=payment_intent, created=inv["created"])
+            fake_stripe.add(
+                "invoice_payment", id=f"inpay_{inv['id']}_{n}", invoice=inv["id"], status="paid",
+                created=inv["created"], payment={"type": "payment_intent", "payment_intent": payment_intent},
+            )
+
+
+@pytest.mark.parametrize("limit,expected_pages", [(3, 1), (4, 1), (2, 2), (1, 3)])
+def test_charge_page_that_fills_at_the_last_invoice_ends_the_listing(fake_stripe, limit, expected_pages):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_a", customer="cus_1", created=1)
+    # 2件のインボイスに 1件 + 2件 の請求（limit=3 ではちょうど最後のインボイスで埋まる）
+    add_charged_invoices(fake_stripe, "sub_a", [1, 2])
+
+    records, pages = read_all_charge_pages(["sub_a"], limit)
+
+    assert len(records) == len({record["ch_id"] for record in records}) == 3
+    assert pages == expected_pages
+
+
+def test_charge_page_that_fills_at_the_end_of_a_subscription_moves_to_the_next(fake_stripe):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    for subscription_id, charges in (("sub_a", [2]), ("sub_b", [1, 1])):
+        fake_stripe.add("subscription", id=subscription_id, customer="cus_1", created=1)
+        add_charged_invoices(fake_stripe, subscription_id, charges)
+
+    first = main.search_charges_page(API_KEY, ["sub_a", "sub_b"], "epoch", 2, None)
+    assert first["has_more"] is True
+    assert main.decode_page_cursor(first["next_starting_after"], ["sub_a", "sub_b"]) == (1, None, 0)
+
+    records, _ = read_all_charge_pages(["sub_a", "sub_b"], 2)
+    assert len(records) == 4
+
+
+def test_invoice_page_that_fills_at_the_last_invoice_ends_the_listing(fake_stripe):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_a", customer="cus_1", created=1)
+    fake_stripe.add_invoices("sub_a", "cus_1", [1000, 1001, 1002, 1003])
+
+    first = main.get_invoices_page(API_KEY, ["sub_a"], None, "epoch", 2, None)
+    second = main.get_invoices_page(API_KEY, ["sub_a"], None, "epoch", 2, first["next_starting_after"])
+
+    assert first["has_more"] is True
+    assert len(second["records"]) == 2
+    assert second["has_more"] is False
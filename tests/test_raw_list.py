@@ -0,0 +1,136 @@
+import copy
+
+import pytest
+import stripe
+
+import main
+from conftest import API_KEY
+
+INVOICE = {
+    "id": "in_1",
+    "object": "invoice",
+    "customer": "cus_1",
+    "subscription": "sub_1",
+    "status": "paid",
+    "created": 1700000000,
+    "period_start": 1699913600,
+    "period_end": None,
+    "amount_due": 1980,
+    "paid": True,
+    "description": "月額プラン",
+    "discount": None,
+    "metadata": {},
+    "customer_address": {"city": "東京", "country": "JP"},
+    "lines": {
+        "object": "list",
+        "has_more": False,
+        "data": [
+            {"id": "il_1", "amount": 1980, "period": {"start": 1699913600, "end": 1700000000}, "tax_rates": []},
+            {"id": "il_2", "amount": 0, "period": {"start": 1699913600, "end": 1700000000}, "tax_rates": ["txr_1"]},
+        ],
+    },
+}
+
+
+@pytest.mark.parametrize("time_format", ["jst", "iso", "epoch"])
+@pytest.mark.parametrize("object_type", ["invoice", "customer", "unknown_type"])
+def test_flatten_record_is_byte_identical_to_rename_and_flatten(time_format, object_type):
+    original = copy.deepcopy(INVOICE)
+
+    fused = main.flatten_record(INVOICE, object_type, time_format)
+    reference = main.flatten_json(main.rename_id_field(copy.deepcopy(INVOICE), object_type), time_format=time_format)
+
+    assert main.serialize_payload({"records": [fused]}) == main.serialize_payload({"records": [reference]})
+    assert list(fused) == list(reference)
+    # 元の dict は書き換えない
+    assert INVOICE == original
+
+
+def test_list_page_matches_sdk_list(fake_stripe):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_1", customer="cus_1", created=1)
+    fake_stripe.add_invoices("sub_1", "cus_1", [1000, 1001, 1002])
+
+    raw = main.list_page(API_KEY, stripe.Invoice, {"subscription": "sub_1", "limit": 2})
+    sdk = stripe.Invoice.list(subscription="sub_1", limit=2, api_key=API_KEY).to_dict()
+
+    assert raw["has_more"] is sdk["has_more"] is True
+    assert [main.flatten_record(inv, "invoice") for inv in raw["data"]] == [
+        main.flatten_json(main.rename_id_field(inv, "invoice")) for inv in sdk["data"]
+    ]
+
+
+@pytest.mark.parametrize("status,body,error_class", [
+    (429, {"error": {"type": "invalid_request_error", "message": "Too many requests"}}, stripe.error.RateLimitError),
+    (400, {"error": {"type": "invalid_request_error", "code": "rate_limit", "message": "slow down"}}, stripe.error.RateLimitError),
+    (404, {"error": {"type": "invalid_request_error", "code": "resource_missing", "param": "customer", "message": "No such customer"}}, stripe.error.InvalidRequestError),
+    (400, {"error": {"type": "idempotency_error", "message": "Keys reused"}}, stripe.error.IdempotencyError),
+    (401, {"error": {"type": "invalid_request_error", "message": "Invalid API Key"}}, stripe.error.AuthenticationError),
+    (402, {"error": {"type": "card_error", "code": "card_declined", "message": "Declined"}}, stripe.error.CardError),
+    (403, {"error": {"type": "invalid_request_error", "message": "Forbidden"}}, stripe.error.PermissionError),
+    (500, {"error": {"type": "api_error", "message": "Internal error"}}, stripe.error.APIError),
+])
+def test_raw_stripe_error_matches_sdk_error_classes(status, body, error_class):
+    error = main.raw_stripe_error(main.serialize_payload(body), status, {})
+
+    assert type(error) is error_class
+    assert error.http_status == status
+    assert error.user_message == body["error"]["message"]
+
+
+def test_raw_stripe_error_with_unreadable_body():
+    error = main.raw_stripe_error(b"<html>Bad gateway</html>", 502, {})
+
+    assert type(error) is stripe.error.APIError
+    assert error.http_status == 502
+
+
+def test_list_page_error_is_sent_once(fake_stripe):
+    with pytest.raises(stripe.error.InvalidRequestError) as excinfo:
+        main.list_page(API_KEY, stripe.Subscription, {"customer": "cus_missing"})
+
+    assert excinfo.value.param == "customer"
+    assert main.is_resource_missing(excinfo.value)
+    # SDK で呼び直さない
+    assert fake_stripe.count("/v1/subscriptions") == 1
+
+
+def test_list_page_sends_sdk_user_agent(fake_stripe):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    main.list_page(API_KEY, stripe.Customer, {})
+    stripe.Customer.list(api_key=API_KEY)
+
+    (_, _, _, raw_headers), (_, _, _, sdk_headers) = fake_stripe.requests
+    # SDK は実行環境によって末尾に項目を足すため、先頭の形式だけを比べる
+    assert sdk_headers["User-Agent"].startswith(raw_headers["User-Agent"])
+    assert raw_headers["User-Agent"].startswith(f"Stripe/v1 PythonBindings/{stripe.VERSION}")
+    assert raw_headers["Authorization"] == f"Bearer {API_KEY}"
+
+
+def test_unknown_list_parameter_is_rejected_like_the_sdk(fake_stripe):
+    # Charge.list には invoice の絞り込みが無く、Stripe は 400 を返す
+    with pytest.raises(stripe.error.InvalidRequestError) as raw:
+        main.list_page(API_KEY, stripe.Charge, {"invoice": "in_1"})
+    with pytest.raises(stripe.error.InvalidRequestError) as sdk:
+        stripe.Charge.list(invoice="in_1", api_key=API_KEY)
+
+    assert raw.value.http_status == sdk.value.http_status == 400
+    assert raw.value.param == sdk.value.param == "invoice"
+    assert raw.value.user_message == sdk.value.user_message == "Received unknown parameter: invoice"
+    assert raw.value.code == sdk.value.code
+    # resource_missing ではないため、ネガティブキャッシュには入れない
+    assert not main.is_resource_missing(raw.value)
+    assert main.negative_cache.get(main.account_key(API_KEY), "invoice", "in_1") is None
+
+
+def test_charge_list_by_payment_intent_matches_sdk(fake_stripe):
+    fake_stripe.add("charge", id="ch_1", payment_intent="pi_1", status="succeeded", created=1000)
+    fake_stripe.add("charge", id="ch_2", payment_intent="pi_2", status="succeeded", created=1001)
+
+    raw = main.list_page(API_KEY, stripe.Charge, {"payment_intent": "pi_1"})
+    sdk = stripe.Charge.list(payment_intent="pi_1", api_key=API_KEY).to_dict()
+
+    assert [main.flatten_record(ch, "charge") for ch in raw["data"]] == [
+        main.flatten_json(main.rename_id_field(ch, "charge")) for ch in sdk["data"]
+    ]
+    assert [ch["id"] for ch in raw["data"]] == ["ch_1"]
@@ -0,0 +1,86 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from conftest import API_KEY
+
+
+@pytest.fixture
+def client(fake_stripe, monkeypatch):
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(60, 100))
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_1", customer="cus_1", created=1)
+    return TestClient(main.app)
+
+
+PARAMS = {"api_key": API_KEY, "subscription_ids": "sub_1"}
+
+
+def test_miss_returns_strong_etag_then_hit(fake_stripe, client):
+    first = client.get("/search_subscriptions_by_id", params=PARAMS)
+    second = client.get("/search_subscriptions_by_id", params=PARAMS)
+
+    assert first.headers["X-Cache"] == "MISS"
+    assert first.headers["ETag"].startswith('"') and not first.headers["ETag"].startswith("W/")
+    assert first.headers["ETag"] == main.compute_etag(first.content)
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert fake_stripe.count("/v1/subscriptions/sub_1") == 1
+
+
+def test_matching_if_none_match_returns_304(client):
+    etag = client.get("/search_subscriptions_by_id", params=PARAMS).headers["ETag"]
+
+    response = client.get("/search_subscriptions_by_id", params=PARAMS, headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+
+def test_other_if_none_match_returns_body(client):
+    client.get("/search_subscriptions_by_id", params=PARAMS)
+
+    response = client.get("/search_subscriptions_by_id", params=PARAMS, headers={"If-None-Match": '"other"'})
+
+    assert response.status_code == 200
+    assert response.json()["records"]
+
+
+def test_no_cache_request_bypasses_cache(fake_stripe, client):
+    client.get("/search_subscriptions_by_id", params=PARAMS)
+
+    response = client.get("/search_subscriptions_by_id", params=PARAMS, headers={"Cache-Control": "no-cache"})
+
+    assert response.headers["X-Cache"] == "MISS"
+    assert fake_stripe.count("/v1/subscriptions/sub_1") == 2
+
+
+def test_evicts_least_recently_used_to_fit_byte_budget():
+    cache = main.ResponseCache(60, 100, max_bytes=250)
+    for key in ("a", "b", "c"):
+        cache.set(key, b"x" * 100, '"etag"', "acct", [key])
+
+    assert cache.get("a") is None
+    assert cache.get("b") is not None and cache.get("c") is not None
+    assert cache.total_bytes == 200
+
+
+def test_body_larger_than_budget_is_not_cached():
+    cache = main.ResponseCache(60, 100, max_bytes=250)
+    cache.set("small", b"x" * 100, '"etag"', "acct", ["small"])
+    cache.set("large", b"x" * 300, '"etag"', "acct", ["large"])
+
+    assert cache.get("large") is None
+    assert cache.get("small") is not None
+    assert cache.total_bytes == 100
+
+
+def test_invalidate_releases_bytes():
+    cache = main.ResponseCache(60, 100, max_bytes=1000)
+    cache.set("a", b"x" * 100, '"etag"', "acct", ["sub_1"])
+    cache.set("b", b"x" * 100, '"etag"', "acct", ["sub_2"])
+
+    assert cache.invalidate("acct", ["sub_1"]) == 1
+    assert cache.get("a") is None
+    assert cache.total_bytes == 100
@@ -0,0 +1,34 @@
+import datetime
+import json
+
+import pytest
+
+import main
+
+
+def stdlib_json(payload) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+@pytest.mark.parametrize("payload", [
+    {"records": [{"inv_id": "in_1", "amount_due": 1980, "paid": True, "discount": None}]},
+    {"records": [{"customer_name": "山田 太郎", "description": "スタンダードプラン × 1"}]},
+    {"records": [{"created": "2024/01/01 09:00:00", "tax_percent": 10.0, "rate": 0.1}]},
+    {"records": [], "watermark": None, "missing_ids": ["cus_1"]},
+    {"text": " \x7f\x00\"\\"},
+    {1: "non-string key", None: "null key"},
+    {"at": datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=9)))},
+    {"huge": 2 ** 70},
+])
+def test_serialize_payload_is_byte_identical_to_json(payload):
+    assert main.serialize_payload(payload) == stdlib_json(payload)
+
+
+@pytest.mark.skipif(main.orjson is None, reason="orjson is not installed")
+@pytest.mark.parametrize("payload,expected", [
+    ({"amount": 1e16}, b'{"amount":1e16}'),
+    ({"amount": float("nan")}, b'{"amount":null}'),
+])
+def test_serialize_payload_known_differences(payload, expected):
+    # 指数表記の小数と NaN だけは標準の json とバイト列が異なる
+    assert main.serialize_payload(payload) == expected
@@ -0,0 +1,57 @@
+import random
+
+import pytest
+import stripe
+
+import main
+from conftest import API_KEY
+
+
+def seed_invoices(fake_stripe, created):
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_1", customer="cus_1", created=min(created))
+    fake_stripe.add_invoices("sub_1", "cus_1", created)
+
+
+def unsharded(params):
+    return [inv["id"] for inv in main.iter_list(API_KEY, stripe.Invoice, params)]
+
+
+@pytest.mark.parametrize("shards", [2, 3, 4, 16])
+@pytest.mark.parametrize("distribution", ["spread", "clustered", "same_second"])
+def test_windows_merge_without_gaps_or_duplicates(fake_stripe, shards, distribution):
+    rng = random.Random(shards)
+    if distribution == "spread":
+        created = [1_000_000 + i * 3600 for i in range(450)]
+    elif distribution == "clustered":
+        # 区間の境界に同じ秒のインボイスが並ぶようにする
+        created = [1_000_000 + rng.randrange(40) for _ in range(450)]
+    else:
+        created = [1_000_000] * 250
+    seed_invoices(fake_stripe, created)
+    params = {"subscription": "sub_1"}
+
+    sharded = main.list_sharded(API_KEY, stripe.Invoice, params, lambda: min(created), shards)
+
+    ids = [inv["id"] for inv in sharded]
+    assert len(ids) == len(set(ids)) == len(created)
+    assert ids == unsharded(params)
+
+
+@pytest.mark.parametrize("bound", [{"gt": 1_000_100}, {"gte": 1_000_100}])
+def test_windows_respect_created_bounds(fake_stripe, bound):
+    created = [1_000_000 + i for i in range(400)]
+    seed_invoices(fake_stripe, created)
+    params = {"subscription": "sub_1", "created": bound}
+
+    sharded = main.list_sharded(API_KEY, stripe.Invoice, params, lambda: min(created), 4)
+
+    assert [inv["id"] for inv in sharded] == unsharded(params)
+
+
+def test_single_page_is_not_sharded(fake_stripe):
+    seed_invoices(fake_stripe, [1_000_000 + i for i in range(10)])
+
+    main.list_sharded(API_KEY, stripe.Invoice, {"subscription": "sub_1"}, lambda: 0, 8)
+
+    assert fake_stripe.count("/v1/invoices") == 1
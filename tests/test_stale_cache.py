@@ -0,0 +1,105 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from conftest import API_KEY
+
+PARAMS = {"api_key": API_KEY, "subscription_ids": "sub_1"}
+
+
+@pytest.fixture
+def client(fake_stripe, monkeypatch):
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(60, 100, stale_ttl=600))
+    monkeypatch.setattr(main, "CACHE_STALE_WHILE_REVALIDATE", 30)
+    monkeypatch.setattr(main, "CACHE_STALE_IF_ERROR", 600)
+    fake_stripe.add("customer", id="cus_1", created=1)
+    fake_stripe.add("subscription", id="sub_1", customer="cus_1", created=1, description="old")
+    return TestClient(main.app)
+
+
+def expire(seconds_ago):
+    (key,) = main.response_cache._entries
+    entry = main.response_cache.get(key)
+    entry["expires_at"] = time.time() - seconds_ago
+    entry["stored_at"] = entry["expires_at"] - 60
+
+
+def wait_for_refresh():
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        with main.cache_refresh_lock:
+            if not main.cache_refresh_keys:
+                return
+        time.sleep(0.01)
+    raise AssertionError("background refresh did not finish")
+
+
+def description(response):
+    return response.json()["records"][0]["description"]
+
+
+def test_stale_while_revalidate_serves_old_body_and_refreshes(fake_stripe, client):
+    client.get("/search_subscriptions_by_id", params=PARAMS)
+    expire(5)
+    fake_stripe.objects["subscription"]["sub_1"]["description"] = "new"
+
+    stale = client.get("/search_subscriptions_by_id", params=PARAMS)
+    wait_for_refresh()
+    fresh = client.get("/search_subscriptions_by_id", params=PARAMS)
+
+    assert stale.headers["X-Cache"] == "STALE"
+    assert int(stale.headers["Age"]) >= 65
+    assert description(stale) == "old"
+    assert fresh.headers["X-Cache"] == "HIT"
+    assert description(fresh) == "new"
+    assert fake_stripe.count("/v1/subscriptions/sub_1") == 2
+
+
+def test_stale_if_error_serves_old_body_when_stripe_fails(fake_stripe, client):
+    client.get("/search_subscriptions_by_id", params=PARAMS)
+    expire(120)
+    fake_stripe.outage = (500, "api_error")
+
+    response = client.get("/search_subscriptions_by_id", params=PARAMS)
+
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "STALE-ERROR"
+    assert int(response.headers["Age"]) >= 180
+    assert description(response) == "old"
+
+
+@pytest.mark.parametrize("outage,expired_for", [
+    ((404, "invalid_request_error"), 120),  # 一時的でないエラーは古い内容で隠さない
+    ((500, "api_error"), 700),  # CACHE_STALE_IF_ERROR を過ぎている
+])
+def test_stale_if_error_limits(fake_stripe, client, outage, expired_for):
+    client.get("/search_subscriptions_by_id", params=PARAMS)
+    expire(expired_for)
+    fake_stripe.outage = outage
+
+    response = client.get("/search_subscriptions_by_id", params=PARAMS)
+
+    assert response.status_code >= 400
+
+
+def test_stale_upcoming_preview_after_error_is_marked(fake_stripe, monkeypatch):
+    monkeypatch.setattr(main, "upcoming_cache", main.UpcomingInvoiceCache(300, 100, stale_ttl=600))
+    monkeypatch.setattr(main, "CACHE_STALE_WHILE_REVALIDATE", 0)
+    monkeypatch.setattr(main, "CACHE_STALE_IF_ERROR", 600)
+    subscription = {"id": "sub_1", "customer": "cus_1", "items": {"data": []}}
+    fake_stripe.previews["sub_1"] = {"amount_due": 1000, "currency": "jpy", "lines": {"data": []}}
+    main.get_upcoming_invoice(API_KEY, subscription)
+    entry = main.upcoming_cache.get(main.account_key(API_KEY), "sub_1", main.billing_fingerprint(subscription))
+    entry["expires_at"] = time.time() - 10
+    fake_stripe.outage = (429, "invalid_request_error")
+
+    token = main.list_stats.set({"pages": 0, "objects": 0, "skipped": {}, "stale_since": None, "stale_error": False})
+    try:
+        preview = main.get_upcoming_invoice(API_KEY, subscription)
+        assert preview["amount_due"] == 1000
+        assert main.stale_data_since() == entry["stored_at"]
+        assert main.stale_data_after_error() is True
+    finally:
+        main.list_stats.reset(token)
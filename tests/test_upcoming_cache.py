@@ -0,0 +1,89 @@
+import pytest
+
+import main
+from conftest import API_KEY
+
+PREVIEW = {
+    "amount_due": 1980,
+    "currency": "jpy",
+    "due_date": None,
+    "customer_address": {"city": "東京"},
+    "lines": {"object": "list", "data": [
+        {"id": "il_1", "description": "月額プラン", "amount": 1980, "quantity": 1,
+         "pricing": {"price_details": {"price": "price_1"}}, "period": {"start": 1, "end": 2}},
+    ]},
+}
+
+
+@pytest.fixture
+def cache(fake_stripe, monkeypatch):
+    upcoming_cache = main.UpcomingInvoiceCache(300, 100)
+    monkeypatch.setattr(main, "upcoming_cache", upcoming_cache)
+    return upcoming_cache
+
+
+def subscription(quantity=1, price="price_1", item="si_1"):
+    return {
+        "id": "sub_1",
+        "customer": "cus_1",
+        "status": "active",
+        "items": {"data": [{"id": item, "price": {"id": price}, "quantity": quantity}]},
+    }
+
+
+def preview_calls(fake_stripe):
+    return fake_stripe.count("/v1/invoices/create_preview")
+
+
+def test_hit_while_fingerprint_is_unchanged(fake_stripe, cache):
+    fake_stripe.previews["sub_1"] = PREVIEW
+
+    first = main.get_upcoming_invoice(API_KEY, subscription())
+    second = main.get_upcoming_invoice(API_KEY, subscription())
+
+    assert first == second == main.project_upcoming_invoice(PREVIEW)
+    assert second["lines"] == [{"description": "月額プラン", "amount": 1980, "quantity": 1, "price_id": "price_1"}]
+    assert preview_calls(fake_stripe) == 1
+
+
+@pytest.mark.parametrize("changed", [
+    subscription(quantity=2),
+    subscription(price="price_2"),
+    subscription(item="si_2"),
+])
+def test_miss_after_items_or_quantity_change(fake_stripe, cache, changed):
+    fake_stripe.previews["sub_1"] = PREVIEW
+    main.get_upcoming_invoice(API_KEY, subscription())
+
+    main.get_upcoming_invoice(API_KEY, changed)
+
+    assert preview_calls(fake_stripe) == 2
+
+
+def test_missing_preview_is_cached(fake_stripe, cache):
+    assert main.get_upcoming_invoice(API_KEY, subscription()) is None
+    assert main.get_upcoming_invoice(API_KEY, subscription()) is None
+
+    assert preview_calls(fake_stripe) == 1
+
+
+def test_invalidate_by_customer_id(fake_stripe, cache):
+    fake_stripe.previews["sub_1"] = PREVIEW
+    main.get_upcoming_invoice(API_KEY, subscription())
+
+    assert cache.invalidate(main.account_key(API_KEY), ["cus_other"]) == 0
+    assert cache.invalidate(main.account_key(API_KEY), ["cus_1"]) == 1
+    main.get_upcoming_invoice(API_KEY, subscription())
+
+    assert preview_calls(fake_stripe) == 2
+
+
+def test_cache_stores_only_projected_fields_within_byte_budget():
+    cache = main.UpcomingInvoiceCache(300, 100, max_bytes=400)
+    preview = main.project_upcoming_invoice(PREVIEW)
+    for subscription_id in ("sub_1", "sub_2", "sub_3"):
+        cache.set("acct", subscription_id, "cus_1", "fp", preview)
+
+    assert "customer_address" not in cache.get("acct", "sub_3", "fp")["preview"]
+    assert cache.get("acct", "sub_1", "fp") is None
+    assert cache.total_bytes <= 400